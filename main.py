@@ -9,7 +9,7 @@ from datetime import datetime
 from typing import Optional
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
@@ -19,6 +19,7 @@ from pydantic import BaseModel
 from src.agents.knowledge_agent import llm, llm_vision
 from src.utils.config import settings
 from src.utils.scheduler import start_scheduler
+from src.utils.sse import FLUSH_TICK, SSECoalescer
 
 # 配置日志系统
 logging.basicConfig(
@@ -44,6 +45,9 @@ class Config:
     MAX_TOOLS_PER_ROUND = 5
     MAX_TOOL_ROUNDS = 10
     CONTENT_PREVIEW_LENGTH = 2000
+    
+    # 客户端断开检测的轮询间隔（秒）
+    DISCONNECT_POLL_INTERVAL = 1.0
 
 app = FastAPI(title=settings.PROJECT_NAME)
 
@@ -58,6 +62,11 @@ class ChatRequest(BaseModel):
     history: list = []
     summary: str = ""
     auto_save: bool = True
+    # 会话模式：提供 session_id 时忽略 history/summary，以服务端会话为准，metadata 只返回增量
+    session_id: Optional[str] = None
+    version: Optional[int] = None
+    # 会话模式下 metadata 默认不带完整提示词（raw_prompt / system_prompt），调试时设为 True
+    debug: bool = False
 
 # 配置 CORS 跨域支持 (允许移动端 Web 访问)
 app.add_middleware(
@@ -70,7 +79,31 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup_event():
+    from src.storage.webdav_pool import open_webdav_pool
+    await open_webdav_pool()
     start_scheduler()
+    if settings.INCREMENTAL_ARCHIVE_ENABLED:
+        from src.agents.incremental_archive import start_incremental_archive
+        start_incremental_archive()
+    if settings.CACHE_WARMUP_ENABLED:
+        from src.storage.cache_warmup import start_cache_warmup
+        start_cache_warmup(settings.CACHE_WARMUP_CONCURRENCY)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from src.storage.sphere_storage import get_sphere_storage
+    from src.storage.webdav_pool import close_webdav_pool
+    from src.agents.incremental_archive import get_incremental_archiver
+    # 先刷新延迟写回的会话，再关闭连接池
+    get_incremental_archiver().stop()
+    storage = get_sphere_storage()
+    failed = await storage.flush_pending_sessions()
+    if failed:
+        # 云端没有拿到最新对话，写入本地会话文件（云端无记录时从这里加载）
+        logger.error(f"[Shutdown] 会话未能上传到云端: {failed}，已保存到本地")
+        latest = storage.session_writer.get_pending(max(failed))
+        save_session_if_needed(True, latest["history"], latest["summary"])
+    await close_webdav_pool()
 
 @app.get("/health")
 async def health_check():
@@ -86,11 +119,34 @@ async def health_check():
         
         # 检查存储连接（简单测试）
         storage_status = "unknown"
+        pool_status = {}
+        cache_status = {}
+        session_writer_status = {}
+        warmup_status = {}
+        index_status = {}
+        llm_usage = {}
+        disconnect_status = {}
+        archive_status = {}
         try:
             from src.storage.sphere_storage import get_sphere_storage
+            from src.storage.webdav_pool import get_pool_stats
+            from src.storage.infinicloud import get_cache_stats
+            from src.storage.cache_warmup import get_warmup_status
+            from src.agents.memory_index import get_memory_index
+            from src.agents.thinking_tool_stream import get_usage_stats, get_cancel_stats
+            from src.agents.incremental_archive import get_incremental_archiver
+            from src.agents.history_summarizer import get_summary_stats
             storage = get_sphere_storage()
             # 简单的连接测试
             storage_status = "connected"
+            pool_status = get_pool_stats()
+            cache_status = get_cache_stats()
+            session_writer_status = {**storage.session_writer.stats(), "journal": storage.journal.stats()}
+            warmup_status = get_warmup_status()
+            index_status = get_memory_index().stats()
+            llm_usage = get_usage_stats()
+            disconnect_status = {**CHAT_DISCONNECT_STATS, **get_cancel_stats()}
+            archive_status = {"incremental": get_incremental_archiver().stats(), "chunk_summaries": get_summary_stats()}
         except Exception as e:
             storage_status = f"error: {str(e)[:100]}"
         
@@ -100,6 +156,14 @@ async def health_check():
             "version": "1.0.0",
             "config": config_status,
             "storage": storage_status,
+            "webdav_pool": pool_status,
+            "webdav_cache": cache_status,
+            "session_writer": session_writer_status,
+            "cache_warmup": warmup_status,
+            "memory_index": index_status,
+            "llm_usage": llm_usage,
+            "chat_disconnects": disconnect_status,
+            "archive": archive_status,
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
@@ -113,24 +177,34 @@ async def health_check():
 class SessionSyncRequest(BaseModel):
     history: list
     summary: str
+    wait: bool = False  # True 时等待上传完成再返回
 
 @app.get("/session/load")
 async def load_session():
-    """从云端恢复会话状态"""
+    """从云端恢复会话状态（附带会话模式所需的 session_id 和 version）"""
     from src.storage.sphere_storage import get_sphere_storage
     storage = get_sphere_storage()
-    return await storage.load_current_session()
+    state = await storage.get_session_state()
+    return {
+        "history": state.history,
+        "summary": state.summary,
+        "session_id": state.session_id,
+        "version": state.version
+    }
 
 @app.post("/session/sync")
 async def sync_session(req: SessionSyncRequest):
-    """同步会话状态至云端"""
+    """
+    同步会话状态至云端。
+    默认延迟写回（与 /chat 的自动保存合并），返回 scheduled；wait=True 时立即上传并返回结果。
+    """
     from src.storage.sphere_storage import get_sphere_storage
     storage = get_sphere_storage()
-    success = await storage.save_current_session(req.history, req.summary)
-    if success:
-        return {"status": "synced"}
-    else:
-        return {"status": "error", "message": "同步失败"}
+    if req.wait:
+        success = await storage.save_current_session(req.history, req.summary)
+        return {"status": "synced" if success else "failed", "deferred": False}
+    storage.schedule_save_current_session(req.history, req.summary)
+    return {"status": "scheduled", "deferred": True}
 
 @app.delete("/session/clear")
 async def clear_session():
@@ -219,8 +293,8 @@ async def delete_message(index: int):
 # [REMOVED] TodoItem 和 todos API 已移除 (V3.0 简化)
 
 # ===== 认知球 V2.3 新增接口 =====
-from src.agents.memory_tools import fetch_memory, list_available_memories, MEMORY_TOOLS, read_memory_readonly
-from src.agents.daily_archive import trigger_daily_archive as do_daily_archive
+from src.agents.memory_tools import fetch_memory, search_memory, list_available_memories, MEMORY_TOOLS, read_memory_readonly
+from src.agents.daily_archive import archive_session as do_daily_archive
 
 class MemoryRequest(BaseModel):
     filename: str
@@ -253,42 +327,41 @@ async def api_delete_memory(req: DeleteMemoryRequest):
     else:
         return {"success": False, "error": f"删除文件 {req.filename} 失败"}
 
+def format_http_date(value: Optional[str]) -> str:
+    """将 WebDAV 的 HTTP-date 转为北京时间字符串"""
+    if not value:
+        return "未知"
+    try:
+        from email.utils import parsedate_to_datetime
+        from src.utils.date_helper import BEIJING_TZ
+        return parsedate_to_datetime(value).astimezone(BEIJING_TZ).strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return value
+
 @app.get("/memory/list")
 async def api_list_memories():
-    """列出可用的记忆文件"""
+    """列出可用的记忆文件（元数据来自一次 PROPFIND，不下载文件内容）"""
     try:
         from src.storage.sphere_storage import get_sphere_storage
         storage = get_sphere_storage()
         
-        files = await list_available_memories()
-        memories = []
-        
-        for filename in files:
-            # 获取文件的详细信息
-            try:
-                content = await storage.read_memory_file(filename)
-                size = len(content) if content else 0
-                
-                # 尝试获取文件的访问时间（从WebDAV或本地）
-                # 这里可以扩展获取更详细的元数据
-                last_accessed = "最近访问"  # 暂时使用占位符
-                
-                memories.append({
-                    "filename": filename,
-                    "last_accessed": last_accessed,
-                    "size": size
-                })
-            except Exception as e:
-                logger.warning(f"Failed to get info for {filename}: {e}")
-                memories.append({
-                    "filename": filename,
-                    "last_accessed": "未知",
-                    "size": 0
-                })
+        entries = await storage.list_memory_entries()
+        memories = [
+            {
+                "filename": entry.name,
+                "last_modified": format_http_date(entry.last_modified),
+                "last_modified_http": entry.last_modified,
+                # 已弃用：旧客户端读取的字段名，值同 last_modified，保留一个版本后移除
+                "last_accessed": format_http_date(entry.last_modified),
+                "etag": entry.etag,
+                "size": entry.size
+            }
+            for entry in entries
+        ]
         
         return {
             "memories": memories,
-            "files": files,  # 保持向后兼容
+            "files": [entry.name for entry in entries],  # 保持向后兼容
             "count": len(memories)
         }
     except Exception as e:
@@ -410,15 +483,26 @@ def write_debug_prompt(messages: list) -> None:
     except Exception as e:
         logger.error(f"Failed to write debug prompt: {e}")
 
+MEMORY_TOOL_REMINDER = "**重要提醒**：\n1. 在调用 fetch_memory 工具前，请**务必先仔细检查对话历史**中是否已经包含相关的记忆内容\n2. 如果历史中有 [已检索的长期记忆] 标记的内容，说明相关记忆已经获取过，**不要重复调用工具**\n3. 只有当历史中确实没有相关信息时，才调用记忆工具\n4. 不确定信息在哪个文件时，用 search_memory 一次检索全部记忆，而不是逐个文件调用 fetch_memory\n5. 优先使用历史中已有的记忆内容来回答问题"
+
+
 def build_system_prompt(summary: str, memory_files: list) -> str:
-    """构建系统提示词"""
-    system_content = ""
+    """
+    构建系统提示词。
     
-    if summary:
-        system_content += f"\n\n【前情提要（动态记忆）】：\n{summary}"
-        
+    stable 布局（默认）：固定说明和排序后的记忆文件清单在前，逐日变化的摘要在后，
+    使提示词前缀在多轮之间逐字节一致，命中 DeepSeek 上下文缓存。
+    legacy 布局：摘要在前（旧行为）。
+    """
+    manifest = ""
     if memory_files:
-        system_content += f"\n\n【可用长期记忆文件】：{', '.join(memory_files)}\n\n**重要提醒**：\n1. 在调用 fetch_memory 工具前，请**务必先仔细检查对话历史**中是否已经包含相关的记忆内容\n2. 如果历史中有 [已检索的长期记忆] 标记的内容，说明相关记忆已经获取过，**不要重复调用工具**\n3. 只有当历史中确实没有相关信息时，才调用 fetch_memory 工具\n4. 优先使用历史中已有的记忆内容来回答问题"
+        manifest = f"\n\n【可用长期记忆文件】：{', '.join(sorted(memory_files))}\n\n{MEMORY_TOOL_REMINDER}"
+    summary_block = f"\n\n【前情提要（动态记忆）】：\n{summary}" if summary else ""
+    
+    if settings.PROMPT_LAYOUT == "legacy":
+        system_content = summary_block + manifest
+    else:
+        system_content = manifest + summary_block
     
     # 调试：输出系统提示词
     logger.info(f"[DEBUG] System prompt built: {system_content[:200]}...")
@@ -458,8 +542,58 @@ def save_session_if_needed(auto_save: bool, history: list, summary: str) -> None
         logger.info("[Session] auto_save=False, skipped saving")
 
 
+# 客户端中途断开时放弃的工作（供 /health 观察）
+CHAT_DISCONNECT_STATS = {"disconnects": 0, "saves_skipped": 0, "discarded_chars": 0}
+
+
+def record_disconnect(stage: str, discarded_chars: int, save_skipped: bool):
+    CHAT_DISCONNECT_STATS["disconnects"] += 1
+    CHAT_DISCONNECT_STATS["discarded_chars"] += discarded_chars
+    if save_skipped:
+        CHAT_DISCONNECT_STATS["saves_skipped"] += 1
+    logger.info(f"[Disconnect] 客户端已断开 ({stage})，丢弃 {discarded_chars} 字符，跳过保存: {save_skipped}")
+
+
+async def watch_disconnect(request: Request, cancel_event: asyncio.Event):
+    """轮询客户端连接状态，断开时触发 cancel_event"""
+    while not cancel_event.is_set():
+        if await request.is_disconnected():
+            cancel_event.set()
+            return
+        await asyncio.sleep(Config.DISCONNECT_POLL_INTERVAL)
+
+
+async def cancel_on_disconnect(request: Request, frames, cancel_event: asyncio.Event):
+    """
+    转发 SSE 帧，并把客户端断开传递给生成器：
+    轮询发现断开，或 Starlette 因断开取消响应任务时，都会触发 cancel_event。
+    """
+    watcher = asyncio.create_task(watch_disconnect(request, cancel_event))
+    try:
+        async for frame in frames:
+            yield frame
+    except (asyncio.CancelledError, GeneratorExit):
+        cancel_event.set()
+        raise
+    finally:
+        watcher.cancel()
+
+
+def build_session_delta(state, req: ChatRequest, base_version: int, appended: list) -> dict:
+    """
+    会话模式的 metadata。
+    客户端版本与本轮开始时的服务端版本一致、且期间没有其他写入时只返回新增消息；
+    否则返回完整历史并标记 resync，客户端直接替换本地状态。
+    """
+    delta = {"session_id": state.session_id, "version": state.version, "base_version": base_version}
+    if req.session_id == state.session_id and req.version == base_version and state.version == base_version + 1:
+        delta["append"] = appended
+    else:
+        delta.update(resync=True, history=state.history, summary=state.summary)
+    return delta
+
 @app.post("/chat")
-async def chat_with_agent(req: ChatRequest):
+async def chat_with_agent(req: ChatRequest, request: Request):
     """
     三层记忆架构对话接口 (TMA Stage 1) - 流式版本:
     1. 动态注入 L2 摘要作为“长期背景”
@@ -475,6 +609,7 @@ async def chat_with_agent(req: ChatRequest):
     sys.stderr.flush()
     
     logger.info("--- [Stream Chat Session Start] ---")
+    cancel_event = asyncio.Event()  # 客户端断开时触发
     
     async def chat_generator():
         banner = f"\n{'='*30}\n🟢 NEW STREAMING REQUEST AT {datetime.now().strftime('%H:%M:%S.%f')[:-3]}\n{'='*30}\n"
@@ -482,40 +617,75 @@ async def chat_with_agent(req: ChatRequest):
         sys.stderr.write(f"RAW USER TEXT: {req.message}\n")
         sys.stderr.flush()
         
+        # 会话模式下历史和摘要以服务端为准，否则使用客户端上传的完整历史（兼容旧前端）
+        from src.storage.sphere_storage import get_sphere_storage
+        storage = get_sphere_storage()
+        session_state = await storage.get_session_state() if req.session_id else None
+        if session_state is not None:
+            base_history, base_summary, base_version = list(session_state.history), session_state.summary, session_state.version
+        else:
+            base_history, base_summary, base_version = req.history, req.summary, None
+        
         # 构建系统提示词和消息
         from src.agents.memory_tools import list_available_memories
         memory_files = await list_available_memories()
-        system_content = build_system_prompt(req.summary, memory_files)
-        messages = build_messages(system_content, req.history, req.message, req.images)
+        system_content = build_system_prompt(base_summary, memory_files)
+        # 按 token 预算裁剪历史（只影响发送给模型的内容，保存的历史保持完整）
+        from src.agents.context_window import fit_history
+        window = fit_history(
+            base_history,
+            settings.CHAT_HISTORY_TOKEN_BUDGET,
+            settings.CHAT_HISTORY_KEEP_RECENT,
+            settings.CHAT_HISTORY_OLD_MESSAGE_TOKENS,
+            settings.CHAT_HISTORY_DROP_BLOCK
+        )
+        messages = build_messages(system_content, window.history, req.message, req.images)
+        
+        # SSE 编码器：合并 content 增量，三条生成路径共用
+        sse = SSECoalescer()
         
         # 多模态路由：如果有图片，则使用 Gemini 3 Flash 进行视觉分析
         if req.images:
             if not settings.GOOGLE_API_KEY or settings.GOOGLE_API_KEY == "EMPTY":
-                yield "event: content\ndata: ❌ 检测到图片输入，但系统未配置 `GOOGLE_API_KEY`。请在环境变量或 `.env` 中添加该密钥以激活视觉分析功能。\n\n"
+                yield sse.event("content", "❌ 检测到图片输入，但系统未配置 `GOOGLE_API_KEY`。请在环境变量或 `.env` 中添加该密钥以激活视觉分析功能。")
                 return
             
-            yield "event: status\ndata: 📸 正在使用 Gemini 3 Flash 进行视觉分析...\n\n"
-            async for chunk in llm_vision.astream(messages):
+            yield sse.event("status", "📸 正在使用 Gemini 3 Flash 进行视觉分析...")
+            full_content = ""
+            vision_stream = llm_vision.astream(messages)
+            paced_vision = sse.paced(vision_stream)
+            async for chunk in paced_vision:
+                if cancel_event.is_set():
+                    break
+                if chunk is FLUSH_TICK:
+                    frame = sse.flush()
+                    if frame:
+                        yield frame
+                    continue
                 full_content += chunk.content
-                # 转换换行符以适应 SSE 格式
-                content_lines = chunk.content.split('\n')
-                if len(content_lines) == 1:
-                    yield f"event: content\ndata: {chunk.content}\n\n"
-                else:
-                    sse_content = "event: content\n"
-                    for line in content_lines:
-                        sse_content += f"data: {line}\n"
-                    sse_content += "\n"
-                    yield sse_content
+                frame = sse.content(chunk.content)
+                if frame:
+                    yield frame
+            if cancel_event.is_set():
+                await paced_vision.aclose()
+                await vision_stream.aclose()
+                record_disconnect("vision", len(full_content), req.auto_save)
+                return
             
             # 直接跳到会话保存阶段
-            save_session_if_needed(req.auto_save, req.history + [{"role": "user", "content": req.message}, {"role": "ai", "content": full_content}], req.summary)
-            yield f"event: metadata\ndata: {json.dumps({'summary': req.summary, 'history': req.history + [{'role': 'user', 'content': req.message}, {'role': 'ai', 'content': full_content}]}, ensure_ascii=False)}\n\n"
+            appended = [{"role": "user", "content": req.message}, {"role": "ai", "content": full_content}]
+            if session_state is not None:
+                session_state = storage.append_session_messages(appended, persist=req.auto_save)
+                vision_meta = build_session_delta(session_state, req, base_version, appended)
+            else:
+                save_session_if_needed(req.auto_save, base_history + appended, base_summary)
+                vision_meta = {"summary": base_summary, "history": base_history + appended}
+            yield sse.event("metadata", json.dumps(vision_meta, ensure_ascii=False))
             return
         
         # 日志追踪
         logger.info(f">>> [System Prompt Context]:\n{system_content}")
-        logger.info(f">>> [Chat History Window]: {len(req.history)} messages")
+        logger.info(f">>> [Chat History Window]: {len(window.history)}/{len(base_history)} messages, saved ~{window.tokens_saved} tokens")
 
         # 写入调试日志
         write_debug_prompt(messages)
@@ -524,6 +694,7 @@ async def chat_with_agent(req: ChatRequest):
         
         full_content = ""
         m3_context = ""  # 存储检索到的长期记忆
+        usage_totals = {}  # 本次请求各轮的 token 用量（含上下文缓存命中/未命中）
         use_thinking_mode = True  # 必须使用thinking mode
         
         # --- 定义工具 ---
@@ -542,6 +713,22 @@ async def chat_with_agent(req: ChatRequest):
                         "required": ["filename"]
                     }
                 }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "search_memory",
+                    "description": "跨全部记忆文件检索长期记忆，一次返回最相关的章节及其来源（文件 > 标题）。不确定信息在哪个文件、或问题涉及多个领域时优先使用，避免逐个文件调用 fetch_memory。",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "query": {"type": "string", "description": "检索内容，如：跑步计划、买房预算、跳槽考虑"},
+                            "top_k": {"type": "integer", "description": "最多返回的章节数，默认 5"},
+                            "token_budget": {"type": "integer", "description": "返回内容的最大 token 数，默认 1500"}
+                        },
+                        "required": ["query"]
+                    }
+                }
             }
         ] if memory_files else []
         
@@ -552,9 +739,15 @@ async def chat_with_agent(req: ChatRequest):
             logger.info(f"[Tools Debug] 工具定义: {json.dumps(tools[0], ensure_ascii=False, indent=2)}")
         
         # --- 工具执行器 ---
+        # 工具可能被提前启动后取消重跑，执行器本身不改动 m3_context：
+        # 检索到的记忆按 (工具名, 参数) 暂存，收到 TOOL_RESULT 时才并入（同一调用重跑只覆盖不重复）
+        tool_memory_blocks: dict[tuple, str] = {}
+
+        def tool_key(name: str, args: dict) -> tuple:
+            return name, json.dumps(args, ensure_ascii=False, sort_keys=True)
+
         async def execute_tool(name: str, args: dict) -> str:
             """执行工具并返回结果"""
-            nonlocal m3_context, system_content
             if name == "fetch_memory":
                 filename = args.get("filename", "")
                 keywords = args.get("keywords")
@@ -563,21 +756,33 @@ async def chat_with_agent(req: ChatRequest):
                 result = await fetch_memory(filename, keywords)
                 if result["success"]:
                     content = result["content"]
-                    m3_context += f"\n\n【来自 {filename} 的长期记忆】：\n{content}"
+                    tool_memory_blocks[tool_key(name, args)] = f"\n\n【来自 {filename} 的长期记忆】：\n{content}"
                     logger.info(f"[M3 Success] 获取到 {len(content)} 字符")
                     return content
                 else:
                     return f"未找到文件: {filename}"
+            if name == "search_memory":
+                query = args.get("query", "")
+                sys.stderr.write(f"[{datetime.now().strftime('%H:%M:%S')}] 🔧 Executing search_memory({query})\n")
+                sys.stderr.flush()
+                result = await search_memory(query, args.get("top_k"), args.get("token_budget"))
+                if result["success"]:
+                    content = result["content"]
+                    tool_memory_blocks[tool_key(name, args)] = f"\n\n【长期记忆检索：{query}】：\n{content}"
+                    logger.info(f"[M3 Search] 命中 {len(result['sources'])} 个章节: {result['sources']}")
+                    return content
+                else:
+                    return result["error"]
             return f"未知工具: {name}"
         
         try:
             # --- Thinking Mode + Tool Calls (V3.2 新特性) ---
             if use_thinking_mode and tools:
-                yield "event: status\ndata: 💭 正在思考并查阅记忆...\n\n"
+                yield sse.event("status", "💭 正在思考并查阅记忆...")
                 sys.stderr.write(f"[{datetime.now().strftime('%H:%M:%S')}] 🧠 Using Thinking Mode + Tool Calls\n")
                 sys.stderr.flush()
                 
-                from src.agents.thinking_tool_stream import stream_with_thinking_tools, ChunkType
+                from src.agents.thinking_tool_stream import stream_with_thinking_tools, ChunkType, merge_usage
                 
                 # 转换 LangChain messages 为 OpenAI 格式
                 openai_messages = []
@@ -591,36 +796,42 @@ async def chat_with_agent(req: ChatRequest):
                 
                 thinking_start = time.time()
                 try:
-                    async for chunk in stream_with_thinking_tools(
+                    async for chunk in sse.paced(stream_with_thinking_tools(
                         messages=openai_messages,
                         tools=tools,
                         tool_executor=execute_tool,
-                        max_tool_rounds=10  # 增加到10轮，支持读取所有记忆文件
-                    ):
-                        if chunk.type == ChunkType.TOOL_CALL:
+                        max_tool_rounds=5,  # search_memory 一次即可跨文件检索，无需逐个读取
+                        cancel_event=cancel_event
+                    )):
+                        if chunk is FLUSH_TICK:
+                            # 模型停顿（调用工具、思考）时发出已缓冲的内容
+                            frame = sse.flush()
+                            if frame:
+                                yield frame
+                        elif chunk.type == ChunkType.TOOL_CALL:
                             # 显示具体的工具参数，让用户知道在查阅哪个文件
                             tool_info = chunk.tool_call or {}
                             tool_name = tool_info.get("name", "unknown")
                             tool_args = tool_info.get("args", {})
                             if tool_name == "fetch_memory":
                                 filename = tool_args.get("filename", "")
-                                yield f"event: status\ndata: 📂 正在查阅记忆：{filename}\n\n"
+                                yield sse.event("status", f"📂 正在查阅记忆：{filename}")
+                            elif tool_name == "search_memory":
+                                query = tool_args.get("query", "")
+                                yield sse.event("status", f"🔍 正在检索记忆：{query}")
                             else:
-                                yield f"event: status\ndata: 🔧 {chunk.content}\n\n"
+                                yield sse.event("status", f"🔧 {chunk.content}")
+                        elif chunk.type == ChunkType.TOOL_RESULT:
+                            # 只并入最终写回对话的调用结果，被取消的提前执行不会留下内容
+                            tool_info = chunk.tool_call or {}
+                            m3_context += tool_memory_blocks.get(tool_key(tool_info.get("name", ""), tool_info.get("args", {})), "")
+                        elif chunk.type == ChunkType.USAGE:
+                            merge_usage(usage_totals, chunk.usage)
                         elif chunk.type == ChunkType.CONTENT:
                             full_content += chunk.content
-                            # 修复换行符问题：将内容中的换行符转换为SSE格式
-                            content_lines = chunk.content.split('\n')
-                            if len(content_lines) == 1:
-                                # 单行内容
-                                yield f"event: content\ndata: {chunk.content}\n\n"
-                            else:
-                                # 多行内容，每行都要加data:前缀
-                                sse_content = "event: content\n"
-                                for line in content_lines:
-                                    sse_content += f"data: {line}\n"
-                                sse_content += "\n"
-                                yield sse_content
+                            frame = sse.content(chunk.content)
+                            if frame:
+                                yield frame
                         elif chunk.type == ChunkType.ERROR:
                             # Thinking Mode 失败，回退到普通模式
                             logger.warning(f"[Thinking Mode] Error: {chunk.content}, falling back...")
@@ -639,9 +850,9 @@ async def chat_with_agent(req: ChatRequest):
                     use_thinking_mode = False
             
             # --- Fallback: 普通流式调用 (不使用 Thinking Mode) ---
-            if not use_thinking_mode or not full_content:
+            if (not use_thinking_mode or not full_content) and not cancel_event.is_set():
                 if not full_content:  # 只有在没有生成内容时才回退
-                    yield "event: status\ndata: ✨ 正在生成回复...\n\n"
+                    yield sse.event("status", "✨ 正在生成回复...")
                     sys.stderr.write(f"[{datetime.now().strftime('%H:%M:%S')}] 📝 Fallback to standard streaming\n")
                     
                     # 如果已经获取了记忆内容，注入到 system prompt
@@ -649,20 +860,45 @@ async def chat_with_agent(req: ChatRequest):
                         system_content += m3_context
                         messages[0] = SystemMessage(content=system_content)
                     
-                    async for chunk in llm.astream(messages):
+                    fallback_stream = llm.astream(messages)
+                    paced_fallback = sse.paced(fallback_stream)
+                    async for chunk in paced_fallback:
+                        if cancel_event.is_set():
+                            break
+                        if chunk is FLUSH_TICK:
+                            frame = sse.flush()
+                            if frame:
+                                yield frame
+                            continue
                         token = chunk.content
                         full_content += token
-                        yield f"event: content\ndata: {token}\n\n"
+                        frame = sse.content(token)
+                        if frame:
+                            yield frame
+                    if cancel_event.is_set():
+                        # 关闭上游 HTTP 流
+                        await paced_fallback.aclose()
+                        await fallback_stream.aclose()
+            
+            if cancel_event.is_set():
+                # 客户端已断开：不再发送元数据，也不保存这轮不完整的对话
+                record_disconnect("generation", len(full_content), req.auto_save)
+                return
+            
+            # 输出缓冲中剩余的内容
+            frame = sse.flush()
+            if frame:
+                yield frame
             
             chat_done_time = time.time()
             logger.info(f"LLM First Response Latency: {chat_done_time - start_time:.2f}s")
 
             # 2. 对话结束后，处理记忆逻辑 (L2 压缩)
-            new_summary = req.summary
+            new_summary = base_summary
             
             # 构建新历史：如果本次获取了记忆，把记忆内容也加入历史
             # 这样后续对话模型就知道已经读取过哪些记忆，避免重复调用工具
-            new_history = req.history.copy()
+            new_history = list(base_history)
             new_history.append({"role": "user", "content": req.message})
             
             # 如果有记忆内容，作为系统消息注入历史（用户不可见，但模型可见）
@@ -689,51 +925,71 @@ async def chat_with_agent(req: ChatRequest):
             # 3. 发送元数据标记位
             try:
                 end_time = time.time()
+                appended = new_history[len(base_history):]
                 metadata = {
                     "type": "metadata",
-                    "summary": new_summary,
-                    "history": new_history,
-
                     "debug": {
-                        "raw_prompt": [
-                            {"role": "system" if isinstance(m, SystemMessage) else "user" if isinstance(m, HumanMessage) else "assistant", "content": m.content} 
-                            for m in messages
-                        ],
                         "latency": {
                             "llm_chat": f"{chat_done_time - start_time:.2f}s",
                             "total": f"{end_time - start_time:.2f}s"
                         },
-                        "system_prompt": system_content,
-                        "history_count": len(req.history)
+                        "history_count": len(base_history),
+                        "context_window": window.stats(),
+                        "usage": usage_totals
                     }
                 }
+                # 完整提示词与窗口内历史等长，会话模式下只在调试时回传，否则抵消增量协议节省的流量
+                if session_state is None or req.debug:
+                    metadata["debug"]["raw_prompt"] = [
+                        {"role": "system" if isinstance(m, SystemMessage) else "user" if isinstance(m, HumanMessage) else "assistant", "content": m.content}
+                        for m in messages
+                    ]
+                    metadata["debug"]["system_prompt"] = system_content
+                if session_state is not None:
+                    # 会话模式：先提交到服务端会话（auto_save 时延迟写回云端），再只回传增量
+                    session_state = storage.append_session_messages(appended, persist=req.auto_save)
+                    metadata.update(build_session_delta(session_state, req, base_version, appended))
+                else:
+                    metadata.update(summary=new_summary, history=new_history)
                 meta_json = json.dumps(metadata, ensure_ascii=False)
-                yield f"event: metadata\ndata: {meta_json}\n\n"
+                yield sse.event("metadata", meta_json)
                 
                 # 根据 auto_save 参数决定是否自动保存
-                if req.auto_save:
-                    # 主要保存到云端
-                    from src.storage.sphere_storage import get_sphere_storage
-                    storage = get_sphere_storage()
-                    await storage.save_current_session(new_history, new_summary)
-                    logger.info(f"[Session] Auto-saved to cloud, history length: {len(new_history)}")
+                if session_state is not None:
+                    logger.info(f"[Session] Session mode v{session_state.version}, appended {len(appended)} messages (auto_save={req.auto_save})")
+                elif req.auto_save:
+                    # 主要保存到云端（后台延迟写回，不阻塞本次响应）
+                    storage.schedule_save_current_session(new_history, new_summary)
+                    logger.info(f"[Session] Auto-save scheduled, history length: {len(new_history)}")
                 else:
                     logger.info(f"[Session] auto_save=False, skipped saving")
                 
+                if usage_totals:
+                    logger.info(f"[Usage] {usage_totals}")
+                logger.info(f"[SSE] {sse.stats()}")
                 logger.info(f"--- [Stream Chat End] Total Latency: {end_time - start_time:.2f}s ---")
                 # 不在这里发送done事件，统一在finally中发送
             except Exception as me:
                 logger.error(f"Metadata generation failed: {me}")
-                yield f"event: error\ndata: {{\"error\": \"metadata_failed\"}}\n\n"
+                yield sse.event("error", json.dumps({"error": "metadata_failed"}))
                 # 不在这里发送done事件，统一在finally中发送
 
+        except asyncio.CancelledError:
+            # Starlette 检测到断开后取消响应任务
+            cancel_event.set()
+            record_disconnect("cancelled", len(full_content), req.auto_save)
+            raise
         except Exception as e:
             logger.error(f"Streaming failed: {e}", exc_info=True)
-            yield f"event: error\ndata: {{\"error\": \"streaming_failed\", \"message\": \"{str(e)}\"}}\n\n"
+            yield sse.event("error", json.dumps({"error": "streaming_failed", "message": str(e)}, ensure_ascii=False))
         finally:
-            yield "event: done\ndata: {}\n\n"
+            if not cancel_event.is_set():
+                yield sse.event("done", "{}")
 
-    return StreamingResponse(chat_generator(), media_type="text/event-stream")
+    return StreamingResponse(
+        cancel_on_disconnect(request, chat_generator(), cancel_event),
+        media_type="text/event-stream"
+    )
 
 if __name__ == "__main__":
     # 启动 Uvicorn，优先读取 HF 环境要求的端口
@@ -0,0 +1,116 @@
+# 对话历史窗口管理
+# 在 token 预算内保留最近几轮原文，压缩较早的消息和已检索的长期记忆，必要时按固定块丢弃最早的消息
+
+import logging
+import re
+from dataclasses import dataclass, field
+
+from src.utils.token_estimator import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+MEMORY_INJECTION_PREFIX = "[已检索的长期记忆]"
+# 记忆注入中的来源标记：【来自 职业规划.md 的长期记忆】 / 【长期记忆检索：跑步】
+_MEMORY_SOURCE_PATTERN = re.compile(r"【来自 (.+?) 的长期记忆】|【长期记忆检索：(.+?)】")
+
+
+@dataclass
+class HistoryWindow:
+    """窗口化后的历史及统计"""
+    history: list = field(default_factory=list)
+    tokens_before: int = 0
+    tokens_after: int = 0
+    compressed: int = 0   # 被截断/压缩的消息数
+    dropped: int = 0      # 被丢弃的消息数
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def stats(self) -> dict:
+        return {
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": self.tokens_saved,
+            "compressed": self.compressed,
+            "dropped": self.dropped,
+            "kept": len(self.history),
+        }
+
+
+def is_memory_injection(message: dict) -> bool:
+    return message.get("role") == "system" and str(message.get("content", "")).startswith(MEMORY_INJECTION_PREFIX)
+
+
+def _message_tokens(message: dict) -> int:
+    return estimate_tokens(str(message.get("content", ""))) + 4  # 角色等格式开销
+
+
+def _compress(message: dict, max_tokens: int) -> dict:
+    """压缩单条较早的消息：记忆注入只保留来源，普通消息截断"""
+    content = str(message.get("content", ""))
+    if is_memory_injection(message):
+        sources = [a or b for a, b in _MEMORY_SOURCE_PATTERN.findall(content)]
+        summary = "、".join(dict.fromkeys(sources)) or "若干记忆"
+        return {**message, "content": f"{MEMORY_INJECTION_PREFIX}（较早检索过：{summary}，内容已省略，如需细节请重新检索）"}
+    if estimate_tokens(content) <= max_tokens:
+        return message
+    return {**message, "content": truncate_to_tokens(content, max_tokens) + "…（已截断）"}
+
+
+def _block_cut(messages: list, excess: int, block: int) -> int:
+    """
+    返回需要丢弃的消息数：只在固定的 token 块边界处切（第 k 个块边界 = 累计 k*block token 处的消息），
+    取能消除 excess 的最小 k。较早消息的压缩结果是确定的，边界位置不随新消息变化，
+    因此切点会保持不变，直到新增内容再超出一整块才前移，提示前缀可以持续命中缓存。
+    """
+    needed = -(-excess // block) * block  # 向上取整到块大小
+    position = 0
+    for i, message in enumerate(messages):
+        if position >= needed:
+            return i
+        position += _message_tokens(message)
+    return len(messages)
+
+
+def fit_history(history: list, budget: int, keep_recent: int, old_message_tokens: int, drop_block: int = 0) -> HistoryWindow:
+    """
+    把历史裁剪到 token 预算以内。
+
+    1. 最近 keep_recent 条消息保持原文
+    2. 更早的消息：记忆注入压缩为来源列表，普通消息截断到 old_message_tokens
+    3. 仍超出预算时按 drop_block 大小的固定块从最早的消息开始丢弃（最近的消息不丢），
+       切点在多轮之间保持稳定；drop_block <= 0 时取预算的 1/4
+    budget <= 0 表示不限制。
+    """
+    window = HistoryWindow(tokens_before=sum(_message_tokens(m) for m in history))
+    if budget <= 0 or window.tokens_before <= budget:
+        window.history = list(history)
+        window.tokens_after = window.tokens_before
+        return window
+
+    split = max(len(history) - keep_recent, 0)
+    older, recent = history[:split], history[split:]
+
+    compressed_older = []
+    for message in older:
+        compressed = _compress(message, old_message_tokens)
+        if compressed is not message:
+            window.compressed += 1
+        compressed_older.append(compressed)
+
+    total = sum(_message_tokens(m) for m in compressed_older + recent)
+    if total > budget:
+        block = drop_block if drop_block > 0 else max(budget // 4, 1)
+        cut = _block_cut(compressed_older, total - budget, block)
+        # 不以孤立的 AI 回复或记忆注入开头
+        while cut < len(compressed_older) and compressed_older[cut].get("role") != "user":
+            cut += 1
+        total -= sum(_message_tokens(m) for m in compressed_older[:cut])
+        window.dropped = cut
+        compressed_older = compressed_older[cut:]
+
+    window.history = compressed_older + recent
+    window.tokens_after = total
+    logger.info(f"[ContextWindow] {window.stats()}")
+    return window
@@ -1,14 +1,18 @@
 # 每日归档任务
 # 凌晨定时执行或手动触发
 
+import asyncio
 import logging
 import json
 import os
+import time
 from src.utils.date_helper import get_current_logical_date, format_logical_date
 from typing import Optional
 from src.storage.sphere_storage import get_sphere_storage
 from src.utils.config import settings
-from src.agents.memory_patcher import detect_memory_updates, apply_memory_patch
+from src.agents.memory_patcher import detect_memory_updates, apply_memory_patches, normalize_updates
+from src.agents.incremental_archive import get_incremental_archiver
+from src.agents.history_summarizer import condense_history, get_summary_stats
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
 
@@ -23,10 +27,20 @@ llm = ChatOpenAI(
 )
 
 
+async def _timed(stage: str, coro, timings: dict):
+    """执行一个阶段并记录耗时（秒）"""
+    start = time.time()
+    try:
+        return await coro
+    finally:
+        timings[stage] = round(time.time() - start, 2)
+
+
 async def trigger_daily_archive(
     session_history: list[dict],
     current_m2: str = "",
-    target_date: Optional[str] = None
+    target_date: Optional[str] = None,
+    pending: Optional[dict] = None
 ) -> dict:
     """
     手动触发每日归档任务。
@@ -36,10 +50,15 @@ async def trigger_daily_archive(
     3. 提取关键信息更新长期记忆
     4. 归档原始对话
     
+    长对话先经 map-reduce 压缩为 history_text，1→2 与 3 共用它并发执行；
+    模型调用全部使用异步接口，不阻塞事件循环。
+    
     Args:
         session_history: 当日对话历史 [{"role": "user/assistant", "content": "..."}]
         current_m2: 当前的 M2 前情提要
         target_date: 归档日期 (ISO格式)，默认为今天
+        pending: 日内增量整理的结果（见 IncrementalArchiver.prepare_nightly），
+            提供时直接合并各段摘要与已检测的 M3 变更，不再处理整天的对话
     
     Returns:
         dict: 归档结果
@@ -48,17 +67,23 @@ async def trigger_daily_archive(
     logger.info(f"[DailyArchive] 开始执行归档任务: {today}...")
     
     storage = get_sphere_storage()
+    total_start = time.time()
+    stage_timings = {}
     
     # ===== 1. 生成会话摘要 =====
-    history_text = "\n".join([
-        f"{'用户' if m['role'] == 'user' else 'AI'}: {m['content']}"
-        for m in session_history  # 使用当天所有对话
-    ])
+    # 当天所有对话；超出预算时先分块并发摘要再合并（块摘要有缓存，重跑时复用）
+    if pending:
+        history_text = "\n\n".join(
+            f"【第 {i} 段：消息 {d['start'] + 1}-{d['end']}】\n{d['digest']}"
+            for i, d in enumerate(pending["digests"], 1)
+        )
+    else:
+        history_text = await _timed("condense", condense_history(session_history), stage_timings)
     
     summary_prompt = f"""
 请作为用户的“数字大脑”，对今天的对话进行深度消化与反思。
 
-### 原始对话记录：
+### 对话记录（过长时为分段要点）：
 {history_text}
 
 ### 任务：
@@ -70,19 +95,23 @@ async def trigger_daily_archive(
 请以第一人称（如“我们今天讨论了...”）生成一份具有反思感的精炼摘要。
 """
     
-    try:
-        response = llm.invoke([
-            SystemMessage(content="你是一位精准的会话归档员。"),
-            HumanMessage(content=summary_prompt)
-        ])
-        session_summary = response.content.strip()
-    except Exception as e:
-        logger.error(f"生成摘要失败: {e}")
-        session_summary = f"[归档失败] {today} 的对话"
-    
-    logger.info(f"[DailyArchive] 会话摘要: {session_summary[:100]}...")
-    
-    m2_prompt = f"""
+    async def summarize() -> str:
+        try:
+            response = await llm.ainvoke([
+                SystemMessage(content="你是一位精准的会话归档员。"),
+                HumanMessage(content=summary_prompt)
+            ])
+            session_summary = response.content.strip()
+        except Exception as e:
+            logger.error(f"生成摘要失败: {e}")
+            session_summary = f"[归档失败] {today} 的对话"
+        
+        logger.info(f"[DailyArchive] 会话摘要: {session_summary[:100]}...")
+        return session_summary
+    
+    # ===== 2. 更新 M2 前情提要（依赖会话摘要） =====
+    async def consolidate_m2(session_summary: str) -> str:
+        m2_prompt = f"""
 请将旧的背景记忆与今天的深度反思进行“生物学式”的巩固与融合。
 
 ### 旧的背景记忆：
@@ -99,33 +128,52 @@ async def trigger_daily_archive(
 
 生成的更新版前情提要应简洁、有力且富有洞察力。
 """
+        
+        try:
+            response = await llm.ainvoke([
+                SystemMessage(content="你是一位精准的叙事压缩专家。"),
+                HumanMessage(content=m2_prompt)
+            ])
+            return response.content.strip()
+        except Exception as e:
+            logger.error(f"更新M2失败: {e}")
+            return current_m2
     
-    try:
-        response = llm.invoke([
-            SystemMessage(content="你是一位精准的叙事压缩专家。"),
-            HumanMessage(content=m2_prompt)
-        ])
-        new_m2 = response.content.strip()
-    except Exception as e:
-        logger.error(f"更新M2失败: {e}")
-        new_m2 = current_m2
-    
-    
-    # ===== 3. 自动 Patch M3 =====
-    patch_results = []
-    try:
-        updates = await detect_memory_updates(session_history)
-        if updates:
-            logger.info(f"[DailyArchive] 检测到 {len(updates)} 个 M3 变更，开始应用补丁...")
-            for update in updates:
-                success = await apply_memory_patch(update["filename"], update["change_instruction"])
-                patch_results.append({
-                    "filename": update["filename"],
-                    "instruction": update["change_instruction"],
-                    "success": success
-                })
-    except Exception as e:
-        logger.error(f"[DailyArchive] M3 Patch 失败: {e}")
+    async def summary_chain() -> tuple[str, str]:
+        session_summary = await _timed("summary", summarize(), stage_timings)
+        new_m2 = await _timed("m2", consolidate_m2(session_summary), stage_timings)
+        return session_summary, new_m2
+    
+    # ===== 3. 自动 Patch M3（只依赖对话记录，与 1→2 并发） =====
+    # 同一文件的多条指令合并为一次重写，不同文件在并发上限内同时处理
+    async def patch_chain() -> tuple[list, dict]:
+        patch_results = []
+        patch_summary = {}
+        try:
+            if pending:
+                updates = normalize_updates(pending.get("updates"))
+            else:
+                updates = await _timed("detect", detect_memory_updates(session_history, history_text), stage_timings)
+            if updates:
+                logger.info(f"[DailyArchive] 检测到 {len(updates)} 个 M3 变更，开始应用补丁...")
+                file_results, patch_summary = await _timed("patch", apply_memory_patches(
+                    updates, settings.ARCHIVE_PATCH_CONCURRENCY, settings.ARCHIVE_PATCH_RETRIES
+                ), stage_timings)
+                success_by_file = {r["filename"]: r["success"] for r in file_results}
+                patch_results = [
+                    {
+                        "filename": update["filename"],
+                        "instruction": update["change_instruction"],
+                        "success": success_by_file.get(update["filename"], False)
+                    }
+                    for update in updates
+                ]
+                patch_summary["by_file"] = file_results
+        except Exception as e:
+            logger.error(f"[DailyArchive] M3 Patch 失败: {e}")
+        return patch_results, patch_summary
+    
+    (session_summary, new_m2), (patch_results, patch_summary) = await asyncio.gather(summary_chain(), patch_chain())
 
     # ===== 4. 统一归档到会话目录 =====
     # 创建统一的会话归档文件，包含摘要、M2和完整对话
@@ -162,14 +210,16 @@ async def trigger_daily_archive(
 """
     
     archive_filename = f"会话归档_{today}.md"
-    await storage.save_session_archive(archive_filename, archive_content)
+    await _timed("archive_write", storage.save_session_archive(archive_filename, archive_content), stage_timings)
     
     logger.info(f"[DailyArchive] 完成统一归档: {archive_filename}")
     
     # ===== 5. 更新当前session的摘要，但保持对话历史清空 =====
     # 将新的M2摘要保存到当前session，这样用户回到应用时能看到更新的摘要
-    await storage.save_current_session([], new_m2)  # 空历史，但保留新摘要
+    await _timed("session_reset", storage.save_current_session([], new_m2), stage_timings)  # 空历史，但保留新摘要
     logger.info(f"[DailyArchive] 已更新当前session摘要: {len(new_m2)} 字符")
+    stage_timings["total"] = round(time.time() - total_start, 2)
+    logger.info(f"[DailyArchive] 各阶段耗时: {stage_timings}")
     
     return {
         "success": True,
@@ -177,6 +227,31 @@ async def trigger_daily_archive(
         "new_m2": new_m2,
         "archive_file": archive_filename,
         "patch_results": patch_results,
-        "m1_cleared": True
+        "patch_summary": patch_summary,
+        "m1_cleared": True,
+        "timings": stage_timings,
+        "history_condense": get_summary_stats(),
+        "incremental_deltas": pending["deltas"] if pending else 0
     }
 
+
+async def archive_session(
+    session_history: list[dict],
+    current_m2: str = "",
+    target_date: Optional[str] = None
+) -> dict:
+    """
+    归档入口（凌晨定时任务与手动触发共用）。
+    
+    启用日内增量整理时先补齐尾部未整理的消息、合并已有增量，
+    归档完成后删除该日期的增量状态，避免手动归档后留下过期的 consolidation 文件。
+    """
+    date_str = target_date if target_date else format_logical_date(get_current_logical_date())
+    if not settings.INCREMENTAL_ARCHIVE_ENABLED:
+        return await trigger_daily_archive(session_history, current_m2, date_str)
+    
+    archiver = get_incremental_archiver()
+    pending = await archiver.prepare_nightly(date_str, session_history)
+    result = await trigger_daily_archive(session_history, current_m2, date_str, pending)
+    await archiver.finish_nightly(date_str)
+    return result
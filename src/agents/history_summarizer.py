@@ -0,0 +1,192 @@
+# 长对话的分层（map-reduce）摘要
+# 按 token 预算把当天对话切块，并发摘要各块再合并；块摘要按内容哈希缓存（内存 + 独立的磁盘缓存），
+# 重跑归档或日内预归档时只需摘要新增的块
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import SystemMessage, HumanMessage
+
+from src.storage.cache import SingleFlight
+from src.storage.disk_cache import get_summary_cache, get_summary_cache_stats
+from src.utils.config import settings
+from src.utils.token_estimator import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+llm = ChatOpenAI(
+    model="deepseek-chat",
+    api_key=settings.DEEPSEEK_API_KEY or "EMPTY",
+    base_url=settings.DEEPSEEK_BASE_URL,
+    temperature=0.3
+)
+
+
+# 常量定义
+class SummarizerConfig:
+    PROMPT_VERSION = "v1"           # 修改摘要 Prompt 时递增，使旧缓存失效
+    DISK_NAMESPACE = "chunk_summary"
+    MEMORY_CACHE_SIZE = 512
+    MAX_REDUCE_DEPTH = 3
+
+
+_CHUNK_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_single_flight = SingleFlight()
+
+# 累计统计（供归档结果和 /health 展示）
+_SUMMARY_STATS = {"chunks": 0, "cache_hit": 0, "disk_hit": 0, "summarized": 0, "failed": 0, "reduce_rounds": 0}
+
+
+def format_history(session_history: list[dict]) -> list[str]:
+    """每条消息一行：'用户: ...' / 'AI: ...'"""
+    return [
+        f"{'用户' if m['role'] == 'user' else 'AI'}: {m['content']}"
+        for m in session_history
+    ]
+
+
+def chunk_lines(lines: list[str], max_tokens: int) -> list[str]:
+    """
+    按消息边界贪心切块，每块估算不超过 max_tokens（超长的单条消息截断）。
+    从头开始切分，对话只在末尾增长时前面的块保持不变，可命中缓存。
+    """
+    chunks = []
+    current: list[str] = []
+    used = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if tokens > max_tokens:
+            line = truncate_to_tokens(line, max_tokens)
+            tokens = max_tokens
+        if current and used + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, used = [], 0
+        current.append(line)
+        used += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _cache_key(text: str) -> str:
+    return hashlib.sha256(f"{SummarizerConfig.PROMPT_VERSION}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _remember(key: str, summary: str):
+    _CHUNK_CACHE[key] = summary
+    _CHUNK_CACHE.move_to_end(key)
+    while len(_CHUNK_CACHE) > SummarizerConfig.MEMORY_CACHE_SIZE:
+        _CHUNK_CACHE.popitem(last=False)
+
+
+async def _llm_summarize_chunk(text: str) -> Optional[str]:
+    prompt = f"""
+以下是用户与 AI 某天对话中的一段（可能是对话原文，也可能是更早几段的摘要）。
+请把它提炼为要点清单，供之后生成当日总结和更新长期记忆使用。
+
+### 对话片段：
+{text}
+
+### 要求：
+1. 按时间顺序列出讨论要点，每条一行（- 开头）。
+2. **保留高熵细节**：决策及其理由、用户的偏好与禁忌、具体的链接、ID、参数、人名、书名。
+3. 保留用户的情绪状态、明确的待办和“以后想做”的想法。
+4. 省略寒暄和重复内容，不要添加原文没有的信息。
+5. 总长度不超过 {settings.ARCHIVE_CHUNK_SUMMARY_TOKENS} token。
+"""
+    try:
+        response = await llm.ainvoke([
+            SystemMessage(content="你是一位精准的会话归档员。"),
+            HumanMessage(content=prompt)
+        ])
+        summary = response.content.strip()
+        return summary or None
+    except Exception as e:
+        logger.error(f"[HistorySummarizer] 块摘要失败: {e}")
+        return None
+
+
+async def summarize_chunk(text: str) -> str:
+    """摘要单个块：内存缓存 → 磁盘缓存 → 模型；失败时退化为截断原文（不缓存）"""
+    _SUMMARY_STATS["chunks"] += 1
+    key = _cache_key(text)
+    if key in _CHUNK_CACHE:
+        _CHUNK_CACHE.move_to_end(key)
+        _SUMMARY_STATS["cache_hit"] += 1
+        return _CHUNK_CACHE[key]
+
+    async def load() -> Optional[str]:
+        disk = get_summary_cache()
+        if disk is not None:
+            try:
+                entry = await asyncio.to_thread(disk.get, SummarizerConfig.DISK_NAMESPACE, key)
+            except Exception as e:
+                logger.warning(f"[HistorySummarizer] 读取磁盘缓存失败: {e}")
+                entry = None
+            if entry is not None:
+                _SUMMARY_STATS["disk_hit"] += 1
+                _remember(key, entry.content)
+                return entry.content
+
+        summary = await _llm_summarize_chunk(text)
+        if summary is None:
+            _SUMMARY_STATS["failed"] += 1
+            return None
+        _SUMMARY_STATS["summarized"] += 1
+        _remember(key, summary)
+        if disk is not None:
+            try:
+                await asyncio.to_thread(disk.put, SummarizerConfig.DISK_NAMESPACE, key, summary, None, None)
+            except Exception as e:
+                logger.warning(f"[HistorySummarizer] 写入磁盘缓存失败: {e}")
+        return summary
+
+    # 同一块的并发请求（如归档摘要与 M3 检测同时进行）只调用一次模型
+    summary = await _single_flight.do(key, load)
+    if summary is None:
+        return truncate_to_tokens(text, settings.ARCHIVE_CHUNK_SUMMARY_TOKENS)
+    return summary
+
+
+async def condense_history(session_history: list[dict]) -> str:
+    """
+    返回可以放进单个 Prompt 的当日对话文本。
+
+    - 全文不超过 ARCHIVE_HISTORY_TOKEN_BUDGET 时原样返回
+    - 否则切块并发摘要（map），拼接后仍超预算则对摘要再切块摘要（reduce），最多 MAX_REDUCE_DEPTH 轮
+    """
+    lines = format_history(session_history)
+    text = "\n".join(lines)
+    budget = settings.ARCHIVE_HISTORY_TOKEN_BUDGET
+    if estimate_tokens(text) <= budget:
+        return text
+
+    semaphore = asyncio.Semaphore(max(settings.ARCHIVE_SUMMARY_CONCURRENCY, 1))
+
+    async def run(chunk: str) -> str:
+        async with semaphore:
+            return await summarize_chunk(chunk)
+
+    for depth in range(SummarizerConfig.MAX_REDUCE_DEPTH):
+        chunks = chunk_lines(lines, settings.ARCHIVE_CHUNK_TOKENS)
+        summaries = await asyncio.gather(*[run(chunk) for chunk in chunks])
+        _SUMMARY_STATS["reduce_rounds"] += 1
+        text = "\n\n".join(f"【第 {i} 段】\n{summary}" for i, summary in enumerate(summaries, 1))
+        logger.info(f"[HistorySummarizer] 第 {depth + 1} 轮: {len(chunks)} 块 -> {estimate_tokens(text)} token")
+        if estimate_tokens(text) <= budget or len(chunks) == 1:
+            break
+        lines = list(summaries)
+    return truncate_to_tokens(text, budget)
+
+
+def get_summary_stats() -> dict:
+    return {
+        **_SUMMARY_STATS,
+        "memory_cached": len(_CHUNK_CACHE),
+        "single_flight": _single_flight.stats(),
+        "disk": get_summary_cache_stats()
+    }
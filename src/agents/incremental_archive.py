@@ -0,0 +1,205 @@
+# 日内增量整理
+# 会话每新增一批消息或空闲一段时间后，在后台只摘要新增的对话并检测 M3 变更，
+# 结果作为增量（delta）保存到云端；凌晨归档只需合并这些小增量，耗时不再随当天对话长度增长
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from src.agents.history_summarizer import condense_history, summarize_chunk
+from src.agents.memory_patcher import detect_memory_updates, normalize_updates
+from src.storage.sphere_storage import get_sphere_storage
+from src.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _history_hash(history: list) -> str:
+    return hashlib.md5(json.dumps(history, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _empty_state(date_str: str) -> dict:
+    return {"date": date_str, "processed": 0, "prefix_hash": _history_hash([]), "deltas": []}
+
+
+class IncrementalArchiver:
+    """
+    日内增量整理器（每个逻辑日期一份状态）。
+
+    - notify(): 会话变更回调；新增消息达到 every_messages 时立即整理，否则空闲 idle_seconds 后整理
+    - consolidate(): 只处理 processed 之后的消息，追加一个 delta（摘要 + M3 变更指令）并写回云端
+    - 历史被改写（删除/清空）时丢弃已有增量，从头开始
+    - prepare_nightly() / finish_nightly(): 供凌晨归档补齐尾部并在合并后清理状态
+    """
+
+    def __init__(self, every_messages: int, idle_seconds: float):
+        self.every_messages = every_messages
+        self.idle_seconds = idle_seconds
+        self._states: dict[str, dict] = {}
+        self._latest: dict[str, list] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+        self._running: dict[str, asyncio.Task] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._stats = {"runs": 0, "messages_processed": 0, "updates_detected": 0, "resets": 0, "failed": 0, "last_run_seconds": 0.0}
+
+    def _lock_for(self, date_str: str) -> asyncio.Lock:
+        if date_str not in self._locks:
+            self._locks[date_str] = asyncio.Lock()
+        return self._locks[date_str]
+
+    def notify(self, date_str: str, history: list):
+        """会话变更回调（同步、不阻塞调用方）"""
+        self._latest[date_str] = history
+        timer = self._timers.pop(date_str, None)
+        if timer is not None:
+            timer.cancel()
+        if not history:
+            return
+        processed = self._states.get(date_str, {}).get("processed", 0)
+        if len(history) - processed >= self.every_messages:
+            self._start(date_str)
+        else:
+            self._timers[date_str] = asyncio.create_task(self._idle(date_str))
+
+    def _start(self, date_str: str):
+        task = self._running.get(date_str)
+        if task is None or task.done():
+            self._running[date_str] = asyncio.create_task(self._run(date_str))
+
+    async def _idle(self, date_str: str):
+        try:
+            await asyncio.sleep(self.idle_seconds)
+        except asyncio.CancelledError:
+            return
+        self._timers.pop(date_str, None)
+        self._start(date_str)
+
+    async def _run(self, date_str: str):
+        try:
+            await self.consolidate(date_str)
+        except Exception as e:
+            self._stats["failed"] += 1
+            logger.error(f"[IncrementalArchive] 增量整理失败 {date_str}: {e}", exc_info=True)
+
+    async def _load(self, date_str: str) -> dict:
+        state = self._states.get(date_str)
+        if state is None:
+            state = await get_sphere_storage().load_consolidation_state(date_str) or _empty_state(date_str)
+            self._states[date_str] = state
+        return state
+
+    async def consolidate(self, date_str: str, history: Optional[list] = None) -> dict:
+        """整理 processed 之后的新消息，返回最新状态"""
+        async with self._lock_for(date_str):
+            storage = get_sphere_storage()
+            state = await self._load(date_str)
+            if history is None:
+                history = self._latest.get(date_str)
+            if history is None:
+                return state
+
+            processed = state["processed"]
+            if processed > len(history) or _history_hash(history[:processed]) != state["prefix_hash"]:
+                logger.info(f"[IncrementalArchive] {date_str} 的历史已被改写，丢弃 {len(state['deltas'])} 个增量")
+                self._stats["resets"] += 1
+                state = self._states[date_str] = _empty_state(date_str)
+                processed = 0
+                if not history:
+                    await storage.delete_consolidation_state(date_str)
+                    return state
+
+            new_messages = history[processed:]
+            if not new_messages:
+                return state
+
+            start = time.time()
+            history_text = await condense_history(new_messages)
+            digest, updates = await asyncio.gather(
+                summarize_chunk(history_text),
+                detect_memory_updates(new_messages, history_text)
+            )
+            state["deltas"].append({
+                "start": processed,
+                "end": len(history),
+                "digest": digest,
+                "updates": updates,
+                "created_at": datetime.now().isoformat()
+            })
+            state["processed"] = len(history)
+            state["prefix_hash"] = _history_hash(history)
+            await storage.save_consolidation_state(date_str, state)
+
+            self._stats["runs"] += 1
+            self._stats["messages_processed"] += len(new_messages)
+            self._stats["updates_detected"] += len(updates)
+            self._stats["last_run_seconds"] = round(time.time() - start, 2)
+            logger.info(
+                f"[IncrementalArchive] {date_str} 整理消息 {processed}-{len(history)}: "
+                f"{len(updates)} 个 M3 变更, 耗时 {self._stats['last_run_seconds']}s"
+            )
+            return state
+
+    async def prepare_nightly(self, date_str: str, history: list) -> Optional[dict]:
+        """
+        凌晨归档前补齐尾部未整理的消息，返回供归档合并的增量
+        {"digests": [...], "updates": [...], "deltas": n}；没有可用增量时返回 None。
+        """
+        timer = self._timers.pop(date_str, None)
+        if timer is not None:
+            timer.cancel()
+        running = self._running.get(date_str)
+        if running is not None:
+            await running
+        state = await self.consolidate(date_str, history)
+        if not state["deltas"] or state["processed"] != len(history):
+            return None
+        return {
+            "digests": [
+                {"start": d["start"], "end": d["end"], "digest": d["digest"]} for d in state["deltas"]
+            ],
+            "updates": normalize_updates([u for d in state["deltas"] for u in d.get("updates") or []]),
+            "deltas": len(state["deltas"])
+        }
+
+    async def finish_nightly(self, date_str: str):
+        """归档合并完成后清理该日期的增量状态"""
+        async with self._lock_for(date_str):
+            self._states.pop(date_str, None)
+            self._latest.pop(date_str, None)
+            await get_sphere_storage().delete_consolidation_state(date_str)
+
+    def stop(self):
+        """取消空闲计时（未整理的消息会在凌晨归档时补齐）"""
+        for task in list(self._timers.values()) + list(self._running.values()):
+            task.cancel()
+        self._timers.clear()
+        self._running.clear()
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "pending_dates": {d: len(s["deltas"]) for d, s in self._states.items()},
+            "idle_timers": len(self._timers)
+        }
+
+
+# 全局单例
+_incremental_archiver: Optional[IncrementalArchiver] = None
+
+def get_incremental_archiver() -> IncrementalArchiver:
+    """获取增量整理器单例"""
+    global _incremental_archiver
+    if _incremental_archiver is None:
+        _incremental_archiver = IncrementalArchiver(
+            settings.INCREMENTAL_ARCHIVE_MESSAGES, settings.INCREMENTAL_ARCHIVE_IDLE_SECONDS
+        )
+    return _incremental_archiver
+
+
+def start_incremental_archive():
+    """把增量整理器挂到会话变更通知上（幂等）"""
+    get_sphere_storage().add_session_listener(get_incremental_archiver().notify)
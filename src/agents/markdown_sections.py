@@ -0,0 +1,198 @@
+# Markdown 章节树与结构化编辑
+# 把记忆文件解析为按标题嵌套的章节树，按标题路径应用 append / replace / add_section 操作，
+# 未修改的部分逐字保留，模型只需输出与改动成正比的操作而不是整篇文档
+
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+
+PATH_SEPARATOR = ">"
+
+
+@dataclass
+class SectionNode:
+    level: int                       # 0 为文档根节点
+    title: str
+    heading_line: Optional[str]      # 原始标题行，根节点为 None
+    body: list = field(default_factory=list)
+    children: list = field(default_factory=list)
+
+
+class EditError(ValueError):
+    """编辑操作无法应用（找不到章节或原文）"""
+
+
+def parse_sections(content: str) -> SectionNode:
+    """解析为章节树（代码块中的 # 不视为标题），render_sections 可逐字还原"""
+    root = SectionNode(0, "", None)
+    stack = [root]
+    in_fence = False
+    for line in content.split("\n"):
+        if _FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING_PATTERN.match(line)
+        if match:
+            level = len(match.group(1))
+            node = SectionNode(level, match.group(2).strip(), line)
+            while stack[-1].level >= level:
+                stack.pop()
+            stack[-1].children.append(node)
+            stack.append(node)
+        else:
+            stack[-1].body.append(line)
+    return root
+
+
+def _render_lines(node: SectionNode, lines: list):
+    if node.heading_line is not None:
+        lines.append(node.heading_line)
+    lines.extend(node.body)
+    for child in node.children:
+        _render_lines(child, lines)
+
+
+def render_sections(root: SectionNode) -> str:
+    lines: list[str] = []
+    _render_lines(root, lines)
+    return "\n".join(lines)
+
+
+def outline(root: SectionNode) -> list[str]:
+    """列出全部章节路径（如 "职业规划 > 目标"），用于提示模型可用的地址"""
+    paths = []
+
+    def walk(node: SectionNode, prefix: list):
+        for child in node.children:
+            path = prefix + [child.title]
+            paths.append(f" {PATH_SEPARATOR} ".join(path))
+            walk(child, path)
+
+    walk(root, [])
+    return paths
+
+
+def _normalize(title: str) -> str:
+    return title.strip().lstrip("#").strip()
+
+
+def find_section(root: SectionNode, path: str) -> Optional[SectionNode]:
+    """
+    按标题路径查找章节；路径可省略开头的层级（如省略一级标题），空路径返回根。
+    多个章节同样匹配（如 "目标" 同时出现在两个 ## 下）时抛出 EditError，而不是猜一个。
+    """
+    wanted = [_normalize(p) for p in path.split(PATH_SEPARATOR) if _normalize(p)]
+    if not wanted:
+        return root
+    matches = []
+
+    def walk(node: SectionNode, prefix: list):
+        for child in node.children:
+            titles = prefix + [_normalize(child.title)]
+            if titles[-len(wanted):] == wanted:
+                matches.append((len(titles), child))
+            walk(child, titles)
+
+    walk(root, [])
+    if not matches:
+        return None
+    # 优先完整路径匹配（层级最少者）
+    depth = min(d for d, _ in matches)
+    best = [node for d, node in matches if d == depth]
+    if len(best) > 1:
+        raise EditError(f"章节路径不唯一: {path}")
+    return best[0]
+
+
+def _content_lines(text: str) -> list[str]:
+    return text.strip("\n").split("\n") if text and text.strip() else []
+
+
+def _insert_at_body_end(node: SectionNode, lines: list[str]):
+    """插入到章节正文末尾、尾部空行之前，保持原有的段落间距"""
+    end = len(node.body)
+    while end > 0 and not node.body[end - 1].strip():
+        end -= 1
+    node.body[end:end] = lines
+
+
+def _last_node(node: SectionNode) -> SectionNode:
+    while node.children:
+        node = node.children[-1]
+    return node
+
+
+def _append(root: SectionNode, op: dict):
+    section = find_section(root, op.get("path", ""))
+    if section is None:
+        raise EditError(f"找不到章节: {op.get('path')}")
+    lines = _content_lines(op.get("content", ""))
+    if not lines:
+        raise EditError("append 缺少 content")
+    _insert_at_body_end(section, lines)
+
+
+def _replace(root: SectionNode, op: dict):
+    section = find_section(root, op.get("path", ""))
+    if section is None:
+        raise EditError(f"找不到章节: {op.get('path')}")
+    old = (op.get("old") or "").strip()
+    if not old:
+        raise EditError("replace 缺少 old")
+    for i, line in enumerate(section.body):
+        if old in line:
+            section.body[i:i + 1] = _content_lines(op.get("new", ""))
+            return
+    raise EditError(f"章节 {op.get('path')} 中找不到: {old[:40]}")
+
+
+def _add_section(root: SectionNode, op: dict):
+    heading = _normalize(op.get("heading", ""))
+    if not heading:
+        raise EditError("add_section 缺少 heading")
+    parent = find_section(root, op.get("path", ""))
+    if parent is None:
+        raise EditError(f"找不到父章节: {op.get('path')}")
+    # 顶层新增时挂在唯一的一级标题下（记忆文件通常以 # 文件名 开头）
+    if parent is root and len(root.children) == 1 and root.children[0].level == 1:
+        parent = root.children[0]
+
+    existing = next((c for c in parent.children if _normalize(c.title) == heading), None)
+    if existing is not None:
+        _append(root, {"path": f"{op.get('path', '')} {PATH_SEPARATOR} {heading}", "content": op.get("content", "")})
+        return
+
+    last = _last_node(parent)
+    if last.heading_line is not None or last.body:
+        if not last.body or last.body[-1].strip():
+            last.body.append("")
+    level = min(max(parent.level + 1, 2), 6)
+    node = SectionNode(level, heading, f"{'#' * level} {heading}", _content_lines(op.get("content", "")) + [""])
+    parent.children.append(node)
+
+
+_OPERATIONS = {
+    "append": _append,
+    "replace": _replace,
+    "add_section": _add_section,
+}
+
+
+def apply_edits(content: str, operations: list[dict]) -> str:
+    """
+    对文档应用一组结构化编辑操作，任一操作失败抛出 EditError（文档保持不变）。
+
+    支持的操作：
+    - {"op": "append", "path": "职业规划 > 目标", "content": "- 新条目"}
+    - {"op": "replace", "path": "...", "old": "原有行中的文字", "new": "替换后的整行"}
+    - {"op": "add_section", "path": "父章节（顶层留空）", "heading": "新章节", "content": "..."}
+    """
+    root = parse_sections(content)
+    for op in operations:
+        handler = _OPERATIONS.get(op.get("op", "")) if isinstance(op, dict) else None
+        if handler is None:
+            raise EditError(f"未知操作: {op}")
+        handler(root, op)
+    return render_sections(root)
@@ -0,0 +1,220 @@
+# 长期记忆倒排索引
+# 按 ## 章节切分 M3 文件，使用 BM25 排序；中文按字二元组切词，英文/数字按单词切词
+
+import hashlib
+import logging
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from src.agents.markdown_sections import SectionNode, parse_sections
+
+logger = logging.getLogger(__name__)
+
+# 常量定义
+class IndexConfig:
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+
+
+# 连续的 CJK 字符，或英文/数字单词（允许 . _ - 连接，如 v3.2、deepseek-chat）
+_TOKEN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:[._-][a-z0-9]+)*")
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+def tokenize(text: str) -> list[str]:
+    """CJK 感知分词：中文连续片段切成字二元组（单字保留），其余按单词"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        run = match.group()
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def split_sections(content: str) -> list[tuple[str, str]]:
+    """
+    按标题切分文档，返回 [(标题路径, 章节文本)]，每个标题一个章节（不含子章节）。
+    标题路径形如 "职业规划 > 目标 > 短期"；与结构化编辑共用 parse_sections，代码块中的 # 不视为标题。
+    """
+    sections = []
+
+    def walk(node: SectionNode, prefix: list[str]):
+        path = prefix + [node.title] if node.heading_line is not None else prefix
+        lines = ([node.heading_line] if node.heading_line is not None else []) + node.body
+        text = "\n".join(lines).strip()
+        if text:
+            sections.append((" > ".join(path), text))
+        for child in node.children:
+            walk(child, path)
+
+    walk(parse_sections(content), [])
+    return sections
+
+
+@dataclass
+class Section:
+    filename: str
+    heading: str
+    text: str
+    length: int
+    tf: Counter
+
+
+@dataclass
+class SearchHit:
+    filename: str
+    heading: str
+    text: str
+    score: float
+
+
+@dataclass
+class FileInfo:
+    content_hash: str
+    etag: Optional[str] = None   # 索引时对应的 WebDAV ETag，用于发现 Obsidian 中的外部修改
+    section_ids: list = field(default_factory=list)
+
+
+class MemoryIndex:
+    """
+    进程内 BM25 倒排索引（章节粒度）。
+
+    - index_file(): 内容哈希未变时直接跳过，否则只重建该文件的章节
+    - stale_files(): 对比目录列表中的 ETag，找出需要重新索引的文件
+    - search(): 返回按 BM25 得分排序的章节，可限定文件
+    """
+
+    def __init__(self):
+        self._files: dict[str, FileInfo] = {}
+        self._sections: dict[int, Section] = {}
+        self._postings: dict[str, dict[int, int]] = {}
+        self._total_length = 0
+        self._next_id = 0
+        # 重建开销统计
+        self._stats = {"files_reindexed": 0, "sections_indexed": 0, "skipped_unchanged": 0, "index_seconds": 0.0}
+
+    @staticmethod
+    def _hash(content: str) -> str:
+        return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+    def is_indexed(self, filename: str) -> bool:
+        return filename in self._files
+
+    def index_file(self, filename: str, content: str, etag: Optional[str] = None) -> bool:
+        """索引（或重建）单个文件，内容未变返回 False"""
+        content_hash = self._hash(content)
+        info = self._files.get(filename)
+        if info and info.content_hash == content_hash:
+            info.etag = etag or info.etag
+            self._stats["skipped_unchanged"] += 1
+            return False
+        start = time.perf_counter()
+        self.remove_file(filename)
+
+        info = FileInfo(content_hash, etag)
+        for heading, text in split_sections(content):
+            tokens = tokenize(f"{filename} {text}")
+            if not tokens:
+                continue
+            section_id = self._next_id
+            self._next_id += 1
+            tf = Counter(tokens)
+            self._sections[section_id] = Section(filename, heading, text, len(tokens), tf)
+            self._total_length += len(tokens)
+            for token, count in tf.items():
+                self._postings.setdefault(token, {})[section_id] = count
+            info.section_ids.append(section_id)
+        self._files[filename] = info
+
+        self._stats["files_reindexed"] += 1
+        self._stats["sections_indexed"] += len(info.section_ids)
+        self._stats["index_seconds"] += time.perf_counter() - start
+        logger.info(f"[MemoryIndex] 索引 {filename}: {len(info.section_ids)} 个章节")
+        return True
+
+    def stale_files(self, etags: dict[str, Optional[str]]) -> list[str]:
+        """
+        根据目录列表 {文件名: ETag} 找出需要（重新）索引的文件，
+        并移除列表中已不存在的文件。
+        """
+        for filename in [f for f in self._files if f not in etags]:
+            self.remove_file(filename)
+        stale = []
+        for filename, etag in etags.items():
+            info = self._files.get(filename)
+            if info is None or etag is None or info.etag != etag:
+                stale.append(filename)
+        return stale
+
+    def remove_file(self, filename: str):
+        """从索引中移除文件的全部章节"""
+        info = self._files.pop(filename, None)
+        if info is None:
+            return
+        for section_id in info.section_ids:
+            section = self._sections.pop(section_id)
+            self._total_length -= section.length
+            for token in section.tf:
+                postings = self._postings.get(token)
+                if postings is not None:
+                    postings.pop(section_id, None)
+                    if not postings:
+                        del self._postings[token]
+
+    def search(self, query: str, top_k: int = 5, filenames: Optional[Iterable[str]] = None) -> list[SearchHit]:
+        """BM25 检索，返回得分大于 0 的前 top_k 个章节"""
+        query_tokens = set(tokenize(query))
+        if not query_tokens or not self._sections:
+            return []
+        allowed = set(filenames) if filenames is not None else None
+
+        n = len(self._sections)
+        avg_length = self._total_length / n
+        k1, b = IndexConfig.BM25_K1, IndexConfig.BM25_B
+        scores: dict[int, float] = {}
+        for token in query_tokens:
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for section_id, tf in postings.items():
+                section = self._sections[section_id]
+                if allowed is not None and section.filename not in allowed:
+                    continue
+                norm = tf * (k1 + 1) / (tf + k1 * (1 - b + b * section.length / avg_length))
+                scores[section_id] = scores.get(section_id, 0.0) + idf * norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [
+            SearchHit(self._sections[sid].filename, self._sections[sid].heading, self._sections[sid].text, round(score, 4))
+            for sid, score in ranked
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "sections": len(self._sections),
+            "terms": len(self._postings),
+            **self._stats,
+            "index_seconds": round(self._stats["index_seconds"], 4),
+        }
+
+
+# 全局单例
+_memory_index: Optional[MemoryIndex] = None
+
+def get_memory_index() -> MemoryIndex:
+    """获取记忆索引单例"""
+    global _memory_index
+    if _memory_index is None:
+        _memory_index = MemoryIndex()
+    return _memory_index
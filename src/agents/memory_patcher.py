@@ -1,9 +1,14 @@
+import asyncio
 import logging
 import json
+import time
+from typing import Optional
 from datetime import datetime
 from src.storage.sphere_storage import get_sphere_storage
 from src.utils.config import settings
 from src.agents.memory_tools import list_available_memories
+from src.agents.history_summarizer import condense_history
+from src.agents.markdown_sections import EditError, apply_edits, outline, parse_sections
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
 
@@ -16,9 +21,53 @@ llm = ChatOpenAI(
     temperature=0.0  # 使用 0 温度以确保精确性
 )
 
-async def detect_memory_updates(session_history: list[dict]) -> list[dict]:
+RETRY_BACKOFF = 2.0  # 重试等待基数（秒），按 2 的幂递增
+
+
+def _add_token_usage(usage: dict, response):
+    """累加一次模型调用的 token 用量"""
+    meta = getattr(response, "usage_metadata", None) or {}
+    if not meta:
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        meta = {"input_tokens": token_usage.get("prompt_tokens", 0), "output_tokens": token_usage.get("completion_tokens", 0)}
+    usage["input_tokens"] = usage.get("input_tokens", 0) + (meta.get("input_tokens") or 0)
+    usage["output_tokens"] = usage.get("output_tokens", 0) + (meta.get("output_tokens") or 0)
+
+
+def _merge_instructions(instructions: list[str]) -> str:
+    """同一文件的多条指令合并为一次重写"""
+    if len(instructions) == 1:
+        return instructions[0]
+    return "\n".join(f"{i}. {instruction}" for i, instruction in enumerate(instructions, 1))
+
+
+def _strip_code_fence(content: str, lang: str) -> str:
+    if content.startswith(f"```{lang}"):
+        return content.split(f"```{lang}")[1].split("```")[0]
+    if content.startswith("```"):
+        return content.split("```")[1].split("```")[0]
+    return content
+
+def normalize_updates(updates) -> list[dict]:
+    """只保留 filename 与 change_instruction 均为非空字符串的变更（模型输出或云端状态可能不合规）"""
+    if isinstance(updates, dict):
+        updates = [updates]
+    if not isinstance(updates, list):
+        return []
+    return [
+        {**u, "filename": u["filename"].strip(), "change_instruction": u["change_instruction"].strip()}
+        for u in updates
+        if isinstance(u, dict)
+        and isinstance(u.get("filename"), str) and u["filename"].strip()
+        and isinstance(u.get("change_instruction"), str) and u["change_instruction"].strip()
+    ]
+
+
+async def detect_memory_updates(session_history: list[dict], history_text: Optional[str] = None) -> list[dict]:
     """
     检测对话中是否包含针对 M3 记忆文件的状态更新。
+
+    history_text 为已压缩的对话文本（见 condense_history），未提供时在此生成。
     """
     # 获取现有记忆文件列表
     memory_files = await list_available_memories()
@@ -27,11 +76,9 @@ async def detect_memory_updates(session_history: list[dict]) -> list[dict]:
     # if not memory_files:
     #     return []
 
-    # 构造 Prompt
-    history_text = "\n".join([
-        f"{'User' if m['role'] == 'user' else 'AI'}: {m['content'][:300]}"
-        for m in session_history
-    ])
+    # 构造 Prompt：长对话分块摘要而不是逐条截断，保留每条消息的细节
+    if history_text is None:
+        history_text = await condense_history(session_history)
 
     detect_prompt = f"""
     作为用户的“外挂记忆体”，请从【对话历史】中提取出人类大脑最容易遗忘但又极具价值的信息，沉淀到 M3 长期记忆库中。
@@ -70,15 +117,9 @@ async def detect_memory_updates(session_history: list[dict]) -> list[dict]:
             SystemMessage(content="你是一个智能的知识库构建者。"),
             HumanMessage(content=detect_prompt)
         ])
-        content = response.content.strip()
-        if content.startswith("```json"):
-            content = content.split("```json")[1].split("```")[0]
-        elif content.startswith("```"):
-            content = content.split("```")[1].split("```")[0]
-            
-        updates = json.loads(content)
-        # 移除过滤逻辑，允许新文件
-        return updates
+        content = _strip_code_fence(response.content.strip(), "json")
+        # 允许新文件，只过滤格式不合规的条目
+        return normalize_updates(json.loads(content))
     except Exception as e:
         logger.error(f"[MemoryPatch] Detection failed: {e}")
         return []
@@ -87,64 +128,196 @@ async def apply_memory_patch(filename: str, change_instruction: str) -> bool:
     """
     将变更应用到指定记忆文件（支持新建）。
     """
-    storage = get_sphere_storage()
     try:
-        # 1. 读取原始内容
-        original_content = await storage.read_memory_file(filename)
-        is_new_file = original_content is None
-        
-        if is_new_file:
-            logger.info(f"[MemoryPatch] Creating NEW file: {filename}")
-            original_content = "" # 空内容用于 Prompt
-
-        # 2. 生成新内容
-        if is_new_file:
-            patch_prompt = f"""
-            你正在创建一个名为【{filename}】的新记忆文件。
-            请根据以下初始指令生成文件内容。
-            
-            初始指令：{change_instruction}
-            
-            要求：
-            1. **标准结构**：必须包含 # 一级标题（文件名）和合理的 ## 二级标题结构。
-            2. **内容填充**：将指令中的事实作为初始条目填入。
-            3. **格式规范**：使用标准的 Markdown 列表或表格。
-            4. 只输出文件全文。
-            """
-        else:
-            patch_prompt = f"""
-            请根据【修改指令】更新以下 Markdown 文档内容。
-
-            修改指令：{change_instruction}
-
-            原文内容：
-            {original_content}
-
-            要求（笔记规范）：
-            1. **结构化录入**：确保信息被归类到合适的 ## 章节下。
-            2. **时间戳溯源**：每条新记录或重大修改，请在末尾标注日期，如 `[2025-12-31]`。
-            3. **逻辑保留**：如果指令中包含“因为...所以...”，请务必完整保留其逻辑脉络。
-            4. **精简干练**：使用清单（-）或表格，避免长篇累牍。
-            5. **历史版本感**：如果是修改旧条目，不要直接删除，可以在后面括号注明“（原为xxx，已于2025-12-31更新为yyy）”，除非用户要求彻底重写。
-            
-            只输出修改后的文档全文。
-            """
-        
-        response = await llm.ainvoke([
-            SystemMessage(content="你是一个文档维护专家。只输出修改后的文档全文。"),
-            HumanMessage(content=patch_prompt)
-        ])
-        new_content = response.content.strip()
-        if new_content.startswith("```markdown"):
-            new_content = new_content.split("```markdown")[1].split("```")[0]
-        elif new_content.startswith("```"):
-            new_content = new_content.split("```")[1].split("```")[0]
-        
-        # 3. 写入新内容
-        await storage.write_memory_file(filename, new_content)
-        logger.info(f"[MemoryPatch] Successfully {'created' if is_new_file else 'patched'} {filename}")
+        await _rewrite_file(filename, change_instruction, {})
         return True
-
     except Exception as e:
         logger.error(f"[MemoryPatch] Patching {filename} failed: {e}")
         return False
+
+
+async def _structured_edit(filename: str, original_content: str, change_instruction: str, usage: dict) -> Optional[str]:
+    """
+    结构化编辑：模型只输出按标题路径定位的操作列表，由本地章节树应用，
+    输出 token 与改动大小成正比。操作无法解析或应用时返回 None。
+    """
+    sections = outline(parse_sections(original_content))
+    edit_prompt = f"""
+        请根据【修改指令】为下面的 Markdown 文档生成结构化编辑操作，不要输出文档全文。
+
+        修改指令：{change_instruction}
+
+        现有章节路径：
+        {json.dumps(sections, ensure_ascii=False)}
+
+        原文内容：
+        {original_content}
+
+        可用操作（路径用 " > " 连接各级标题，必须取自现有章节路径）：
+        - {{"op": "append", "path": "章节路径", "content": "追加到该章节末尾的 Markdown"}}
+        - {{"op": "replace", "path": "章节路径", "old": "该章节中要替换的原有行（原文片段）", "new": "替换后的整行"}}
+        - {{"op": "add_section", "path": "父章节路径（顶层留空）", "heading": "新章节标题", "content": "章节内容"}}
+
+        要求（笔记规范）：
+        1. **结构化录入**：信息归类到合适的 ## 章节下，没有合适章节时用 add_section。
+        2. **时间戳溯源**：每条新记录或重大修改，请在末尾标注日期，如 `[{datetime.now().strftime("%Y-%m-%d")}]`。
+        3. **逻辑保留**：如果指令中包含“因为...所以...”，请务必完整保留其逻辑脉络。
+        4. **精简干练**：使用清单（-）或表格，避免长篇累牍。
+        5. **历史版本感**：修改旧条目用 replace，并在新行括号注明“（原为xxx，已更新为yyy）”。
+
+        只输出 JSON 数组，如 [{{"op": "append", "path": "...", "content": "- ..."}}]。
+        """
+    response = await llm.ainvoke([
+        SystemMessage(content="你是一个文档维护专家。只输出 JSON 格式的编辑操作。"),
+        HumanMessage(content=edit_prompt)
+    ])
+    _add_token_usage(usage, response)
+    try:
+        operations = json.loads(_strip_code_fence(response.content.strip(), "json"))
+        if isinstance(operations, dict):
+            operations = [operations]
+        if not isinstance(operations, list):
+            raise EditError(f"操作格式错误: {type(operations).__name__}")
+        if not operations:
+            return original_content
+        return apply_edits(original_content, operations)
+    except (ValueError, TypeError, AttributeError) as e:  # JSON 无效、操作无法应用或字段类型错误
+        logger.warning(f"[MemoryPatch] {filename} 结构化编辑无法应用，改为全文重写: {e}")
+        return None
+
+
+async def _rewrite_file(filename: str, change_instruction: str, usage: dict) -> str:
+    """读取 → 模型修改 → 写回，返回使用的模式（structured/rewrite/create），失败时抛出异常；usage 累加 token 用量"""
+    storage = get_sphere_storage()
+    # 1. 读取原始内容（写回前向服务器确认，避免覆盖 Obsidian 中的外部修改）
+    original_content = await storage.read_memory_file(filename, revalidate=True)
+    is_new_file = original_content is None
+    
+    if is_new_file:
+        logger.info(f"[MemoryPatch] Creating NEW file: {filename}")
+        original_content = "" # 空内容用于 Prompt
+
+    # 2. 已有文件优先使用结构化编辑
+    if not is_new_file and settings.MEMORY_PATCH_MODE == "structured":
+        new_content = await _structured_edit(filename, original_content, change_instruction, usage)
+        if new_content is not None:
+            if new_content != original_content and not await storage.write_memory_file(filename, new_content):
+                raise IOError(f"写入失败: {filename}")
+            logger.info(f"[MemoryPatch] Successfully patched {filename} (structured)")
+            return "structured"
+
+    # 3. 生成新内容（新建或全文重写）
+    if is_new_file:
+        patch_prompt = f"""
+        你正在创建一个名为【{filename}】的新记忆文件。
+        请根据以下初始指令生成文件内容。
+        
+        初始指令：{change_instruction}
+        
+        要求：
+        1. **标准结构**：必须包含 # 一级标题（文件名）和合理的 ## 二级标题结构。
+        2. **内容填充**：将指令中的事实作为初始条目填入。
+        3. **格式规范**：使用标准的 Markdown 列表或表格。
+        4. 只输出文件全文。
+        """
+    else:
+        patch_prompt = f"""
+        请根据【修改指令】更新以下 Markdown 文档内容。
+
+        修改指令：{change_instruction}
+
+        原文内容：
+        {original_content}
+
+        要求（笔记规范）：
+        1. **结构化录入**：确保信息被归类到合适的 ## 章节下。
+        2. **时间戳溯源**：每条新记录或重大修改，请在末尾标注日期，如 `[2025-12-31]`。
+        3. **逻辑保留**：如果指令中包含“因为...所以...”，请务必完整保留其逻辑脉络。
+        4. **精简干练**：使用清单（-）或表格，避免长篇累牍。
+        5. **历史版本感**：如果是修改旧条目，不要直接删除，可以在后面括号注明“（原为xxx，已于2025-12-31更新为yyy）”，除非用户要求彻底重写。
+        
+        只输出修改后的文档全文。
+        """
+    
+    response = await llm.ainvoke([
+        SystemMessage(content="你是一个文档维护专家。只输出修改后的文档全文。"),
+        HumanMessage(content=patch_prompt)
+    ])
+    _add_token_usage(usage, response)
+    new_content = _strip_code_fence(response.content.strip(), "markdown")
+    
+    # 4. 写入新内容
+    if not new_content.strip():
+        raise ValueError("模型返回了空文档")
+    if not await storage.write_memory_file(filename, new_content):
+        raise IOError(f"写入失败: {filename}")
+    logger.info(f"[MemoryPatch] Successfully {'created' if is_new_file else 'patched'} {filename}")
+    return "create" if is_new_file else "rewrite"
+
+
+async def apply_file_patches(filename: str, instructions: list[str], retries: int) -> dict:
+    """把同一文件的全部指令合并为一次重写，失败时按指数退避重试"""
+    start = time.time()
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    merged = _merge_instructions(instructions)
+    success = False
+    attempts = 0
+    error = ""
+    mode = ""
+    for attempt in range(retries + 1):
+        attempts += 1
+        try:
+            mode = await _rewrite_file(filename, merged, usage)
+            success = True
+            break
+        except Exception as e:
+            error = str(e)
+            logger.warning(f"[MemoryPatch] {filename} 第 {attempts} 次修改失败: {e}")
+            if attempt < retries:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    return {
+        "filename": filename,
+        "instructions": len(instructions),
+        "success": success,
+        "mode": mode,
+        "attempts": attempts,
+        "latency": round(time.time() - start, 2),
+        "error": "" if success else error,
+        **usage
+    }
+
+
+async def apply_memory_patches(updates: list[dict], concurrency: int, retries: int) -> tuple[list[dict], dict]:
+    """
+    按目标文件分组应用补丁：同一文件的多条指令只重写一次，不同文件在并发上限内同时处理。
+    
+    Returns:
+        (每个文件的结果, 汇总统计)
+    """
+    start = time.time()
+    grouped: dict[str, list[str]] = {}
+    for update in updates:
+        if update.get("filename") and update.get("change_instruction"):
+            grouped.setdefault(update["filename"], []).append(update["change_instruction"])
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run(filename: str, instructions: list[str]) -> dict:
+        async with semaphore:
+            return await apply_file_patches(filename, instructions, retries)
+
+    results = await asyncio.gather(*[run(f, i) for f, i in grouped.items()])
+    summary = {
+        "files": len(results),
+        "instructions": sum(r["instructions"] for r in results),
+        "succeeded": sum(1 for r in results if r["success"]),
+        "failed": sum(1 for r in results if not r["success"]),
+        "retries": sum(r["attempts"] - 1 for r in results),
+        "structured": sum(1 for r in results if r["mode"] == "structured"),
+        "wall_time": round(time.time() - start, 2),
+        "max_file_latency": max((r["latency"] for r in results), default=0),
+        "input_tokens": sum(r["input_tokens"] for r in results),
+        "output_tokens": sum(r["output_tokens"] for r in results),
+    }
+    logger.info(f"[MemoryPatch] 补丁汇总: {summary}")
+    return list(results), summary
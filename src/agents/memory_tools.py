@@ -1,11 +1,13 @@
 # 长期记忆工具模块
-# 提供 fetch_memory 和相关记忆管理工具
+# 提供 fetch_memory / search_memory 和相关记忆管理工具
 
+import asyncio
 import logging
-import re
 from typing import Optional
 
+from src.agents.memory_index import get_memory_index
 from src.storage.sphere_storage import get_sphere_storage
+from src.utils.token_estimator import estimate_tokens, truncate_to_tokens
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +16,9 @@ class MemoryConfig:
     MAX_PARAGRAPHS = 3
     MAX_LINES = 10
     CONTENT_PREVIEW_LENGTH = 2000
+    SEARCH_TOP_K = 5
+    SEARCH_MAX_TOP_K = 20
+    SEARCH_TOKEN_BUDGET = 1500
 
 
 import time
@@ -50,13 +55,15 @@ async def fetch_memory(filename: str, keywords: Optional[str] = None) -> dict:
             "error": f"文件不存在: {filename}"
         }
     
-    # 如果有关键词，进行段落级搜索
+    # 如果有关键词，在倒排索引中做章节级 BM25 检索（内容未变时不会重新切分）
     if keywords:
-        paragraphs = re.split(r'\n(?=##)', content)  # 按二级标题分割
-        matched = [p for p in paragraphs if keywords in p]
+        _attach_index_listener()
+        index = get_memory_index()
+        index.index_file(filename, content, storage.memory_file_etag(filename))
+        hits = index.search(keywords, top_k=MemoryConfig.MAX_PARAGRAPHS, filenames=[filename])
         
-        if matched:
-            result = "\n\n".join(matched[:MemoryConfig.MAX_PARAGRAPHS])  # 最多返回3段
+        if hits:
+            result = "\n\n".join(hit.text for hit in hits)  # 最多返回3段
         else:
             # 降级到全文匹配
             lines = [l for l in content.split("\n") if keywords in l]
@@ -71,6 +78,99 @@ async def fetch_memory(filename: str, keywords: Optional[str] = None) -> dict:
     return {"success": True, "content": result}
 
 
+def _on_memory_file_changed(filename: str, content: Optional[str], etag: Optional[str]):
+    """存储层变更回调：只重建发生变化的文件"""
+    if not filename.endswith(".md"):
+        return
+    index = get_memory_index()
+    if content is None:
+        index.remove_file(filename)
+    else:
+        index.index_file(filename, content, etag)
+
+
+def _attach_index_listener():
+    """把索引挂到记忆存储的变更通知上（幂等）"""
+    get_sphere_storage().memory_storage.add_change_listener(_on_memory_file_changed)
+
+
+async def ensure_memory_index() -> list[str]:
+    """
+    保持索引与云端一致。
+    
+    写入/删除通过变更回调即时更新；Obsidian 中的外部修改通过目录列表中的
+    ETag 对比发现，只重新读取并索引 ETag 变化的文件。
+    """
+    _attach_index_listener()
+    storage = get_sphere_storage()
+    index = get_memory_index()
+    entries = await storage.list_memory_entries()
+    etags = {entry.name: entry.etag for entry in entries}
+    stale = index.stale_files(etags)
+    if stale:
+        contents = await asyncio.gather(*[storage.read_memory_file(f, etags[f]) for f in stale])
+        for filename, content in zip(stale, contents):
+            if content is not None:
+                index.index_file(filename, content, etags[filename])
+        logger.info(f"[MemoryIndex] 增量更新 {len(stale)} 个文件: {stale}")
+    return list(etags)
+
+
+async def search_memories(query: str, top_k: int = MemoryConfig.SEARCH_TOP_K) -> list[dict]:
+    """
+    跨文件检索长期记忆，返回按 BM25 得分排序的章节。
+    
+    Returns:
+        list[dict]: [{"filename", "heading", "content", "score"}]
+    """
+    start_time = time.time()
+    await ensure_memory_index()
+    hits = get_memory_index().search(query, top_k=top_k)
+    logger.info(f"[{time.strftime('%H:%M:%S')}] [search_memories] '{query}' 命中 {len(hits)} 个章节 (耗时 {time.time() - start_time:.3f}s)")
+    return [
+        {"filename": hit.filename, "heading": hit.heading, "content": hit.text, "score": hit.score}
+        for hit in hits
+    ]
+
+
+async def search_memory(
+    query: str,
+    top_k: int = MemoryConfig.SEARCH_TOP_K,
+    token_budget: int = MemoryConfig.SEARCH_TOKEN_BUDGET
+) -> dict:
+    """
+    跨文件检索长期记忆（供 LLM 工具调用）。
+    
+    一次调用检索全部记忆文件，按得分从高到低拼接章节并标注来源，
+    总长度不超过 token_budget，避免模型逐个文件多轮调用 fetch_memory。
+    
+    Returns:
+        dict: {"success": bool, "content": str, "sources": list, "error": str}
+    """
+    top_k = max(1, min(int(top_k or MemoryConfig.SEARCH_TOP_K), MemoryConfig.SEARCH_MAX_TOP_K))
+    token_budget = max(1, int(token_budget or MemoryConfig.SEARCH_TOKEN_BUDGET))
+    hits = await search_memories(query, top_k)
+    if not hits:
+        return {"success": False, "content": "", "sources": [], "error": f"未找到与「{query}」相关的记忆"}
+
+    blocks, sources, used = [], [], 0
+    for hit in hits:
+        source = f"{hit['filename']} > {hit['heading']}" if hit["heading"] else hit["filename"]
+        block = f"【{source}】\n{hit['content']}"
+        cost = estimate_tokens(block)
+        if used + cost > token_budget:
+            if not blocks:
+                # 第一段就超出预算时截断，保证至少返回最相关的内容
+                blocks.append(truncate_to_tokens(block, token_budget))
+                sources.append(source)
+            break
+        blocks.append(block)
+        sources.append(source)
+        used += cost
+
+    return {"success": True, "content": "\n\n".join(blocks), "sources": sources, "error": ""}
+
+
 async def read_memory_readonly(filename: str) -> dict:
     """只读获取记忆文件内容（不更新时间戳，用于 Debug 查看）"""
     storage = get_sphere_storage()
@@ -113,6 +213,31 @@ MEMORY_TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_memory",
+            "description": "跨全部记忆文件检索长期记忆，一次返回最相关的章节（含文件名和标题来源）。不确定信息在哪个文件时优先使用。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "检索内容，如 跑步计划、买房预算"
+                    },
+                    "top_k": {
+                        "type": "integer",
+                        "description": "最多返回的章节数，默认 5"
+                    },
+                    "token_budget": {
+                        "type": "integer",
+                        "description": "返回内容的最大 token 数，默认 1500"
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -22,6 +22,7 @@ class StreamConfig:
     CONNECT_TIMEOUT = 10.0
     TOOL_TIMEOUT = 30.0
     MAX_TOOLS_PER_ROUND = 5
+    MAX_CONCURRENT_TOOLS = settings.TOOL_MAX_CONCURRENCY  # 同一轮内并发执行的工具数上限
     DEBUG_LOG_INTERVAL = 10  # 每10个chunk输出一次调试信息
 
 def ts() -> str:
@@ -33,7 +34,9 @@ class ChunkType(Enum):
     """流式输出块类型"""
     REASONING = "reasoning"      # 思考链内容
     TOOL_CALL = "tool_call"      # 工具调用请求
+    TOOL_RESULT = "tool_result"  # 工具结果已写回对话（只包含最终采用的那次执行）
     CONTENT = "content"          # 最终回答内容
+    USAGE = "usage"              # 本轮 token 用量（含上下文缓存命中）
     ERROR = "error"              # 错误信息
 
 
@@ -43,6 +46,7 @@ class StreamChunk:
     type: ChunkType
     content: str = ""
     tool_call: Optional[dict] = None
+    usage: Optional[dict] = None
     is_final: bool = False
 
 
@@ -62,12 +66,215 @@ def get_async_client() -> AsyncOpenAI:
     return _async_client
 
 
+# 进程内累计的 token 用量（供 /health 观察前缀缓存命中率）
+_USAGE_STATS = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cache_hit_tokens": 0, "cache_miss_tokens": 0}
+
+
+def _parse_usage(usage) -> dict:
+    """提取 usage 中的 token 数；DeepSeek 用 prompt_cache_hit/miss_tokens 报告上下文缓存"""
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", 0) if details else 0
+    hit = hit or 0
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cache_hit_tokens": hit,
+        "cache_miss_tokens": miss if miss is not None else max(prompt_tokens - hit, 0),
+    }
+
+
+def merge_usage(total: dict, usage: dict) -> dict:
+    """累加多轮 usage，并计算缓存命中率"""
+    for key, value in usage.items():
+        if key != "cache_hit_rate":
+            total[key] = total.get(key, 0) + value
+    cached = total.get("cache_hit_tokens", 0) + total.get("cache_miss_tokens", 0)
+    total["cache_hit_rate"] = round(total.get("cache_hit_tokens", 0) / cached, 4) if cached else 0.0
+    return total
+
+
+def get_usage_stats() -> dict:
+    return merge_usage({}, _USAGE_STATS)
+
+
+# 客户端断开后中止的工作（供 /health 观察节省了多少）
+_CANCEL_STATS = {"rounds_aborted": 0, "streams_closed": 0, "tools_cancelled": 0}
+_CLOSE_TASKS: set = set()
+
+
+def get_cancel_stats() -> dict:
+    return dict(_CANCEL_STATS)
+
+
+def _abort_round(stream, calls: list):
+    """中止本轮：关闭上游 HTTP 流，取消尚未完成的工具"""
+    _CANCEL_STATS["rounds_aborted"] += 1
+    for call in calls:
+        task = call.get("task")
+        if task is not None and not task.done():
+            task.cancel()
+            _CANCEL_STATS["tools_cancelled"] += 1
+    close = getattr(stream, "close", None)
+    if close is not None:
+        # 在独立任务中关闭，调用方此时可能正处于取消状态
+        task = asyncio.create_task(close())
+        _CLOSE_TASKS.add(task)
+        task.add_done_callback(_CLOSE_TASKS.discard)
+        _CANCEL_STATS["streams_closed"] += 1
+
+
+async def _gather_unless_cancelled(tasks: list, cancel_event: Optional[asyncio.Event]) -> Optional[list]:
+    """等待全部工具完成；cancel_event 先被触发时取消全部工具并等待其结束，返回 None"""
+    if cancel_event is None:
+        return await asyncio.gather(*tasks)
+    gathered = asyncio.gather(*tasks)
+    waiter = asyncio.create_task(cancel_event.wait())
+    try:
+        await asyncio.wait({gathered, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        gathered.cancel()
+        # 自身被取消时无法再等待，由回调取走结果，避免 "exception was never retrieved"
+        gathered.add_done_callback(_retrieve_result)
+        raise
+    finally:
+        waiter.cancel()
+    if gathered.done():
+        return gathered.result()
+    gathered.cancel()
+    await asyncio.gather(gathered, return_exceptions=True)
+    return None
+
+
+def _retrieve_result(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+
+async def _run_tool(
+    tool_executor: Callable[[str, dict], Any],
+    name: str,
+    args: dict,
+    semaphore: asyncio.Semaphore
+) -> str:
+    """在并发上限内执行单个工具，超时和异常都转为结果文本（超时从获得执行槽位开始计算）"""
+    async with semaphore:
+        start = time.time()
+        try:
+            result = await asyncio.wait_for(tool_executor(name, args), timeout=StreamConfig.TOOL_TIMEOUT)
+            logger.info(f"[ThinkingStream] Tool {name} returned {len(str(result))} chars ({time.time() - start:.2f}s)")
+        except asyncio.TimeoutError:
+            logger.error(f"[ThinkingStream] Tool {name} timeout after {StreamConfig.TOOL_TIMEOUT}s")
+            result = f"工具执行超时: {name}"
+        except Exception as tool_error:
+            logger.error(f"[ThinkingStream] Tool execution error: {tool_error}")
+            result = f"工具执行失败: {str(tool_error)}"
+    return str(result) if result else "执行成功"
+
+
+def _is_complete_json(arguments: str) -> bool:
+    """参数字符串是否已是完整的 JSON 对象"""
+    if not arguments.rstrip().endswith("}"):
+        return False
+    try:
+        return isinstance(json.loads(arguments), dict)
+    except json.JSONDecodeError:
+        return False
+
+
+class ToolCallAssembler:
+    """
+    流式工具调用组装器。
+    
+    把 tool_calls 增量拼成完整调用；某个调用的参数已能解析为完整 JSON 时即视为就绪，
+    调用方可以立即执行，不必等整个流结束。不以“下一个 index 已开始”判断就绪，
+    因为多个调用的增量可能交错到达。
+    """
+
+    def __init__(self):
+        self.calls: list[dict] = []
+        self._current: Optional[dict] = None
+        self._emitted: set[int] = set()
+
+    def feed(self, tool_call_deltas) -> list[int]:
+        """处理一批 tool_calls 增量，返回新就绪的调用下标"""
+        for tc in tool_call_deltas:
+            if tc.index is not None:
+                # 新工具调用开始
+                while len(self.calls) <= tc.index:
+                    self.calls.append({"id": "", "name": "", "arguments": ""})
+                self._current = self.calls[tc.index]
+            if self._current is None:
+                continue
+            
+            if tc.id:
+                self._current["id"] = tc.id
+                logger.info(f"[{ts()}] [ThinkingStream] Set tool id: {tc.id}")
+            if tc.function:
+                if tc.function.name:
+                    self._current["name"] = tc.function.name
+                    logger.info(f"[{ts()}] [ThinkingStream] Set tool name: {tc.function.name}")
+                if tc.function.arguments:
+                    self._current["arguments"] += tc.function.arguments
+                    logger.info(f"[{ts()}] [ThinkingStream] Appended args: {tc.function.arguments}")
+        return self._collect_ready(final=False)
+
+    def finish(self) -> list[int]:
+        """流结束：其余调用全部视为就绪"""
+        return self._collect_ready(final=True)
+
+    def _collect_ready(self, final: bool) -> list[int]:
+        ready = []
+        for i, call in enumerate(self.calls):
+            if i in self._emitted or not call["name"]:
+                continue
+            if final or _is_complete_json(call["arguments"]):
+                self._emitted.add(i)
+                ready.append(i)
+        return ready
+
+
+def _launch_tool(
+    call: dict,
+    tool_executor: Callable[[str, dict], Any],
+    semaphore: asyncio.Semaphore
+) -> Optional[dict]:
+    """
+    解析参数并在后台启动工具，返回参数（参数无效、或解析结果与已启动的任务相同时返回 None）。
+    参数在提前启动后发生变化时取消旧任务并以新参数重跑，旧任务的输出被丢弃。
+    """
+    call["launched_args"] = call["arguments"]
+    try:
+        args = json.loads(call["arguments"]) if call["arguments"] else {}
+    except json.JSONDecodeError as e:
+        logger.error(f"[ThinkingStream] Invalid tool arguments for {call['name']}: {e}")
+        args = None
+    previous = call.get("task")
+    if previous is not None:
+        if args is not None and args == call.get("args"):
+            # 只多了空白等不改变参数的增量，沿用已启动的任务
+            return None
+        previous.cancel()
+    call["task"] = None
+    call["args"] = args
+    if args is None:
+        return None
+    logger.info(f"[{ts()}] [ThinkingStream] Executing tool: {call['name']}({args})")
+    call["task"] = asyncio.create_task(_run_tool(tool_executor, call["name"], args, semaphore))
+    return args
+
+
 async def stream_with_thinking_tools(
     messages: list,
     tools: list,
     tool_executor: Callable[[str, dict], Any],
     max_tool_rounds: int = 5,
-    total_timeout: float = StreamConfig.DEFAULT_TIMEOUT
+    total_timeout: float = StreamConfig.DEFAULT_TIMEOUT,
+    tool_concurrency: int = StreamConfig.MAX_CONCURRENT_TOOLS,
+    cancel_event: Optional[asyncio.Event] = None
 ):
     """
     Deepseek V3.2 Thinking Mode + Tool Calls 流式调用。
@@ -75,15 +282,20 @@ async def stream_with_thinking_tools(
     实现"边思考边调用工具"的核心逻辑：
     1. 启用 thinking mode 发起流式请求
     2. 流式接收 reasoning_content 和 tool_calls
-    3. 如有工具调用，执行工具并回传结果，继续循环
+    3. 某个工具调用的参数一旦完整就立即在后台执行（与后续输出重叠），
+       本轮结束后按原顺序回传结果，继续循环
     4. 直到获得最终 content 为止
     
     Args:
         messages: 对话历史
         tools: 工具定义列表
-        tool_executor: 工具执行函数，签名为 (name, args) -> result
+        tool_executor: 工具执行函数，签名为 (name, args) -> result。
+            工具可能在参数完整前被提前启动、随后取消并以新参数重跑，执行器不应产生副作用；
+            需要记录的结果以 TOOL_RESULT 块为准，每个最终采用的调用只产出一次
         max_tool_rounds: 最大工具调用轮数，防止无限循环
         total_timeout: 总超时时间
+        tool_concurrency: 同一轮内并发执行的工具数上限
+        cancel_event: 客户端断开时被触发；触发后关闭上游流、取消工具并结束，不再产出
     
     Yields:
         StreamChunk: 流式输出块（思考/工具调用/内容）
@@ -91,8 +303,11 @@ async def stream_with_thinking_tools(
     client = get_async_client()
     current_messages = list(messages)  # 复制，避免修改原列表
     total_start = time.time()
+    tool_semaphore = asyncio.Semaphore(max(tool_concurrency, 1))
     
     for round_idx in range(max_tool_rounds):
+        if cancel_event is not None and cancel_event.is_set():
+            return
         # 检查总体超时
         if time.time() - total_start > total_timeout:
             logger.error(f"[ThinkingStream] Total timeout ({total_timeout}s) reached")
@@ -111,7 +326,8 @@ async def stream_with_thinking_tools(
                 model="deepseek-chat",
                 messages=current_messages,
                 tools=tools if tools else None,
-                stream=True
+                stream=True,
+                stream_options={"include_usage": True}
             )
         except Exception as e:
             logger.error(f"[{ts()}] [ThinkingStream] API call failed: {e}")
@@ -121,57 +337,71 @@ async def stream_with_thinking_tools(
         # 收集本轮响应
         reasoning_content = ""
         content = ""
-        tool_calls_data = []  # 存储工具调用信息
-        current_tool_call = None
+        assembler = ToolCallAssembler()
+        tool_calls_data = assembler.calls  # 存储工具调用信息
+        launched = 0
         chunk_count = 0
         last_chunk = None
         
         logger.info(f"[{ts()}] [ThinkingStream] Starting stream iteration...")
         
-        async for chunk in stream:
-            chunk_count += 1
-            if chunk_count % StreamConfig.DEBUG_LOG_INTERVAL == 0:
-                now = time.time()
-                logger.info(f"[{ts()}] [ThinkingStream] Received {chunk_count} chunks, elapsed {now - round_start:.2f}s")
-            last_chunk = chunk
-            
-            delta = chunk.choices[0].delta if chunk.choices else None
-            if not delta:
-                continue
-            
-            # 处理思考链
-            if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                reasoning_content += delta.reasoning_content
-            
-            # 处理最终内容
-            if delta.content:
-                content += delta.content
-                yield StreamChunk(type=ChunkType.CONTENT, content=delta.content)
-            
-            # 处理工具调用
-            if delta.tool_calls:
-                logger.info(f"[{ts()}] [ThinkingStream] Received tool_calls delta: {delta.tool_calls}")
-                for tc in delta.tool_calls:
-                    if tc.index is not None:
-                        # 新工具调用开始
-                        while len(tool_calls_data) <= tc.index:
-                            tool_calls_data.append({
-                                "id": "",
-                                "name": "",
-                                "arguments": ""
-                            })
-                        current_tool_call = tool_calls_data[tc.index]
-                    
-                    if tc.id:
-                        current_tool_call["id"] = tc.id
-                        logger.info(f"[{ts()}] [ThinkingStream] Set tool id: {tc.id}")
-                    if tc.function:
-                        if tc.function.name:
-                            current_tool_call["name"] = tc.function.name
-                            logger.info(f"[{ts()}] [ThinkingStream] Set tool name: {tc.function.name}")
-                        if tc.function.arguments:
-                            current_tool_call["arguments"] += tc.function.arguments
-                            logger.info(f"[{ts()}] [ThinkingStream] Appended args: {tc.function.arguments}")
+        try:
+            async for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                chunk_count += 1
+                if chunk_count % StreamConfig.DEBUG_LOG_INTERVAL == 0:
+                    now = time.time()
+                    logger.info(f"[{ts()}] [ThinkingStream] Received {chunk_count} chunks, elapsed {now - round_start:.2f}s")
+                # 开启 include_usage 后，最后一个 chunk 只有 usage、没有 choices
+                if getattr(chunk, "usage", None):
+                    usage = _parse_usage(chunk.usage)
+                    _USAGE_STATS["requests"] += 1
+                    for key, value in usage.items():
+                        _USAGE_STATS[key] += value
+                    logger.info(f"[{ts()}] [ThinkingStream] Usage: {usage}")
+                    yield StreamChunk(type=ChunkType.USAGE, usage=usage)
+                if not chunk.choices:
+                    continue
+                last_chunk = chunk
+                
+                delta = chunk.choices[0].delta if chunk.choices else None
+                if not delta:
+                    continue
+                
+                # 处理思考链
+                if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
+                    reasoning_content += delta.reasoning_content
+                
+                # 处理最终内容
+                if delta.content:
+                    content += delta.content
+                    yield StreamChunk(type=ChunkType.CONTENT, content=delta.content)
+                
+                # 处理工具调用：参数完整的调用立即启动
+                if delta.tool_calls:
+                    logger.info(f"[{ts()}] [ThinkingStream] Received tool_calls delta: {delta.tool_calls}")
+                    for index in assembler.feed(delta.tool_calls):
+                        if launched >= StreamConfig.MAX_TOOLS_PER_ROUND:
+                            continue
+                        launched += 1
+                        call = tool_calls_data[index]
+                        args = _launch_tool(call, tool_executor, tool_semaphore)
+                        if args is not None:
+                            logger.info(f"[{ts()}] [ThinkingStream] Eager start: {call['name']} (elapsed {time.time() - round_start:.2f}s)")
+                            yield StreamChunk(
+                                type=ChunkType.TOOL_CALL,
+                                content=f"正在调用 {call['name']}...",
+                                tool_call={"name": call["name"], "args": args}
+                            )
+        except BaseException:
+            # 流中断（含请求被取消）时关闭上游并取消已提前启动的工具
+            _abort_round(stream, tool_calls_data)
+            raise
+        if cancel_event is not None and cancel_event.is_set():
+            _abort_round(stream, tool_calls_data)
+            logger.info(f"[{ts()}] [ThinkingStream] Client disconnected, round {round_idx + 1} aborted after {chunk_count} chunks")
+            return
         
         # 检查流结束状态
         finish_reason = last_chunk.choices[0].finish_reason if last_chunk and last_chunk.choices else None
@@ -236,47 +466,43 @@ async def stream_with_thinking_tools(
         
         current_messages.append(assistant_message)
         
-        # 执行工具并收集结果
+        # 启动流结束时才就绪（或参数在启动后又有变化）的工具
+        assembler.finish()
         for tc in filtered_tool_calls:
-            try:
-                args = json.loads(tc["arguments"]) if tc["arguments"] else {}
-                logger.info(f"[ThinkingStream] Executing tool: {tc['name']}({args})")
-                
-                # 通知调用方正在执行工具
+            if tc.get("launched_args") == tc["arguments"]:
+                continue
+            args = _launch_tool(tc, tool_executor, tool_semaphore)
+            if args is not None:
                 yield StreamChunk(
                     type=ChunkType.TOOL_CALL, 
                     content=f"正在调用 {tc['name']}...",
                     tool_call={"name": tc["name"], "args": args}
                 )
-                
-                # 执行工具（添加超时保护）
-                try:
-                    result = await asyncio.wait_for(
-                        tool_executor(tc["name"], args), 
-                        timeout=StreamConfig.TOOL_TIMEOUT
-                    )
-                    logger.info(f"[ThinkingStream] Tool {tc['name']} returned {len(str(result))} chars")
-                except asyncio.TimeoutError:
-                    logger.error(f"[ThinkingStream] Tool {tc['name']} timeout after {StreamConfig.TOOL_TIMEOUT}s")
-                    result = f"工具执行超时: {tc['name']}"
-                except Exception as tool_error:
-                    logger.error(f"[ThinkingStream] Tool execution error: {tool_error}")
-                    result = f"工具执行失败: {str(tool_error)}"
-                
-                # 将工具结果加入消息
-                current_messages.append({
-                    "role": "tool",
-                    "tool_call_id": tc["id"],
-                    "content": str(result) if result else "执行成功"
-                })
-                
-            except Exception as e:
-                logger.error(f"[ThinkingStream] Tool execution failed: {e}")
-                current_messages.append({
-                    "role": "tool",
-                    "tool_call_id": tc["id"],
-                    "content": f"工具执行失败: {str(e)}"
-                })
+        
+        tools_start = time.time()
+        tasks = [tc["task"] for tc in filtered_tool_calls if tc["task"] is not None]
+        results = await _gather_unless_cancelled(tasks, cancel_event)
+        if results is None:
+            _abort_round(None, filtered_tool_calls)
+            logger.info(f"[{ts()}] [ThinkingStream] Client disconnected while tools were running")
+            return
+        logger.info(f"[{ts()}] [ThinkingStream] {len(results)} tools finished {time.time() - tools_start:.2f}s after stream end (concurrency={tool_concurrency})")
+        
+        # 按原 tool_call_id 顺序写回结果
+        results_iter = iter(results)
+        for tc in filtered_tool_calls:
+            result = next(results_iter) if tc["task"] is not None else "工具执行失败: 参数不是有效的 JSON"
+            current_messages.append({
+                "role": "tool",
+                "tool_call_id": tc["id"],
+                "content": result
+            })
+            if tc["task"] is not None:
+                yield StreamChunk(
+                    type=ChunkType.TOOL_RESULT,
+                    content=result,
+                    tool_call={"name": tc["name"], "args": tc["args"]}
+                )
         
         # 继续下一轮（让模型处理工具结果）
     
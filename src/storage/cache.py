@@ -0,0 +1,127 @@
+# 存储层缓存子系统
+# 按字节预算淘汰的 LRU 缓存，按命名空间（base_url + 目录）隔离
+# 以及合并并发请求的 SingleFlight
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LRUByteCache:
+    """
+    带字节预算的 LRU 缓存。
+
+    - 键为 (namespace, key)，不同目录的数据互不干扰
+    - 总大小超过 max_bytes 时从最久未使用的条目开始淘汰
+    - 支持按单个键或整个命名空间定向失效
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[str, str], tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """读取条目并标记为最近使用"""
+        with self._lock:
+            item = self._entries.get((namespace, key))
+            if item is None:
+                return None
+            self._entries.move_to_end((namespace, key))
+            return item[0]
+
+    def set(self, namespace: str, key: str, value: Any, size: int):
+        """写入条目，必要时淘汰旧条目"""
+        if size > self.max_bytes:
+            # 单个条目超过预算，不缓存
+            logger.warning(f"[Cache] 条目过大，跳过缓存: {namespace} {key} ({size} bytes)")
+            self.invalidate(namespace, key)
+            return
+        with self._lock:
+            old = self._entries.pop((namespace, key), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[(namespace, key)] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                (ns, k), (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+                logger.info(f"[Cache EVICT] {ns} {k} ({evicted_size} bytes)")
+
+    def invalidate(self, namespace: str, key: Optional[str] = None):
+        """失效单个键；不传 key 时失效整个命名空间"""
+        with self._lock:
+            if key is not None:
+                item = self._entries.pop((namespace, key), None)
+                if item is not None:
+                    self._bytes -= item[1]
+                return
+            for entry_key in [k for k in self._entries if k[0] == namespace]:
+                self._bytes -= self._entries.pop(entry_key)[1]
+
+    def clear(self):
+        """清空所有命名空间"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """返回缓存规模统计"""
+        with self._lock:
+            namespaces: dict[str, dict] = {}
+            for (ns, _), (_, size) in self._entries.items():
+                info = namespaces.setdefault(ns, {"entries": 0, "bytes": 0})
+                info["entries"] += 1
+                info["bytes"] += size
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+                "namespaces": namespaces,
+            }
+
+
+class SingleFlight:
+    """
+    合并同一键上的并发请求。
+
+    第一个调用者发起真正的请求，其余并发调用者等待同一个 Task 的结果，
+    避免缓存尚未写入时重复请求同一文件。
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None and not task.done():
+            self.coalesced += 1
+            logger.info(f"[SingleFlight] 合并请求: {key}")
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.executed += 1
+        # shield: 单个调用者被取消时不影响其他等待者
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self._inflight),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,58 @@
+# 启动预热：并发预取所有 M3 记忆文件到缓存
+# 使第一次 /chat 的工具调用也能直接命中缓存
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from src.storage.sphere_storage import get_sphere_storage
+
+logger = logging.getLogger(__name__)
+
+# 预热进度（供 /health 展示）
+_WARMUP_STATUS = {
+    "state": "idle",        # idle / running / done / failed
+    "total": 0,
+    "done": 0,
+    "failed": 0,
+    "duration": None,       # 秒
+}
+
+_warmup_task: Optional[asyncio.Task] = None
+
+
+async def warm_up_memory_cache(concurrency: int) -> dict:
+    """列出记忆目录并以有限并发预取全部文件内容"""
+    start = time.time()
+    _WARMUP_STATUS.update(state="running", total=0, done=0, failed=0, duration=None)
+    storage = get_sphere_storage()
+    try:
+        files = await storage.list_memory_files()
+        _WARMUP_STATUS["total"] = len(files)
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def prefetch(filename: str):
+            async with semaphore:
+                content = await storage.read_memory_file(filename)
+                _WARMUP_STATUS["done" if content is not None else "failed"] += 1
+
+        await asyncio.gather(*[prefetch(f) for f in files])
+        _WARMUP_STATUS["state"] = "done"
+    except Exception as e:
+        logger.error(f"[Warmup] 缓存预热失败: {e}")
+        _WARMUP_STATUS["state"] = "failed"
+    _WARMUP_STATUS["duration"] = round(time.time() - start, 3)
+    logger.info(f"[Warmup] 缓存预热结束: {get_warmup_status()}")
+    return get_warmup_status()
+
+
+def start_cache_warmup(concurrency: int):
+    """在后台启动预热，不阻塞应用启动"""
+    global _warmup_task
+    if _warmup_task is None or _warmup_task.done():
+        _warmup_task = asyncio.create_task(warm_up_memory_cache(concurrency))
+
+
+def get_warmup_status() -> dict:
+    return dict(_WARMUP_STATUS)
@@ -0,0 +1,168 @@
+# 本地磁盘缓存层
+# 位于内存 LRU 之下，用 SQLite 保存 WebDAV 内容及其 ETag，进程重启后仍可命中
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from src.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DiskEntry:
+    content: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class DiskCache:
+    """
+    SQLite 持久化缓存。
+
+    - 键为 (namespace, key)，与内存缓存一致
+    - 总大小超过 max_bytes 时按最近访问时间淘汰
+    - 所有方法都是同步的，调用方通过 asyncio.to_thread 使用
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    size INTEGER NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            self._conn.commit()
+            self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self._evictions = 0
+        logger.info(f"[DiskCache] 已打开 {path} ({self._bytes} bytes)")
+
+    def get(self, namespace: str, key: str) -> Optional[DiskEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, etag, last_modified FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, key)
+            )
+            self._conn.commit()
+            return DiskEntry(*row)
+
+    def put(self, namespace: str, key: str, content: str, etag: Optional[str], last_modified: Optional[str]):
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, key, content, etag, last_modified, size, time.time())
+            )
+            self._bytes += size - (old[0] if old else 0)
+            self._evict_locked()
+            self._conn.commit()
+
+    def delete(self, namespace: str, key: Optional[str] = None):
+        with self._lock:
+            if key is None:
+                self._conn.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+            else:
+                self._conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+            self._conn.commit()
+            self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _evict_locked(self):
+        """按最近访问时间淘汰，直到回到预算以内"""
+        while self._bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT namespace, key, size FROM entries ORDER BY accessed_at LIMIT 32"
+            ).fetchall()
+            if not rows:
+                break
+            for namespace, key, size in rows:
+                if self._bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+                self._bytes -= size
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "path": self.path,
+            "entries": count,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self._evictions,
+        }
+
+
+_disk_cache: Optional[DiskCache] = None
+_disk_cache_failed = False
+
+
+def get_disk_cache() -> Optional[DiskCache]:
+    """获取磁盘缓存单例；未配置路径或打开失败时返回 None"""
+    global _disk_cache, _disk_cache_failed
+    if _disk_cache is None and not _disk_cache_failed and settings.WEBDAV_DISK_CACHE_PATH:
+        try:
+            _disk_cache = DiskCache(settings.WEBDAV_DISK_CACHE_PATH, settings.WEBDAV_DISK_CACHE_MAX_BYTES)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"[DiskCache] 无法打开磁盘缓存，仅使用内存缓存: {e}")
+            _disk_cache_failed = True
+    return _disk_cache
+
+
+_summary_cache: Optional[DiskCache] = None
+_summary_cache_failed = False
+
+
+def get_summary_cache() -> Optional[DiskCache]:
+    """
+    归档块摘要的磁盘缓存单例。
+    使用独立的 SQLite 文件和字节预算，大量摘要不会挤掉 WebDAV 文件缓存中的记忆文件。
+    """
+    global _summary_cache, _summary_cache_failed
+    if _summary_cache is None and not _summary_cache_failed and settings.ARCHIVE_SUMMARY_CACHE_PATH:
+        try:
+            _summary_cache = DiskCache(settings.ARCHIVE_SUMMARY_CACHE_PATH, settings.ARCHIVE_SUMMARY_CACHE_MAX_BYTES)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"[DiskCache] 无法打开摘要缓存，仅使用内存缓存: {e}")
+            _summary_cache_failed = True
+    return _summary_cache
+
+
+def get_disk_cache_stats() -> Optional[dict]:
+    """返回磁盘缓存统计（尚未打开时不会触发创建）"""
+    return _disk_cache.stats() if _disk_cache is not None else None
+
+
+def get_summary_cache_stats() -> Optional[dict]:
+    """返回摘要缓存统计（尚未打开时不会触发创建）"""
+    return _summary_cache.stats() if _summary_cache is not None else None
@@ -1,146 +1,444 @@
 # InfiniCloud 存储适配器
 # 用于读写长期记忆文件
 
+import asyncio
 import os
 import re
 import logging
 import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Tuple
+from email.utils import formatdate
+from typing import Callable, Optional
+from urllib.parse import unquote
 import httpx
 
+from src.storage.cache import LRUByteCache, SingleFlight
+from src.storage.disk_cache import get_disk_cache, get_disk_cache_stats
+from src.storage.webdav_pool import get_webdav_client
+from src.utils.config import settings
+
 logger = logging.getLogger(__name__)
 
 # ===== 内存缓存 =====
-# 缓存格式: {key: (content, timestamp)}
-_MEMORY_CACHE: dict[str, Tuple[str, float]] = {}
-_FILE_LIST_CACHE: Tuple[list[str], float] = ([], 0)
+# 文件内容缓存保存 ETag / Last-Modified 校验器，过了新鲜期后用条件请求向服务器确认
+@dataclass
+class CacheEntry:
+    content: str
+    timestamp: float                     # 最近一次确认与服务器一致的时间
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+@dataclass
+class FileEntry:
+    """PROPFIND 返回的文件元数据"""
+    name: str
+    size: int = 0
+    last_modified: Optional[str] = None  # HTTP-date 格式
+    etag: Optional[str] = None
+
+
+# 只请求需要的属性，避免服务器返回全部 allprop
+PROPFIND_BODY = b"""<?xml version="1.0" encoding="utf-8"?>
+<D:propfind xmlns:D="DAV:">
+  <D:prop>
+    <D:resourcetype/>
+    <D:getcontentlength/>
+    <D:getlastmodified/>
+    <D:getetag/>
+  </D:prop>
+</D:propfind>"""
+
+DAV_NS = "{DAV:}"
+
+
+def _parse_propfind_response(elem: ET.Element) -> Optional[FileEntry]:
+    """把一个 <D:response> 元素解析为 FileEntry，目录返回 None"""
+    href = elem.findtext(f"{DAV_NS}href") or ""
+    if href.endswith("/") or elem.find(f".//{DAV_NS}collection") is not None:
+        return None
+    name = unquote(href.rsplit("/", 1)[-1])
+    if not name:
+        return None
+    length = elem.findtext(f".//{DAV_NS}getcontentlength")
+    return FileEntry(
+        name=name,
+        size=int(length) if length and length.strip().isdigit() else 0,
+        last_modified=(elem.findtext(f".//{DAV_NS}getlastmodified") or "").strip() or None,
+        etag=(elem.findtext(f".//{DAV_NS}getetag") or "").strip() or None,
+    )
+
+
+# 所有实例共享一个按字节预算淘汰的 LRU 缓存，命名空间为 base_url + 目录
+_CACHE = LRUByteCache(settings.WEBDAV_CACHE_MAX_BYTES)
+LIST_CACHE_KEY = "list"
+
+# 进行中的读取请求，键为 (命名空间, 缓存键)
+_INFLIGHT = SingleFlight()
+
+# 缓存命中统计
+# hit: 新鲜期内直接命中; revalidated: 条件请求返回 304; miss: 下载了完整内容
+# disk_hit: 内存未命中但本地磁盘缓存命中（之后在后台重新校验）
+_CACHE_STATS = {"hit": 0, "revalidated": 0, "miss": 0, "disk_hit": 0}
+
+# 文件变更回调: (filename, content, etag)，content 为 None 表示文件已删除
+ChangeListener = Callable[[str, Optional[str], Optional[str]], None]
+
+# 后台重新校验任务（保留引用，防止被垃圾回收）
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
 
 # 缓存有效期（秒）
-CACHE_TTL_FILE = 300      # 文件内容缓存 5 分钟
+# 文件内容新鲜期，超过后发条件请求重新校验。Obsidian 中的外部修改由目录列表的 ETag 对比
+# （read_file 的 expected_etag）发现：与列表 ETag 不一致的内存/磁盘条目不会直接返回
+CACHE_FRESH_FILE = 300
 CACHE_TTL_LIST = 60       # 文件列表缓存 1 分钟
 
 
-def get_cached(key: str, ttl: int) -> Optional[str]:
-    """获取缓存内容，过期返回 None"""
-    if key in _MEMORY_CACHE:
-        content, ts = _MEMORY_CACHE[key]
-        if time.time() - ts < ttl:
-            logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache HIT] {key}")
-            return content
+def get_entry(namespace: str, key: str) -> Optional[CacheEntry]:
+    """获取缓存条目（不论是否新鲜）"""
+    return _CACHE.get(namespace, key)
+
+
+def get_cached(namespace: str, key: str, ttl: int) -> Optional[str]:
+    """获取新鲜期内的缓存内容，过期返回 None"""
+    entry = _CACHE.get(namespace, key)
+    if entry and time.time() - entry.timestamp < ttl:
+        logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache HIT] {key}")
+        return entry.content
     return None
 
 
-def set_cache(key: str, content: str):
-    """设置缓存"""
-    _MEMORY_CACHE[key] = (content, time.time())
-    logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache SET] {key} ({len(content)} chars)")
+def set_cache(namespace: str, key: str, content: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+    """设置缓存（按 UTF-8 字节数计入预算）"""
+    entry = CacheEntry(content, time.time(), etag, last_modified)
+    _CACHE.set(namespace, key, entry, len(content.encode("utf-8")))
+    logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache SET] {key} ({len(content)} chars, etag={etag})")
 
 
-def clear_cache(key: str = None):
-    """清除缓存（单个或全部）"""
-    global _MEMORY_CACHE, _FILE_LIST_CACHE
-    if key:
-        _MEMORY_CACHE.pop(key, None)
+def clear_cache(namespace: Optional[str] = None, key: Optional[str] = None):
+    """清除缓存：指定键、整个命名空间或全部"""
+    if namespace is None:
+        _CACHE.clear()
     else:
-        _MEMORY_CACHE.clear()
-        _FILE_LIST_CACHE = ([], 0)
-    logger.info(f"[Cache CLEAR] {key or 'ALL'}")
+        _CACHE.invalidate(namespace, key)
+    logger.info(f"[Cache CLEAR] {namespace or 'ALL'} {key or ''}")
+
+
+async def _disk_put(namespace: str, key: str, content: str, etag: Optional[str], last_modified: Optional[str]):
+    """写入磁盘缓存层（在线程池中执行，失败不影响主流程）"""
+    disk = get_disk_cache()
+    if disk is None:
+        return
+    try:
+        await asyncio.to_thread(disk.put, namespace, key, content, etag, last_modified)
+    except Exception as e:
+        logger.warning(f"[DiskCache] 写入失败 {key}: {e}")
+
+
+async def _disk_delete(namespace: str, key: str):
+    """从磁盘缓存层删除条目"""
+    disk = get_disk_cache()
+    if disk is None:
+        return
+    try:
+        await asyncio.to_thread(disk.delete, namespace, key)
+    except Exception as e:
+        logger.warning(f"[DiskCache] 删除失败 {key}: {e}")
+
+
+def _same_etag(a: Optional[str], b: Optional[str]) -> bool:
+    """比较两个 ETag（忽略弱校验前缀 W/ 和引号，PROPFIND 与 GET 返回的格式可能不同）"""
+    def normalize(etag: str) -> str:
+        etag = etag.strip()
+        if etag.startswith("W/"):
+            etag = etag[2:]
+        return etag.strip('"')
+    return a is not None and b is not None and normalize(a) == normalize(b)
+
+
+def get_cache_stats() -> dict:
+    """返回缓存命中统计与占用情况"""
+    return {
+        **_CACHE_STATS,
+        "coalesced": _INFLIGHT.coalesced,
+        **_CACHE.stats(),
+        "disk": get_disk_cache_stats(),
+    }
 
 
 class InfiniCloudStorage:
     """
     InfiniCloud WebDAV 存储适配器。
     使用 httpx 进行 HTTP 请求，支持中文文件名。
+    所有实例共用 webdav_pool 中的连接池，避免每次请求重新握手。
     """
     
-    def __init__(self, base_url: str, username: str, password: str, memory_dir: str = "/obsidian/mem"):
+    def __init__(
+        self,
+        base_url: str,
+        username: str,
+        password: str,
+        memory_dir: str = "/obsidian/mem",
+        disk_cache: bool = False
+    ):
         self.base_url = base_url.rstrip("/")
         self.auth = (username, password)
         self.memory_dir = memory_dir  # 从配置传入
+        self.namespace = f"{self.base_url}{self.memory_dir}"  # 缓存命名空间
+        # 是否使用磁盘缓存层。磁盘副本在重启后先返回再校验，只适合记忆文件；
+        # 会话快照、日志和增量整理状态会在读到的内容上继续追加/压缩，必须读服务器上的最新版本
+        self.disk_cache = disk_cache
+        self._listeners: list[ChangeListener] = []
+    
+    def add_change_listener(self, listener: ChangeListener):
+        """注册文件变更回调（写入、删除、读取到新内容时触发）"""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+    
+    def _notify(self, filename: str, content: Optional[str], etag: Optional[str]):
+        for listener in self._listeners:
+            try:
+                listener(filename, content, etag)
+            except Exception as e:
+                logger.error(f"文件变更回调失败 {filename}: {e}")
     
     def _get_url(self, filename: str) -> str:
         return f"{self.base_url}{self.memory_dir}/{filename}"
     
-    async def list_files(self) -> list[str]:
-        """列出所有记忆文件（带缓存）"""
-        global _FILE_LIST_CACHE
+    async def list_files(self, suffix: str = ".md") -> list[str]:
+        """列出目录下指定后缀的文件名（带缓存）"""
+        return [e.name for e in await self.list_entries(suffix)]
+    
+    async def list_entries(self, suffix: Optional[str] = ".md") -> list[FileEntry]:
+        """
+        列出目录下的文件及元数据（大小、修改时间、ETag，带缓存）。
         
+        一次 PROPFIND 即可拿到全部元数据，无需逐个下载文件。
+        suffix 为 None 时返回所有文件。
+        """
         # 检查缓存
-        cached_files, cached_ts = _FILE_LIST_CACHE
-        if cached_files and time.time() - cached_ts < CACHE_TTL_LIST:
-            logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache HIT] file_list ({len(cached_files)} files)")
-            return cached_files
-        
-        from urllib.parse import unquote
+        cached = _CACHE.get(self.namespace, LIST_CACHE_KEY)
+        cached_entries, cached_ts = cached if cached else ([], 0)
+        if cached_entries and time.time() - cached_ts < CACHE_TTL_LIST:
+            logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache HIT] file_list {self.memory_dir} ({len(cached_entries)} files)")
+            entries = cached_entries
+        else:
+            entries = await _INFLIGHT.do(
+                (self.namespace, LIST_CACHE_KEY),
+                lambda: self._fetch_file_list(cached_entries)
+            )
+        if suffix is None:
+            return list(entries)
+        return [e for e in entries if e.name.lower().endswith(suffix)]
+    
+    async def _fetch_file_list(self, cached_entries: list[FileEntry]) -> list[FileEntry]:
+        """发起 PROPFIND 列出目录（由 SingleFlight 合并并发调用）"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.request(
-                    "PROPFIND",
-                    f"{self.base_url}{self.memory_dir}/",
-                    auth=self.auth,
-                    headers={"Depth": "1"}
-                )
-                # 解析 WebDAV XML 响应，大小写不敏感，解码 URL
-                matches = re.findall(r'<D:href>.*?/([^/]+\.md)</D:href>', response.text, re.IGNORECASE)
-                files = [unquote(f) for f in matches]
-                
-                # 更新缓存
-                _FILE_LIST_CACHE = (files, time.time())
-                logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache SET] file_list ({len(files)} files)")
-                return files
+            client = get_webdav_client()
+            entries = []
+            # 流式解析 multistatus，每解析完一个 <D:response> 即释放
+            parser = ET.XMLPullParser(events=("end",))
+            async with client.stream(
+                "PROPFIND",
+                f"{self.base_url}{self.memory_dir}/",
+                auth=self.auth,
+                content=PROPFIND_BODY,
+                headers={"Depth": "1", "Content-Type": "application/xml; charset=utf-8"}
+            ) as response:
+                if response.status_code != 207:
+                    raise RuntimeError(f"PROPFIND 返回异常状态 {response.status_code}")
+                async for chunk in response.aiter_bytes():
+                    parser.feed(chunk)
+                    for _, elem in parser.read_events():
+                        if elem.tag == f"{DAV_NS}response":
+                            entry = _parse_propfind_response(elem)
+                            if entry:
+                                entries.append(entry)
+                            elem.clear()
+            parser.close()
+            
+            # 更新缓存
+            size = sum(len(e.name.encode("utf-8")) + len(e.etag or "") + 64 for e in entries)
+            _CACHE.set(self.namespace, LIST_CACHE_KEY, (entries, time.time()), size)
+            logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache SET] file_list {self.memory_dir} ({len(entries)} files)")
+            return entries
         except Exception as e:
             logger.error(f"列出文件失败: {e}")
-            return cached_files if cached_files else []  # 失败时返回旧缓存
+            return cached_entries  # 失败时返回旧缓存
+    
+    def cached_etag(self, filename: str) -> Optional[str]:
+        """最近一次读取/写入该文件时得到的 ETag（来自缓存，不发请求）"""
+        entry = get_entry(self.namespace, f"file:{filename}")
+        return entry.etag if entry else None
     
-    async def read_file(self, filename: str) -> Optional[str]:
-        """读取记忆文件内容（带缓存）"""
+    async def listed_etag(self, filename: str) -> Optional[str]:
+        """目录列表（PROPFIND，缓存 CACHE_TTL_LIST 秒）中该文件的 ETag，不在列表中返回 None"""
+        for entry in await self.list_entries(None):
+            if entry.name == filename:
+                return entry.etag
+        return None
+    
+    async def read_file(
+        self,
+        filename: str,
+        expected_etag: Optional[str] = None,
+        revalidate: bool = False
+    ) -> Optional[str]:
+        """
+        读取记忆文件内容（带校验缓存）。
+        
+        新鲜期内直接返回缓存；过期后携带 If-None-Match / If-Modified-Since
+        发起条件请求，文件未变时服务器返回 304，不再重复下载正文。
+        expected_etag: 调用方已知的最新 ETag（如来自目录列表），内存或磁盘缓存与之不一致时不直接使用。
+        revalidate: 跳过新鲜期和磁盘层，总是向服务器确认（读-改-写之前使用）。
+        """
         cache_key = f"file:{filename}"
         
         # 检查缓存
-        cached = get_cached(cache_key, CACHE_TTL_FILE)
-        if cached is not None:
-            return cached
+        if not revalidate:
+            cached = get_cached(self.namespace, cache_key, CACHE_FRESH_FILE)
+            entry = get_entry(self.namespace, cache_key)
+            if cached is not None and expected_etag is not None and not _same_etag(entry.etag, expected_etag):
+                cached = None
+            if cached is not None:
+                _CACHE_STATS["hit"] += 1
+                return cached
+        
+        # 期望的 ETag 不同的调用不能共享结果（其中一方可能拿到磁盘上的旧副本）
+        return await _INFLIGHT.do(
+            (self.namespace, cache_key, expected_etag, revalidate),
+            lambda: self._fetch_file(filename, cache_key, expected_etag, revalidate)
+        )
+    
+    async def _fetch_file(
+        self,
+        filename: str,
+        cache_key: str,
+        expected_etag: Optional[str] = None,
+        revalidate: bool = False
+    ) -> Optional[str]:
+        """内存未命中时读取：先查磁盘缓存层，再发起（条件）GET（由 SingleFlight 合并并发调用）"""
+        entry = get_entry(self.namespace, cache_key)
+        if entry is None and not revalidate and self.disk_cache:
+            disk = get_disk_cache()
+            disk_entry = None
+            if disk is not None:
+                try:
+                    disk_entry = await asyncio.to_thread(disk.get, self.namespace, cache_key)
+                except Exception as e:
+                    logger.warning(f"[DiskCache] 读取失败 {cache_key}: {e}")
+            if disk_entry is not None and expected_etag is not None and not _same_etag(disk_entry.etag, expected_etag):
+                # 本地副本已落后于目录列表，直接下载新内容
+                disk_entry = None
+            if disk_entry is not None:
+                # 重启后的首次读取直接用本地副本，后台再用 ETag 向服务器确认
+                set_cache(self.namespace, cache_key, disk_entry.content, disk_entry.etag, disk_entry.last_modified)
+                _CACHE_STATS["disk_hit"] += 1
+                self._schedule_revalidate(filename, cache_key)
+                return disk_entry.content
+        return await self._conditional_get(filename, cache_key, expected_etag)
+    
+    def _schedule_revalidate(self, filename: str, cache_key: str):
+        """在后台对缓存条目发起条件请求"""
+        task = asyncio.create_task(_INFLIGHT.do(
+            (self.namespace, f"revalidate:{cache_key}"),
+            lambda: self._conditional_get(filename, cache_key)
+        ))
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
+    
+    async def _conditional_get(self, filename: str, cache_key: str, expected_etag: Optional[str] = None) -> Optional[str]:
+        """发起 GET；已有缓存条目时携带校验器，未变则服务器返回 304"""
+        entry = get_entry(self.namespace, cache_key)
+        headers = {}
+        # 缓存条目已知过期时不带校验器，避免 If-Modified-Since 在秒级精度下误判为未修改
+        if entry and (expected_etag is None or _same_etag(entry.etag, expected_etag)):
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    self._get_url(filename),
-                    auth=self.auth
-                )
-                if response.status_code == 200:
-                    content = response.text
-                    # 更新缓存
-                    set_cache(cache_key, content)
-                    return content
-                else:
-                    logger.warning(f"文件不存在: {filename}")
-                    return None
+            client = get_webdav_client()
+            response = await client.get(
+                self._get_url(filename),
+                auth=self.auth,
+                headers=headers
+            )
+            if response.status_code == 304 and entry:
+                # 文件未变，刷新确认时间即可
+                entry.timestamp = time.time()
+                _CACHE_STATS["revalidated"] += 1
+                logger.info(f"[{time.strftime('%H:%M:%S')}] [Cache 304] {cache_key}")
+                return entry.content
+            if response.status_code == 200:
+                content = response.text
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                _CACHE_STATS["miss"] += 1
+                # 更新缓存（内存 + 磁盘）
+                set_cache(self.namespace, cache_key, content, etag=etag, last_modified=last_modified)
+                if self.disk_cache:
+                    await _disk_put(self.namespace, cache_key, content, etag, last_modified)
+                self._notify(filename, content, etag)
+                return content
+            if response.status_code == 404:
+                logger.warning(f"文件不存在: {filename}")
+                clear_cache(self.namespace, cache_key)
+                if self.disk_cache:
+                    await _disk_delete(self.namespace, cache_key)
+                self._notify(filename, None, None)
+                return None
+            logger.warning(f"读取文件异常状态 {response.status_code}: {filename}")
+            return entry.content if entry else None
         except Exception as e:
             logger.error(f"读取文件失败: {e}")
-            return None
+            # 网络异常时返回旧缓存
+            return entry.content if entry else None
     
     async def write_file(self, filename: str, content: str) -> bool:
         """写入记忆文件"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.put(
-                    self._get_url(filename),
-                    auth=self.auth,
-                    content=content.encode("utf-8"),
-                    headers={"Content-Type": "text/markdown; charset=utf-8"}
-                )
-                success = response.status_code in (200, 201, 204)
-                if success:
-                    logger.info(f"文件写入成功: {filename}")
-                    # 更新缓存
-                    cache_key = f"file:{filename}"
-                    set_cache(cache_key, content)
-                return success
+            client = get_webdav_client()
+            response = await client.put(
+                self._get_url(filename),
+                auth=self.auth,
+                content=content.encode("utf-8"),
+                headers={"Content-Type": "text/markdown; charset=utf-8"}
+            )
+            success = response.status_code in (200, 201, 204)
+            if success:
+                logger.info(f"文件写入成功: {filename}")
+                # 更新缓存，保留 PUT 响应中的校验器，之后的重新校验可以走条件请求
+                cache_key = f"file:{filename}"
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                set_cache(self.namespace, cache_key, content, etag, last_modified)
+                if self.disk_cache:
+                    await _disk_put(self.namespace, cache_key, content, etag, last_modified)
+                self._notify(filename, content, etag)
+                self._update_cached_listing(filename, content, etag, last_modified)
+            return success
         except Exception as e:
             logger.error(f"写入文件失败: {e}")
             return False
     
+    def _update_cached_listing(self, filename: str, content: str, etag: Optional[str], last_modified: Optional[str] = None):
+        """写入成功后同步文件列表缓存中的元数据；新建文件则让列表失效"""
+        cached = _CACHE.get(self.namespace, LIST_CACHE_KEY)
+        if not cached:
+            return
+        for entry in cached[0]:
+            if entry.name == filename:
+                entry.size = len(content.encode("utf-8"))
+                entry.etag = etag
+                entry.last_modified = last_modified or formatdate(usegmt=True)
+                return
+        # 新建文件时让文件列表失效，下次列出即可看到
+        clear_cache(self.namespace, LIST_CACHE_KEY)
+    
     async def update_timestamp(self, filename: str) -> bool:
         """更新文件的 last_accessed 时间戳"""
         content = await self.read_file(filename)
@@ -168,19 +466,21 @@ class InfiniCloudStorage:
     async def delete_file(self, filename: str) -> bool:
         """删除记忆文件"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(
-                    self._get_url(filename),
-                    auth=self.auth
-                )
-                success = response.status_code in (200, 204, 404)  # 404也算成功（文件已不存在）
-                if success:
-                    logger.info(f"文件删除成功: {filename}")
-                    # 清除相关缓存
-                    clear_cache(f"file:{filename}")
-                    global _FILE_LIST_CACHE
-                    _FILE_LIST_CACHE = ([], 0)  # 清除文件列表缓存
-                return success
+            client = get_webdav_client()
+            response = await client.delete(
+                self._get_url(filename),
+                auth=self.auth
+            )
+            success = response.status_code in (200, 204, 404)  # 404也算成功（文件已不存在）
+            if success:
+                logger.info(f"文件删除成功: {filename}")
+                # 清除相关缓存
+                clear_cache(self.namespace, f"file:{filename}")
+                if self.disk_cache:
+                    await _disk_delete(self.namespace, f"file:{filename}")
+                self._notify(filename, None, None)
+                clear_cache(self.namespace, LIST_CACHE_KEY)  # 清除本目录的文件列表缓存
+            return success
         except Exception as e:
             logger.error(f"删除文件失败: {e}")
             return False
@@ -193,6 +493,7 @@ def get_infinicloud_storage() -> InfiniCloudStorage:
         base_url=settings.INFINICLOUD_URL or "https://mori.teracloud.jp/dav",
         username=settings.INFINICLOUD_USER or "",
         password=settings.INFINICLOUD_PASS or "",
-        memory_dir=settings.INFINICLOUD_MEMORY_DIR
+        memory_dir=settings.INFINICLOUD_MEMORY_DIR,
+        disk_cache=True
     )
 
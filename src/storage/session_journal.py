@@ -0,0 +1,192 @@
+# 当前会话的追加式日志（journal）
+# 每轮只上传新增消息的 JSONL 分段，定期压缩成完整快照
+
+import asyncio
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from src.storage.infinicloud import InfiniCloudStorage
+
+logger = logging.getLogger(__name__)
+
+# 快照文件名: current_session_2025-01-01.json
+SNAPSHOT_PATTERN = re.compile(r"^current_session_(\d{4}-\d{2}-\d{2})\.json$")
+# 分段文件名: current_session_2025-01-01.00012.jsonl
+SEGMENT_PATTERN = re.compile(r"^current_session_(\d{4}-\d{2}-\d{2})\.(\d+)\.jsonl$")
+
+
+def snapshot_filename(date_str: str) -> str:
+    return f"current_session_{date_str}.json"
+
+
+def segment_filename(date_str: str, seq: int) -> str:
+    return f"current_session_{date_str}.{seq:05d}.jsonl"
+
+
+def encode_segment(messages: list, summary: Optional[str]) -> str:
+    """把新增消息（及变化后的摘要）编码为 JSONL，每行一条记录"""
+    lines = [json.dumps({"type": "message", "message": m}, ensure_ascii=False) for m in messages]
+    if summary is not None:
+        lines.append(json.dumps({"type": "summary", "summary": summary}, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+
+def apply_segment(history: list, summary: str, text: str) -> str:
+    """把分段内容追加到 history（原地修改），返回更新后的摘要"""
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.get("type") == "message":
+            history.append(record["message"])
+        elif record.get("type") == "summary":
+            summary = record.get("summary", "")
+    return summary
+
+
+@dataclass
+class JournalState:
+    """某个逻辑日期已持久化的状态"""
+    history: list = field(default_factory=list)
+    summary: str = ""
+    seq: int = 0                 # 已写入的最大分段序号
+    segments: list = field(default_factory=list)  # 快照之后尚未压缩的分段序号
+
+
+class SessionJournal:
+    """
+    会话日志管理器。
+
+    - 快照 current_session_<date>.json 保持原有格式，额外记录 journal_seq
+    - 之后每次保存只写一个包含新增消息的分段，上传量与当天对话长度无关
+    - 分段数达到 compact_every，或历史被改写（删除/清空）时，写入新快照并删除旧分段
+    - 加载时读取快照，再按序回放 journal_seq 之后的分段
+    """
+
+    def __init__(self, storage: InfiniCloudStorage, compact_every: int):
+        self.storage = storage
+        self.compact_every = compact_every
+        self._states: dict[str, JournalState] = {}
+        self._stats = {"segments_written": 0, "compactions": 0, "segment_bytes": 0, "snapshot_bytes": 0}
+
+    async def save(self, date_str: str, history: list, summary: str) -> bool:
+        """保存会话：能追加时只写分段，否则压缩为快照"""
+        state = self._states.get(date_str)
+        if state is None or history[:len(state.history)] != state.history:
+            # 进程内没有状态，或历史被改写（删除/清空），写完整快照
+            return await self._compact(date_str, history, summary)
+
+        new_messages = history[len(state.history):]
+        summary_changed = summary != state.summary
+        if not new_messages and not summary_changed:
+            return True
+        if len(state.segments) + 1 >= self.compact_every:
+            return await self._compact(date_str, history, summary)
+
+        seq = state.seq + 1
+        content = encode_segment(new_messages, summary if summary_changed else None)
+        success = await self.storage.write_file(segment_filename(date_str, seq), content)
+        if success:
+            state.history = list(history)
+            state.summary = summary
+            state.seq = seq
+            state.segments.append(seq)
+            self._stats["segments_written"] += 1
+            self._stats["segment_bytes"] += len(content.encode("utf-8"))
+            logger.info(f"[SessionJournal] 追加分段 {date_str}#{seq}: {len(new_messages)} 条消息")
+        return success
+
+    async def _compact(self, date_str: str, history: list, summary: str) -> bool:
+        """写入完整快照，并删除已被快照包含的分段"""
+        state = self._states.get(date_str)
+        if state is None:
+            # 进程重启后不知道云端有哪些分段，从目录列表中找出来
+            stale = await self._list_segments(date_str)
+            seq = max(stale, default=0)
+        else:
+            stale = list(state.segments)
+            seq = state.seq
+
+        session_data = {
+            "history": history,
+            "summary": summary,
+            "last_updated": datetime.now().isoformat(),
+            "date": date_str,
+            "logical_date": date_str,  # 明确标记逻辑日期
+            "journal_seq": seq
+        }
+        content = json.dumps(session_data, ensure_ascii=False, indent=2)
+        success = await self.storage.write_file(snapshot_filename(date_str), content)
+        if not success:
+            return False
+
+        self._states[date_str] = JournalState(list(history), summary, seq, [])
+        self._stats["compactions"] += 1
+        self._stats["snapshot_bytes"] += len(content.encode("utf-8"))
+        logger.info(f"[SessionJournal] 压缩快照 {date_str} (seq={seq}, 清理 {len(stale)} 个分段)")
+        for old_seq in stale:
+            await self.storage.delete_file(segment_filename(date_str, old_seq))
+        return True
+
+    async def _list_segments(self, date_str: str) -> list[int]:
+        """列出云端某日期的全部分段序号"""
+        seqs = []
+        for entry in await self.storage.list_entries(".jsonl"):
+            match = SEGMENT_PATTERN.match(entry.name)
+            if match and match.group(1) == date_str:
+                seqs.append(int(match.group(2)))
+        return sorted(seqs)
+
+    async def list_snapshot_dates(self) -> list[str]:
+        """从一次（带缓存的）目录列表中找出所有有快照的逻辑日期"""
+        dates = []
+        for entry in await self.storage.list_entries(".json"):
+            match = SNAPSHOT_PATTERN.match(entry.name)
+            if match:
+                dates.append(match.group(1))
+        return sorted(dates)
+
+    async def load(self, date_str: str) -> Optional[dict]:
+        """从快照 + 后续分段重建某日期的会话，不存在返回 None"""
+        content = await self.storage.read_file(snapshot_filename(date_str))
+        if not content:
+            return None
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as e:
+            logger.error(f"[SessionJournal] 解析快照失败 {date_str}: {e}")
+            return None
+
+        history = list(data.get("history", []))
+        summary = data.get("summary", "")
+        base_seq = data.get("journal_seq", 0)
+
+        tail = [seq for seq in await self._list_segments(date_str) if seq > base_seq]
+        complete = True
+        if tail:
+            texts = await asyncio.gather(*[
+                self.storage.read_file(segment_filename(date_str, seq)) for seq in tail
+            ])
+            for seq, text in zip(tail, texts):
+                if text is None:
+                    logger.warning(f"[SessionJournal] 分段缺失 {date_str}#{seq}，停止回放")
+                    complete = False
+                    break
+                summary = apply_segment(history, summary, text)
+
+        if complete:
+            self._states[date_str] = JournalState(
+                list(history), summary, max(tail, default=base_seq), list(tail)
+            )
+        else:
+            # 回放不完整时不记录状态，下次保存会写完整快照并清理分段
+            self._states.pop(date_str, None)
+        logger.info(f"[SessionJournal] 加载 {date_str}: 快照 + {len(tail)} 个分段, {len(history)} 条消息")
+        return {"history": history, "summary": summary}
+
+    def stats(self) -> dict:
+        return dict(self._stats)
@@ -0,0 +1,165 @@
+# 当前会话的延迟写回（write-behind）
+# 合并同一逻辑日期在短时间内的多次保存，只上传最新快照，且不阻塞 SSE 响应
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 实际上传函数签名: (history, summary, logical_date_str) -> bool
+UploadFn = Callable[[list, str, str], Awaitable[bool]]
+
+
+# 关闭前刷新时的重试间隔基数（秒），不按写回窗口退避，避免拖慢关闭
+FLUSH_RETRY_BASE = 0.5
+
+
+class SessionWriteBehind:
+    """
+    会话快照延迟写回器。
+
+    - schedule(): 记录最新快照并立即返回，窗口期结束后在后台上传
+    - 同一逻辑日期在窗口期内的多次保存只上传最后一次
+    - 每个逻辑日期一把锁，保证上传顺序与快照顺序一致
+    - 上传失败时放回快照（期间没有更新的保存时），按指数退避重试
+    - flush(): 立即上传所有待写快照（应用关闭时调用），返回仍未上传成功的日期
+    """
+
+    def __init__(self, upload: UploadFn, delay: float, max_retries: int = 5, max_backoff: float = 60.0):
+        self._upload = upload
+        self.delay = delay
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        # 待写快照: date -> (generation, history, summary)
+        self._pending: dict[str, tuple[int, list, str]] = {}
+        # 每个日期最近一次保存（延迟或立即）的序号，用来判断失败的快照是否已被取代
+        self._generation: dict[str, int] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._flushing = False
+        self._stats = {
+            "scheduled": 0, "uploaded": 0, "coalesced": 0, "failed": 0, "retried": 0, "last_upload_ms": 0
+        }
+
+    def _lock_for(self, date_str: str) -> asyncio.Lock:
+        if date_str not in self._locks:
+            self._locks[date_str] = asyncio.Lock()
+        return self._locks[date_str]
+
+    def _next_generation(self, date_str: str) -> int:
+        self._generation[date_str] = self._generation.get(date_str, 0) + 1
+        return self._generation[date_str]
+
+    def _backoff(self, attempt: int) -> float:
+        """第 attempt 次失败后的等待时间"""
+        return min(self.delay * (2 ** attempt), self.max_backoff)
+
+    def schedule(self, history: list, summary: str, date_str: str):
+        """登记待写快照，后台延迟上传"""
+        self._stats["scheduled"] += 1
+        if date_str in self._pending:
+            self._stats["coalesced"] += 1
+        self._pending[date_str] = (self._next_generation(date_str), history, summary)
+        if date_str not in self._tasks:
+            self._tasks[date_str] = asyncio.create_task(self._run(date_str))
+
+    def get_pending(self, date_str: str) -> Optional[dict]:
+        """返回尚未上传的最新快照（包括上传失败等待重试的快照）"""
+        snapshot = self._pending.get(date_str)
+        if snapshot is None:
+            return None
+        return {"history": snapshot[1], "summary": snapshot[2]}
+
+    def discard(self, date_str: str):
+        """丢弃待写快照（会话被清空或被直接覆盖时）"""
+        self._pending.pop(date_str, None)
+
+    async def write_now(self, history: list, summary: str, date_str: str) -> bool:
+        """立即写入，并丢弃同日期更旧的待写快照"""
+        self.discard(date_str)
+        self._next_generation(date_str)
+        async with self._lock_for(date_str):
+            return await self._upload(history, summary, date_str)
+
+    async def _run(self, date_str: str):
+        """窗口期到达后上传最新快照；上传期间又有新快照则继续下一轮，失败时退避重试"""
+        attempt = 0
+        try:
+            await asyncio.sleep(self.delay)
+            while date_str in self._pending and not self._flushing:
+                if await self._upload_pending(date_str):
+                    attempt = 0
+                    if date_str in self._pending:
+                        await asyncio.sleep(self.delay)
+                    continue
+                if attempt >= self.max_retries:
+                    # 快照仍保留在待写队列中，下一次保存或关闭时的 flush 会再次尝试
+                    logger.error(f"[SessionWriter] {date_str} 连续 {attempt + 1} 次上传失败，暂停重试")
+                    break
+                self._stats["retried"] += 1
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._tasks.pop(date_str, None)
+
+    async def _upload_pending(self, date_str: str) -> bool:
+        """上传该日期的待写快照，失败时放回队列（期间没有更新的保存时）；没有待写快照视为成功"""
+        async with self._lock_for(date_str):
+            snapshot = self._pending.pop(date_str, None)
+            if snapshot is None:
+                return True
+            generation, history, summary = snapshot
+            start = time.time()
+            success = False
+            try:
+                success = await self._upload(history, summary, date_str)
+            except Exception as e:
+                logger.error(f"[SessionWriter] 上传失败: {date_str}: {e}")
+            finally:
+                # 被取消时同样放回快照
+                self._stats["last_upload_ms"] = int((time.time() - start) * 1000)
+                self._stats["uploaded" if success else "failed"] += 1
+                if not success and date_str not in self._pending and self._generation.get(date_str) == generation:
+                    self._pending[date_str] = snapshot
+            return success
+
+    async def flush(self, retries: int = 2) -> list[str]:
+        """
+        立即上传所有待写快照，并结束后台计时任务。
+        每个快照最多重试 retries 次，返回仍未上传成功的逻辑日期（快照保留在待写队列中）。
+        """
+        # 先停止后台计时：等待正在进行的上传完成，再取消剩余的等待，避免与这里的重试交错
+        self._flushing = True
+        try:
+            for lock in list(self._locks.values()):
+                async with lock:
+                    pass
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._flushing = False
+
+        failed = []
+        for date_str in list(self._pending):
+            for attempt in range(retries + 1):
+                if await self._upload_pending(date_str):
+                    break
+                if attempt < retries:
+                    self._stats["retried"] += 1
+                    await asyncio.sleep(FLUSH_RETRY_BASE * (2 ** attempt))
+            else:
+                failed.append(date_str)
+        if failed:
+            logger.error(f"[SessionWriter] 刷新后仍有会话未上传: {failed}")
+        logger.info(f"[SessionWriter] 已刷新所有待写会话 {self.stats()}")
+        return failed
+
+    def stats(self) -> dict:
+        return {**self._stats, "pending": len(self._pending)}
@@ -4,15 +4,43 @@
 import json
 import logging
 import os
+import uuid
+from dataclasses import dataclass, field
 from datetime import datetime, date, timedelta
-from typing import Optional
+from typing import Callable, Optional
 
-from src.storage.infinicloud import InfiniCloudStorage
+from src.storage.infinicloud import InfiniCloudStorage, FileEntry
+from src.storage.session_journal import SessionJournal
+from src.storage.session_writer import SessionWriteBehind
 from src.utils.date_helper import get_current_logical_date, format_logical_date
 from src.utils.config import settings
 
 logger = logging.getLogger(__name__)
 
+# 当前逻辑日期没有会话时，最多回溯多少天加载最近的会话
+SESSION_LOOKBACK_DAYS = 7
+
+# 会话变更回调签名: (logical_date_str, history) -> None
+SessionListener = Callable[[str, list], None]
+
+
+def consolidation_filename(date_str: str) -> str:
+    """日内增量整理状态文件名（与会话快照同目录）"""
+    return f"consolidation_{date_str}.json"
+
+
+@dataclass
+class SessionState:
+    """
+    服务端持有的当前会话（规范历史）。
+    session_id 在进程内加载会话时生成，重启或逻辑日期切换后变化；version 每次历史或摘要变化时 +1。
+    """
+    session_id: str
+    version: int = 0
+    history: list = field(default_factory=list)
+    summary: str = ""
+    date_str: str = ""  # 所属逻辑日期
+
 
 class SphereStorage:
     """
@@ -29,10 +57,10 @@ class SphereStorage:
         self.username = settings.INFINICLOUD_USER or ""
         self.password = settings.INFINICLOUD_PASS or ""
         
-        # 创建不同用途的存储实例
+        # 创建不同用途的存储实例（只有记忆文件使用磁盘缓存层）
         self.memory_storage = InfiniCloudStorage(
             self.base_url, self.username, self.password, 
-            settings.INFINICLOUD_MEMORY_DIR
+            settings.INFINICLOUD_MEMORY_DIR, disk_cache=True
         )
         self.sessions_storage = InfiniCloudStorage(
             self.base_url, self.username, self.password,
@@ -42,6 +70,24 @@ class SphereStorage:
             self.base_url, self.username, self.password,
             settings.INFINICLOUD_CURRENT_DIR
         )
+        
+        # 当前对话的追加式日志（每轮只上传新增消息）
+        self.journal = SessionJournal(
+            self.current_storage, settings.SESSION_JOURNAL_COMPACT_EVERY
+        )
+        
+        # 最近一次有会话记录的逻辑日期（由保存操作维护，避免逐日探测）
+        self._latest_session_date: Optional[str] = None
+        
+        # 服务端会话状态（会话模式下客户端只上传新消息）
+        self._session_state: Optional[SessionState] = None
+        self._session_listeners: list[SessionListener] = []
+        
+        # 当前对话的延迟写回器（合并短时间内的多次保存）
+        self.session_writer = SessionWriteBehind(
+            self._write_current_session, settings.SESSION_SAVE_DELAY,
+            settings.SESSION_SAVE_MAX_RETRIES, settings.SESSION_SAVE_MAX_BACKOFF
+        )
     
     # ===== 记忆文件管理 (M3) =====
     
@@ -49,9 +95,30 @@ class SphereStorage:
         """列出所有长期记忆文件"""
         return await self.memory_storage.list_files()
     
-    async def read_memory_file(self, filename: str) -> Optional[str]:
-        """读取记忆文件内容"""
-        return await self.memory_storage.read_file(filename)
+    async def list_memory_entries(self) -> list[FileEntry]:
+        """列出长期记忆文件及元数据（一次 PROPFIND）"""
+        return await self.memory_storage.list_entries()
+    
+    async def read_memory_file(
+        self,
+        filename: str,
+        expected_etag: Optional[str] = None,
+        revalidate: bool = False
+    ) -> Optional[str]:
+        """
+        读取记忆文件内容。
+        
+        未给出 expected_etag 时取目录列表中的 ETag，使 Obsidian 中的外部修改
+        最迟在列表缓存过期后被发现，而不是等文件内容的新鲜期结束。
+        revalidate: 总是向服务器确认（修改并写回文件前使用）。
+        """
+        if expected_etag is None and not revalidate:
+            expected_etag = await self.memory_storage.listed_etag(filename)
+        return await self.memory_storage.read_file(filename, expected_etag, revalidate)
+    
+    def memory_file_etag(self, filename: str) -> Optional[str]:
+        """最近一次读取记忆文件得到的 ETag"""
+        return self.memory_storage.cached_etag(filename)
     
     async def write_memory_file(self, filename: str, content: str) -> bool:
         """写入记忆文件"""
@@ -78,79 +145,145 @@ class SphereStorage:
     # ===== 当前对话管理 =====
     
     async def save_current_session(self, history: list, summary: str) -> bool:
-        """保存当前对话到云端"""
-        logical_date = get_current_logical_date()
-        session_data = {
-            "history": history,
-            "summary": summary,
-            "last_updated": datetime.now().isoformat(),
-            "date": format_logical_date(logical_date),
-            "logical_date": format_logical_date(logical_date)  # 明确标记逻辑日期
-        }
-        
-        content = json.dumps(session_data, ensure_ascii=False, indent=2)
-        filename = f"current_session_{format_logical_date(logical_date)}.json"
-        
-        success = await self.current_storage.write_file(filename, content)
+        """立即保存当前对话到云端（会丢弃同日期尚未上传的旧快照）"""
+        date_str = format_logical_date(get_current_logical_date())
+        self._set_session_state(history, summary)
+        return await self.session_writer.write_now(history, summary, date_str)
+    
+    def schedule_save_current_session(self, history: list, summary: str):
+        """登记当前对话快照，由后台延迟上传（不阻塞调用方）"""
+        date_str = format_logical_date(get_current_logical_date())
+        self._set_session_state(history, summary)
+        self.session_writer.schedule(history, summary, date_str)
+    
+    def _set_session_state(self, history: list, summary: str):
+        """所有保存路径都经过这里，保证服务端状态与云端一致"""
+        date_str = format_logical_date(get_current_logical_date())
+        if self._session_state is None or self._session_state.date_str != date_str:
+            # 跨过逻辑日期后换新的 session_id，基于前一天状态的增量请求会被要求重新同步
+            self._session_state = SessionState(uuid.uuid4().hex, date_str=date_str)
+        state = self._session_state
+        if state.history == history and state.summary == summary:
+            return
+        state.history = list(history)
+        state.summary = summary
+        state.version += 1
+        for listener in self._session_listeners:
+            try:
+                listener(date_str, state.history)
+            except Exception as e:
+                logger.error(f"[SphereStorage] 会话变更回调失败: {e}")
+    
+    def add_session_listener(self, listener: SessionListener):
+        """注册会话变更回调（每次历史或摘要变化时触发，幂等）"""
+        if listener not in self._session_listeners:
+            self._session_listeners.append(listener)
+    
+    async def get_session_state(self) -> SessionState:
+        """获取服务端会话状态，首次访问或逻辑日期切换后从云端重新加载"""
+        date_str = format_logical_date(get_current_logical_date())
+        state = self._session_state
+        if state is None or state.date_str != date_str:
+            data = await self.load_current_session()
+            if self._session_state is state:
+                self._session_state = SessionState(
+                    uuid.uuid4().hex, 1, list(data.get("history", [])), data.get("summary", ""), date_str
+                )
+        return self._session_state
+    
+    def append_session_messages(self, messages: list, persist: bool = True) -> SessionState:
+        """
+        把本轮新增消息追加到服务端会话（需先调用 get_session_state），persist 时延迟写回云端。
+        返回追加后的状态；追加时跨过了逻辑日期则是新的会话对象。
+        """
+        state = self._session_state
+        history = state.history + list(messages)
+        if persist:
+            self.schedule_save_current_session(history, state.summary)
+        else:
+            self._set_session_state(history, state.summary)
+        return self._session_state
+    
+    async def flush_pending_sessions(self) -> list[str]:
+        """立即上传所有待写的会话快照（应用关闭时调用），返回上传失败的逻辑日期"""
+        return await self.session_writer.flush()
+    
+    async def _write_current_session(self, history: list, summary: str, date_str: str) -> bool:
+        """把会话写入指定逻辑日期的日志（追加分段或压缩快照）"""
+        success = await self.journal.save(date_str, history, summary)
         if success:
-            logger.info(f"[SphereStorage] 当前对话已保存到云端: {filename} (逻辑日期)")
+            if self._latest_session_date is None or date_str > self._latest_session_date:
+                self._latest_session_date = date_str
+            logger.info(f"[SphereStorage] 当前对话已保存到云端: {date_str} (逻辑日期)")
         return success
     
-    async def load_current_session(self) -> dict:
-        """从云端加载当前对话"""
+    async def load_session_for_date(self, date_str: str) -> Optional[dict]:
+        """加载指定逻辑日期的会话（快照 + 日志分段），不存在返回 None"""
+        pending = self.session_writer.get_pending(date_str)
+        if pending is not None:
+            return pending
+        return await self.journal.load(date_str)
+    
+    async def resolve_latest_session_date(self) -> Optional[str]:
+        """
+        找出最近 SESSION_LOOKBACK_DAYS 天内最新的会话日期。
+        
+        优先使用内存指针；否则从一次目录列表中选出最新的快照，不再逐日探测。
+        """
         logical_date = get_current_logical_date()
+        today_str = format_logical_date(logical_date)
+        earliest_str = format_logical_date(logical_date - timedelta(days=SESSION_LOOKBACK_DAYS))
         
-        # 首先尝试加载当前逻辑日期的session
-        filename = f"current_session_{format_logical_date(logical_date)}.json"
-        content = await self.current_storage.read_file(filename)
+        if self.session_writer.get_pending(today_str) is not None:
+            return today_str
         
-        if content:
-            try:
-                data = json.loads(content)
-                logger.info(f"[SphereStorage] 从云端加载当前对话: {filename} (逻辑日期)")
-                return {
-                    "history": data.get("history", []),
-                    "summary": data.get("summary", "")
-                }
-            except json.JSONDecodeError as e:
-                logger.error(f"[SphereStorage] 解析当前对话失败: {e}")
+        if self._latest_session_date is None:
+            dates = [d for d in await self.journal.list_snapshot_dates() if d <= today_str]
+            self._latest_session_date = dates[-1] if dates else None
         
-        # 如果当前逻辑日期没有session，尝试加载最近几天的session
-        logger.info("[SphereStorage] 当前逻辑日期没有对话记录，尝试加载最近的session...")
-        for days_back in range(1, 8):  # 尝试最近7天
-            past_logical_date = logical_date - timedelta(days=days_back)
-            past_filename = f"current_session_{format_logical_date(past_logical_date)}.json"
-            past_content = await self.current_storage.read_file(past_filename)
-            
-            if past_content:
-                try:
-                    data = json.loads(past_content)
-                    logger.info(f"[SphereStorage] 从云端加载历史对话: {past_filename} (逻辑日期)")
-                    return {
-                        "history": data.get("history", []),
-                        "summary": data.get("summary", "")
-                    }
-                except json.JSONDecodeError as e:
-                    logger.error(f"[SphereStorage] 解析历史对话失败: {e}")
-                    continue
+        latest = self._latest_session_date
+        if latest is not None and earliest_str <= latest <= today_str:
+            return latest
+        return None
+    
+    async def load_current_session(self) -> dict:
+        """从云端加载当前对话（当前逻辑日期没有时回退到最近的会话）"""
+        date_str = await self.resolve_latest_session_date()
+        if date_str is not None:
+            data = await self.load_session_for_date(date_str)
+            if data is not None:
+                logger.info(f"[SphereStorage] 从云端加载对话: {date_str} (逻辑日期)")
+                return data
+            # 指针指向的文件已不存在，下次重新列目录
+            self._latest_session_date = None
         
         # 如果云端都没有，尝试从本地加载
         logger.info("[SphereStorage] 云端没有找到任何session，尝试本地加载...")
         return self._load_local_session()
     
+    async def load_consolidation_state(self, date_str: str) -> Optional[dict]:
+        """读取某逻辑日期的日内增量整理状态，不存在返回 None"""
+        content = await self.current_storage.read_file(consolidation_filename(date_str))
+        if not content:
+            return None
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError as e:
+            logger.error(f"[SphereStorage] 解析增量整理状态失败 {date_str}: {e}")
+            return None
+    
+    async def save_consolidation_state(self, date_str: str, data: dict) -> bool:
+        """保存日内增量整理状态"""
+        content = json.dumps(data, ensure_ascii=False, indent=2)
+        return await self.current_storage.write_file(consolidation_filename(date_str), content)
+    
+    async def delete_consolidation_state(self, date_str: str) -> bool:
+        """删除日内增量整理状态（夜间归档合并后）"""
+        return await self.current_storage.delete_file(consolidation_filename(date_str))
+    
     async def clear_current_session(self) -> bool:
         """清空当前对话（仅云端）"""
-        logical_date = get_current_logical_date()
-        filename = f"current_session_{format_logical_date(logical_date)}.json"
-        empty_data = {
-            "history": [],
-            "summary": "",
-            "last_updated": datetime.now().isoformat(),
-            "date": format_logical_date(logical_date),
-            "logical_date": format_logical_date(logical_date)
-        }
-        content = json.dumps(empty_data, ensure_ascii=False, indent=2)
-        return await self.current_storage.write_file(filename, content)
+        return await self.save_current_session([], "")
     
     def _load_local_session(self) -> dict:
         """从本地加载会话（备用）"""
@@ -0,0 +1,107 @@
+# WebDAV 共享连接池
+# 所有 InfiniCloudStorage 实例共用一个 httpx.AsyncClient，复用 TCP/TLS 连接
+
+import logging
+import time
+from typing import Optional
+
+import httpx
+
+from src.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+# ===== 连接复用统计 =====
+# requests: 发出的请求总数
+# connections_opened: 新建的 TCP 连接数（其余请求即为复用已有连接）
+_POOL_STATS = {
+    "requests": 0,
+    "connections_opened": 0,
+    "opened_at": None,
+}
+
+_shared_client: Optional[httpx.AsyncClient] = None
+
+
+async def _trace(event_name: str, info: dict):
+    """httpcore trace 回调：统计新建连接"""
+    if event_name == "connection.connect_tcp.complete":
+        _POOL_STATS["connections_opened"] += 1
+
+
+async def _on_request(request: httpx.Request):
+    """请求钩子：计数并挂载 trace 回调"""
+    _POOL_STATS["requests"] += 1
+    request.extensions["trace"] = _trace
+
+
+def _http2_available() -> bool:
+    """检查 HTTP/2 依赖 (h2) 是否已安装"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _create_client() -> httpx.AsyncClient:
+    """按配置创建共享客户端"""
+    use_http2 = settings.WEBDAV_HTTP2
+    if use_http2 and not _http2_available():
+        logger.warning("[WebDAVPool] WEBDAV_HTTP2=True 但未安装 h2，回退到 HTTP/1.1")
+        use_http2 = False
+
+    limits = httpx.Limits(
+        max_connections=settings.WEBDAV_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.WEBDAV_MAX_KEEPALIVE,
+        keepalive_expiry=settings.WEBDAV_KEEPALIVE_EXPIRY,
+    )
+    client = httpx.AsyncClient(
+        http2=use_http2,
+        limits=limits,
+        timeout=httpx.Timeout(settings.WEBDAV_TIMEOUT),
+        event_hooks={"request": [_on_request]},
+    )
+    _POOL_STATS["opened_at"] = time.time()
+    logger.info(
+        f"[WebDAVPool] 连接池已创建 (http2={use_http2}, "
+        f"max_connections={settings.WEBDAV_MAX_CONNECTIONS}, "
+        f"keepalive={settings.WEBDAV_MAX_KEEPALIVE})"
+    )
+    return client
+
+
+def get_webdav_client() -> httpx.AsyncClient:
+    """获取共享客户端（未在启动时打开则按需创建）"""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = _create_client()
+    return _shared_client
+
+
+async def open_webdav_pool():
+    """应用启动时打开连接池"""
+    get_webdav_client()
+
+
+async def close_webdav_pool():
+    """应用关闭时释放所有连接"""
+    global _shared_client
+    if _shared_client is not None and not _shared_client.is_closed:
+        await _shared_client.aclose()
+        logger.info(f"[WebDAVPool] 连接池已关闭 {get_pool_stats()}")
+    _shared_client = None
+
+
+def get_pool_stats() -> dict:
+    """返回连接复用统计（供 /health 监控）"""
+    requests = _POOL_STATS["requests"]
+    opened = _POOL_STATS["connections_opened"]
+    reused = max(requests - opened, 0)
+    return {
+        "active": _shared_client is not None and not _shared_client.is_closed,
+        "requests": requests,
+        "connections_opened": opened,
+        "connections_reused": reused,
+        "reuse_ratio": round(reused / requests, 3) if requests else 0.0,
+    }
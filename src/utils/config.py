@@ -25,6 +25,63 @@ class Settings(BaseSettings):
     INFINICLOUD_USER: Optional[str] = None
     INFINICLOUD_PASS: Optional[str] = None
 
+    # WebDAV 共享连接池配置
+    WEBDAV_HTTP2: bool = False            # 需要安装 h2 才会生效
+    WEBDAV_MAX_CONNECTIONS: int = 10
+    WEBDAV_MAX_KEEPALIVE: int = 5
+    WEBDAV_KEEPALIVE_EXPIRY: float = 30.0  # 空闲连接保活时间（秒）
+    WEBDAV_TIMEOUT: float = 10.0
+    WEBDAV_CACHE_MAX_BYTES: int = 32 * 1024 * 1024  # 内存缓存字节预算
+    # 本地磁盘缓存（SQLite），只缓存记忆文件，重启后仍可命中；路径留空则禁用
+    WEBDAV_DISK_CACHE_PATH: str = os.path.join("data", "webdav_cache.sqlite3")
+    WEBDAV_DISK_CACHE_MAX_BYTES: int = 128 * 1024 * 1024
+    # 启动时预取所有记忆文件到缓存
+    CACHE_WARMUP_ENABLED: bool = True
+    CACHE_WARMUP_CONCURRENCY: int = 4
+
+    # 会话保存合并窗口（秒）：窗口内的多次保存只上传最新快照
+    SESSION_SAVE_DELAY: float = 3.0
+    # 上传失败后按指数退避重试的次数与最长间隔（秒）；超过次数后等下一次保存或关闭时再试
+    SESSION_SAVE_MAX_RETRIES: int = 5
+    SESSION_SAVE_MAX_BACKOFF: float = 60.0
+    # 会话日志每追加多少个分段压缩一次快照
+    SESSION_JOURNAL_COMPACT_EVERY: int = 20
+
+    # 系统提示词布局：stable 固定内容在前以命中上下文缓存，legacy 为旧的摘要在前
+    PROMPT_LAYOUT: str = "stable"
+
+    # /chat 历史窗口：估算 token 预算（<=0 不限制）、保留原文的最近消息数、较早消息的截断长度
+    CHAT_HISTORY_TOKEN_BUDGET: int = 12000
+    CHAT_HISTORY_KEEP_RECENT: int = 8
+    CHAT_HISTORY_OLD_MESSAGE_TOKENS: int = 300
+    # 超出预算时按多大的 token 块丢弃最早的消息（块越大，切点越稳定，前缀缓存命中越多）
+    CHAT_HISTORY_DROP_BLOCK: int = 3000
+
+    # SSE 内容合并：最长缓冲时间（秒）和字节数，达到任一即发送
+    SSE_FLUSH_INTERVAL: float = 0.025
+    SSE_FLUSH_BYTES: int = 1024
+
+    # 每日归档：并发修改的记忆文件数、单个文件失败后的重试次数
+    ARCHIVE_PATCH_CONCURRENCY: int = 3
+    ARCHIVE_PATCH_RETRIES: int = 2
+    # 每日归档：对话全文超过预算时分块摘要（map-reduce），块大小、块摘要长度与并发数
+    ARCHIVE_HISTORY_TOKEN_BUDGET: int = 24000
+    ARCHIVE_CHUNK_TOKENS: int = 6000
+    ARCHIVE_CHUNK_SUMMARY_TOKENS: int = 800
+    ARCHIVE_SUMMARY_CONCURRENCY: int = 4
+    # 块摘要的磁盘缓存：独立文件与预算，不与 WebDAV 文件缓存争用空间（路径为空则只用内存）
+    ARCHIVE_SUMMARY_CACHE_PATH: str = os.path.join("data", "summary_cache.sqlite3")
+    ARCHIVE_SUMMARY_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    # 日内增量整理：每新增多少条消息（约 10 轮）或空闲多少秒后，在后台整理新增对话
+    INCREMENTAL_ARCHIVE_ENABLED: bool = True
+    INCREMENTAL_ARCHIVE_MESSAGES: int = 20
+    INCREMENTAL_ARCHIVE_IDLE_SECONDS: float = 1800
+    # 修改已有记忆文件的方式：structured（按章节路径的编辑操作）或 rewrite（模型输出全文）
+    MEMORY_PATCH_MODE: str = "structured"
+
+    # 同一轮工具调用的并发上限
+    TOOL_MAX_CONCURRENCY: int = 3
+
     # 指定环境变量加载策略 - HF环境优先使用环境变量
     model_config = SettingsConfigDict(
         env_file=".env", 
@@ -3,7 +3,9 @@ import json
 import logging
 from datetime import datetime, timedelta, date
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from src.agents.daily_archive import trigger_daily_archive
+from src.agents.daily_archive import archive_session
+from src.agents.incremental_archive import get_incremental_archiver
+from src.utils.config import settings
 from src.utils.date_helper import get_current_logical_date, format_logical_date, get_beijing_time
 
 logger = logging.getLogger(__name__)
@@ -26,25 +28,22 @@ async def auto_archive_job():
     from src.storage.sphere_storage import get_sphere_storage
     storage = get_sphere_storage()
     
-    # 尝试加载目标日期的session文件
-    filename = f"current_session_{target_date_str}.json"
-    content = await storage.current_storage.read_file(filename)
+    # 加载目标日期的session（快照 + 日志分段）
+    data = await storage.load_session_for_date(target_date_str)
     
-    if not content:
-        logger.info(f"[Scheduler] 目标日期 {target_date_str} 的session文件不存在，跳过归档。")
-        return
-
     try:
-        data = json.loads(content)
-        history = data.get("history", [])
-        summary = data.get("summary", "")
+        history = data.get("history", []) if data else []
+        summary = data.get("summary", "") if data else ""
             
         if not history:
-            logger.info(f"[Scheduler] 目标日期 {target_date_str} 的历史为空，跳过。")
+            logger.info(f"[Scheduler] 目标日期 {target_date_str} 的session不存在或历史为空，跳过归档。")
+            if settings.INCREMENTAL_ARCHIVE_ENABLED:
+                # 会话已被清空时，日内整理留下的增量也不再需要
+                await get_incremental_archiver().finish_nightly(target_date_str)
             return
             
-        # 执行归档（会自动清理 M1 并更新 M2）
-        result = await trigger_daily_archive(
+        # 执行归档（会自动清理 M1 并更新 M2）；日内已整理的部分只合并增量
+        result = await archive_session(
             session_history=history,
             current_m2=summary,
             target_date=target_date_str
@@ -0,0 +1,95 @@
+# SSE 编码与内容增量合并
+# 把模型的逐 token 增量合并成较少的帧，按时间或字节数刷新，降低写入次数和每帧开销
+
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+
+from src.utils.config import settings
+
+
+# paced() 在模型停顿时产出的标记，调用方收到后应调用 flush()
+FLUSH_TICK = object()
+
+
+def encode_event(event: str, data: str) -> str:
+    """一次性编码一个 SSE 帧；多行数据每行加 data: 前缀"""
+    data = data.replace("\r\n", "\n").replace("\r", "\n")
+    return f"event: {event}\ndata: " + data.replace("\n", "\ndata: ") + "\n\n"
+
+
+class SSECoalescer:
+    """
+    content 增量合并器。
+
+    - content(): 缓冲增量；距上次刷新超过 max_delay 秒或缓冲超过 max_bytes 时返回合并后的帧
+    - event(): 先刷新缓冲的内容，再编码其他事件，保证事件顺序不变
+    - flush(): 流结束或切换路径时输出剩余内容
+    - paced(): 包装上游流，模型停顿超过 max_delay 时产出 FLUSH_TICK，缓冲内容按时发出
+    空闲一段时间后到达的第一个增量会立即发出，因此不会感到打字延迟。
+    """
+
+    def __init__(self, max_delay: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.max_delay = settings.SSE_FLUSH_INTERVAL if max_delay is None else max_delay
+        self.max_bytes = settings.SSE_FLUSH_BYTES if max_bytes is None else max_bytes
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush = 0.0
+        self.frames = 0
+        self.deltas = 0
+
+    def content(self, text: str) -> str:
+        if not text:
+            return ""
+        self.deltas += 1
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))
+        if self._size >= self.max_bytes or time.monotonic() - self._last_flush >= self.max_delay:
+            return self.flush()
+        return ""
+
+    def flush(self) -> str:
+        if not self._parts:
+            return ""
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self.frames += 1
+        return encode_event("content", text)
+
+    def event(self, event: str, data: str) -> str:
+        return self.flush() + encode_event(event, data)
+
+    async def paced(self, stream) -> AsyncIterator:
+        """
+        遍历上游流；有缓冲内容且距上次刷新已到 max_delay 仍没有下一项时产出 FLUSH_TICK，
+        使工具调用或长时间思考期间已缓冲的内容不会滞留。
+        上游的 __anext__ 在独立任务中等待，超时不会取消它；关闭本迭代器时取消进行中的读取。
+        """
+        iterator = stream.__aiter__()
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = None
+                if self._parts:
+                    timeout = max(self.max_delay - (time.monotonic() - self._last_flush), 0)
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield FLUSH_TICK
+                    continue
+                task, pending = pending, None
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if pending is not None:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"deltas": self.deltas, "frames": self.frames}
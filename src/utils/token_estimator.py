@@ -0,0 +1,29 @@
+# Token 估算
+# 按 DeepSeek 官方给出的经验比例：1 个中文字符 ≈ 0.6 token，1 个英文字符 ≈ 0.3 token
+
+import re
+
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数（无需加载分词器）"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return int(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR) + 1
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """按估算 token 数截断文本（保留开头）"""
+    if estimate_tokens(text) <= budget:
+        return text
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += CJK_TOKENS_PER_CHAR if _CJK_PATTERN.match(ch) else OTHER_TOKENS_PER_CHAR
+        if used > budget:
+            return text[:i]
+    return text
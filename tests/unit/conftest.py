@@ -0,0 +1,57 @@
+import pytest
+
+from src.storage.infinicloud import FileEntry
+
+
+class FakeDavStorage:
+    """内存中的 WebDAV 目录，接口与 InfiniCloudStorage 的读写/列表/删除一致"""
+
+    def __init__(self):
+        self.files: dict[str, str] = {}
+        self.etags: dict[str, str] = {}
+        self.reads: list[str] = []
+        self.writes: list[str] = []
+        self.deletes: list[str] = []
+        self._version = 0
+
+    def put(self, filename, content):
+        """模拟在应用之外（如 Obsidian）修改文件：内容和 ETag 都变化"""
+        self._version += 1
+        self.files[filename] = content
+        self.etags[filename] = f'"v{self._version}"'
+
+    async def read_file(self, filename, expected_etag=None, revalidate=False):
+        self.reads.append(filename)
+        return self.files.get(filename)
+
+    async def write_file(self, filename, content):
+        self.put(filename, content)
+        self.writes.append(filename)
+        return True
+
+    async def listed_etag(self, filename):
+        return self.etags.get(filename)
+
+    def cached_etag(self, filename):
+        return self.etags.get(filename)
+
+    def add_change_listener(self, listener):
+        pass
+
+    async def delete_file(self, filename):
+        self.files.pop(filename, None)
+        self.etags.pop(filename, None)
+        self.deletes.append(filename)
+        return True
+
+    async def list_entries(self, suffix=".md"):
+        return [
+            FileEntry(name, len(content.encode("utf-8")), etag=self.etags.get(name))
+            for name, content in sorted(self.files.items())
+            if suffix is None or name.endswith(suffix)
+        ]
+
+
+@pytest.fixture
+def fake_dav():
+    return FakeDavStorage()
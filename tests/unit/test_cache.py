@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from src.storage.cache import LRUByteCache, SingleFlight
+
+
+def test_evicts_least_recently_used_to_stay_within_budget():
+    cache = LRUByteCache(max_bytes=100)
+    cache.set("ns", "a", "A", 40)
+    cache.set("ns", "b", "B", 40)
+    assert cache.get("ns", "a") == "A"   # a 变为最近使用
+    cache.set("ns", "c", "C", 40)
+
+    assert cache.get("ns", "b") is None
+    assert cache.get("ns", "a") == "A" and cache.get("ns", "c") == "C"
+    stats = cache.stats()
+    assert stats["bytes"] == 80 and stats["evictions"] == 1
+
+
+def test_overwrite_replaces_size_accounting():
+    cache = LRUByteCache(max_bytes=100)
+    cache.set("ns", "a", "A", 60)
+    cache.set("ns", "a", "A2", 30)
+    assert cache.stats()["bytes"] == 30
+    assert cache.stats()["evictions"] == 0
+
+
+def test_oversized_entry_is_rejected_and_drops_old_value():
+    cache = LRUByteCache(max_bytes=100)
+    cache.set("ns", "a", "旧", 10)
+    cache.set("ns", "keep", "K", 10)
+    cache.set("ns", "a", "新", 101)
+
+    # 旧值不能继续被当作最新内容返回，其他条目不受影响
+    assert cache.get("ns", "a") is None
+    assert cache.get("ns", "keep") == "K"
+    assert cache.stats()["bytes"] == 10
+
+
+def test_invalidate_key_and_namespace():
+    cache = LRUByteCache(max_bytes=100)
+    cache.set("mem", "a", "A", 10)
+    cache.set("mem", "b", "B", 10)
+    cache.set("sessions", "a", "S", 10)
+
+    cache.invalidate("mem", "a")
+    assert cache.get("mem", "a") is None and cache.get("mem", "b") == "B"
+
+    cache.invalidate("mem")
+    assert cache.get("mem", "b") is None
+    assert cache.get("sessions", "a") == "S"
+    assert cache.stats()["bytes"] == 10
+    assert list(cache.stats()["namespaces"]) == ["sessions"]
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "内容"
+
+    async def main():
+        results = await asyncio.gather(*[flight.do("file", fetch) for _ in range(5)])
+        # 完成后再调用会发起新的请求
+        results.append(await flight.do("file", fetch))
+        return results
+
+    assert asyncio.run(main()) == ["内容"] * 6
+    assert len(calls) == 2
+    assert flight.stats() == {"inflight": 0, "executed": 2, "coalesced": 4}
+
+
+def test_single_flight_propagates_errors_to_every_waiter():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise OSError("连接中断")
+
+    async def main():
+        return await asyncio.gather(*[flight.do("file", fail) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, OSError) for r in results)
+    assert flight.executed == 1
+
+
+def test_cancelled_waiter_does_not_cancel_shared_task():
+    flight = SingleFlight()
+    started = []
+
+    async def fetch():
+        started.append(1)
+        await asyncio.sleep(0.02)
+        return "内容"
+
+    async def main():
+        first = asyncio.create_task(flight.do("file", fetch))
+        second = asyncio.create_task(flight.do("file", fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # 共享任务仍在运行：新的调用者继续合并到它上面
+        third = await flight.do("file", fetch)
+        return await second, third
+
+    assert asyncio.run(main()) == ("内容", "内容")
+    assert len(started) == 1
+    assert flight.coalesced == 2
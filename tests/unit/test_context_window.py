@@ -0,0 +1,62 @@
+from src.agents.context_window import MEMORY_INJECTION_PREFIX, fit_history
+from src.utils.token_estimator import estimate_tokens
+
+
+def turn(i, size=200):
+    return [
+        {"role": "user", "content": f"问题{i} " + "问" * size},
+        {"role": "assistant", "content": f"回答{i} " + "答" * size},
+    ]
+
+
+def conversation(turns, size=200):
+    return [m for i in range(turns) for m in turn(i, size)]
+
+
+def test_under_budget_is_unchanged():
+    history = conversation(3)
+    window = fit_history(history, budget=100000, keep_recent=2, old_message_tokens=50)
+    assert window.history == history
+    assert window.dropped == window.compressed == 0
+
+
+def test_recent_messages_stay_verbatim_and_older_are_compressed():
+    history = conversation(6, size=400)
+    history.insert(2, {"role": "system", "content": f"{MEMORY_INJECTION_PREFIX}\n【来自 职业规划.md 的长期记忆】\n" + "记" * 500})
+    window = fit_history(history, budget=2000, keep_recent=4, old_message_tokens=50)
+
+    assert window.dropped == 0
+    assert window.history[-4:] == history[-4:]
+    injection = window.history[2]
+    assert injection["content"].startswith(MEMORY_INJECTION_PREFIX)
+    assert "职业规划.md" in injection["content"] and "记" * 10 not in injection["content"]
+    assert window.history[0]["content"].endswith("…（已截断）")
+    assert estimate_tokens(window.history[0]["content"]) < 60
+    assert window.compressed == len(history) - 4
+    assert window.tokens_after <= 2000
+
+
+def test_drops_oldest_in_blocks_and_starts_with_user():
+    history = conversation(20)
+    window = fit_history(history, budget=1500, keep_recent=4, old_message_tokens=100, drop_block=300)
+
+    assert window.dropped > 0
+    assert window.tokens_after <= 1500
+    assert window.history[0]["role"] == "user"
+    assert window.history[-4:] == history[-4:]
+
+
+def test_cut_point_is_stable_across_turns():
+    """新消息到来时切点保持不变，直到超出一整块才前移，使提示前缀可复用"""
+    history = conversation(20)
+    first_kept = []
+    for extra in range(8):
+        window = fit_history(history + conversation(extra + 20)[40:], budget=3000, keep_recent=4,
+                             old_message_tokens=100, drop_block=1000)
+        assert window.tokens_after <= 3000
+        first_kept.append(window.history[0]["content"])
+
+    changes = sum(1 for a, b in zip(first_kept, first_kept[1:]) if a != b)
+    # 每轮新增约 240 token，1000 token 的块大约每 4 轮才移动一次切点
+    assert changes <= 3
+    assert len(set(first_kept)) > 1
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import src.agents.history_summarizer as history_summarizer
+import src.storage.disk_cache as disk_cache
+from src.agents.history_summarizer import chunk_lines, condense_history, format_history
+
+
+class CountingLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def ainvoke(self, messages):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(content=f"- 要点 {self.calls}")
+
+
+def long_day(turns):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"第 {i} 条消息 " + "讨论内容" * 40}
+        for i in range(turns)
+    ]
+
+
+@pytest.fixture
+def summarizer(monkeypatch, tmp_path):
+    llm = CountingLLM()
+    monkeypatch.setattr(history_summarizer, "llm", llm)
+    monkeypatch.setattr(history_summarizer.settings, "ARCHIVE_HISTORY_TOKEN_BUDGET", 400)
+    monkeypatch.setattr(history_summarizer.settings, "ARCHIVE_CHUNK_TOKENS", 300)
+    monkeypatch.setattr(history_summarizer.settings, "ARCHIVE_SUMMARY_CACHE_PATH", str(tmp_path / "summary.sqlite3"))
+    monkeypatch.setattr(history_summarizer.settings, "WEBDAV_DISK_CACHE_PATH", str(tmp_path / "webdav.sqlite3"))
+    monkeypatch.setattr(disk_cache, "_summary_cache", None)
+    monkeypatch.setattr(disk_cache, "_disk_cache", None)
+    history_summarizer._CHUNK_CACHE.clear()
+    yield llm
+    history_summarizer._CHUNK_CACHE.clear()
+
+
+def test_short_history_is_returned_verbatim(summarizer):
+    history = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好！"}]
+    assert asyncio.run(condense_history(history)) == "用户: 你好\nAI: 你好！"
+    assert summarizer.calls == 0
+
+
+def test_chunking_is_prefix_stable():
+    lines = format_history(long_day(12))
+    chunks = chunk_lines(lines, 300)
+    grown = chunk_lines(lines + ["用户: 新消息"], 300)
+    assert grown[:-1] == chunks[:-1]
+
+
+def test_condense_reuses_cached_chunk_summaries(summarizer):
+    history = long_day(12)
+    first = asyncio.run(condense_history(history))
+    calls = summarizer.calls
+    assert calls > 1 and "【第 1 段】" in first
+
+    # 重跑：全部命中内存缓存
+    assert asyncio.run(condense_history(history)) == first
+    assert summarizer.calls == calls
+
+    # 进程重启（内存缓存清空）：命中独立的磁盘缓存
+    history_summarizer._CHUNK_CACHE.clear()
+    assert asyncio.run(condense_history(history)) == first
+    assert summarizer.calls == calls
+
+    # 日内继续对话：只摘要新增的末尾块
+    asyncio.run(condense_history(history + long_day(2)))
+    assert summarizer.calls - calls <= 2
+
+
+def test_summaries_do_not_use_the_webdav_file_cache(summarizer):
+    asyncio.run(condense_history(long_day(12)))
+    assert disk_cache.get_summary_cache().stats()["entries"] > 0
+    assert disk_cache._disk_cache is None or disk_cache._disk_cache.stats()["entries"] == 0
+
+
+def test_concurrent_condense_calls_share_model_calls(summarizer):
+    history = long_day(12)
+
+    async def both():
+        return await asyncio.gather(condense_history(history), condense_history(history))
+
+    first, second = asyncio.run(both())
+    assert first == second
+    assert summarizer.calls == len(chunk_lines(format_history(history), 300))
@@ -0,0 +1,164 @@
+import asyncio
+import json
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import src.agents.daily_archive as daily_archive
+import src.agents.incremental_archive as incremental_archive
+from src.agents.memory_patcher import normalize_updates
+from src.storage import sphere_storage
+from src.storage.session_journal import SessionJournal
+from src.storage.sphere_storage import SphereStorage, consolidation_filename
+
+DATE = "2026-10-17"
+
+
+def messages(start, count):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"消息 {i}"}
+        for i in range(start, start + count)
+    ]
+
+
+def saved_state(dav, date_str=DATE):
+    """读取写到云端的增量整理状态文件，不存在返回 None"""
+    content = dav.files.get(consolidation_filename(date_str))
+    return json.loads(content) if content is not None else None
+
+
+@pytest.fixture
+def env(monkeypatch, fake_dav):
+    """真实的 SphereStorage（当前对话目录换成内存 WebDAV），通过模块级查找注入"""
+    storage = SphereStorage()
+    storage.current_storage = fake_dav
+    storage.journal = SessionJournal(fake_dav, compact_every=10)
+    monkeypatch.setattr(storage, "_load_local_session", lambda: {"history": [], "summary": ""})
+    detect_calls = []
+
+    async def summarize(text):
+        return f"摘要({text.count(chr(10)) + 1} 条)"
+
+    async def detect(history, history_text=None):
+        detect_calls.append(len(history))
+        return [{"filename": "a.md", "change_instruction": f"记录 {len(history)} 条"}, {"filename": "", "change_instruction": "x"}]
+
+    monkeypatch.setattr(sphere_storage, "_sphere_storage", storage)
+    monkeypatch.setattr(sphere_storage, "get_current_logical_date", lambda: date.fromisoformat(DATE))
+    monkeypatch.setattr(incremental_archive, "summarize_chunk", summarize)
+    monkeypatch.setattr(incremental_archive, "detect_memory_updates", detect)
+    monkeypatch.setattr(incremental_archive, "_incremental_archiver", None)
+    monkeypatch.setattr(incremental_archive.settings, "INCREMENTAL_ARCHIVE_MESSAGES", 4)
+    monkeypatch.setattr(incremental_archive.settings, "INCREMENTAL_ARCHIVE_IDLE_SECONDS", 0.05)
+    monkeypatch.setattr(incremental_archive.settings, "INCREMENTAL_ARCHIVE_ENABLED", True)
+    return SimpleNamespace(
+        archiver=incremental_archive.get_incremental_archiver(),
+        storage=storage,
+        dav=fake_dav,
+        detect_calls=detect_calls,
+    )
+
+
+def test_normalize_updates_filters_malformed_entries():
+    updates = [
+        {"filename": " a.md ", "change_instruction": "加一条", "reason": "r"},
+        {"filename": "b.md"},
+        {"filename": 3, "change_instruction": "x"},
+        "c.md",
+        None,
+    ]
+    assert normalize_updates(updates) == [{"filename": "a.md", "change_instruction": "加一条", "reason": "r"}]
+    assert normalize_updates({"filename": "a.md", "change_instruction": "x"}) == [{"filename": "a.md", "change_instruction": "x"}]
+    assert normalize_updates("[]") == []
+
+
+def test_session_saves_notify_archiver_through_storage_listener(env):
+    async def main():
+        incremental_archive.start_incremental_archive()
+        incremental_archive.start_incremental_archive()  # 幂等
+        await env.storage.get_session_state()
+        for i in range(4):
+            env.storage.append_session_messages(messages(i, 1), persist=False)
+        await asyncio.sleep(0.02)
+        env.archiver.stop()
+
+    asyncio.run(main())
+    assert env.storage._session_listeners == [env.archiver.notify]
+    assert env.detect_calls == [4]
+    assert saved_state(env.dav)["processed"] == 4
+
+
+def test_consolidates_on_threshold_and_idle(env):
+    async def main():
+        history = []
+        for i in range(5):
+            history = history + messages(i, 1)
+            env.archiver.notify(DATE, history)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.15)
+
+    asyncio.run(main())
+    # 第 4 条消息达到阈值立即整理，第 5 条在空闲后整理，每次只处理新增消息
+    assert env.detect_calls == [4, 1]
+    state = saved_state(env.dav)
+    assert state["processed"] == 5
+    assert [(d["start"], d["end"]) for d in state["deltas"]] == [(0, 4), (4, 5)]
+
+
+def test_rewritten_history_discards_deltas(env):
+    archiver = env.archiver
+    asyncio.run(archiver.consolidate(DATE, messages(0, 6)))
+    state = asyncio.run(archiver.consolidate(DATE, messages(0, 2) + messages(10, 1)))
+    assert archiver.stats()["resets"] == 1
+    assert [(d["start"], d["end"]) for d in state["deltas"]] == [(0, 3)]
+
+    asyncio.run(archiver.consolidate(DATE, []))
+    assert saved_state(env.dav) is None
+
+
+def test_state_is_reloaded_from_storage(env, monkeypatch):
+    history = messages(0, 6)
+    asyncio.run(env.archiver.consolidate(DATE, history))
+
+    # 进程重启：新的整理器从云端状态继续，只处理新增消息
+    monkeypatch.setattr(incremental_archive, "_incremental_archiver", None)
+    restarted = incremental_archive.get_incremental_archiver()
+    asyncio.run(restarted.consolidate(DATE, history + messages(6, 2)))
+    assert env.detect_calls == [6, 2]
+    assert saved_state(env.dav)["processed"] == 8
+
+
+def test_prepare_nightly_only_processes_tail(env):
+    history = messages(0, 8)
+    asyncio.run(env.archiver.consolidate(DATE, history))
+    pending = asyncio.run(env.archiver.prepare_nightly(DATE, history + messages(8, 2)))
+
+    assert env.detect_calls == [8, 2]
+    assert pending["deltas"] == 2
+    assert [(d["start"], d["end"]) for d in pending["digests"]] == [(0, 8), (8, 10)]
+    # 不合规的变更在合并前被过滤
+    assert pending["updates"] == [
+        {"filename": "a.md", "change_instruction": "记录 8 条"},
+        {"filename": "a.md", "change_instruction": "记录 2 条"},
+    ]
+
+
+def test_manual_archive_merges_pending_and_cleans_up(env, monkeypatch):
+    received = {}
+
+    async def fake_trigger(session_history, current_m2="", target_date=None, pending=None):
+        received.update(target_date=target_date, pending=pending)
+        return {"success": True}
+
+    monkeypatch.setattr(daily_archive, "trigger_daily_archive", fake_trigger)
+    monkeypatch.setattr(daily_archive.settings, "INCREMENTAL_ARCHIVE_ENABLED", True)
+    history = messages(0, 6)
+    asyncio.run(env.archiver.consolidate(DATE, history))
+    assert saved_state(env.dav) is not None
+
+    asyncio.run(daily_archive.archive_session(history, "旧摘要", DATE))
+    assert received["target_date"] == DATE
+    assert received["pending"]["deltas"] == 1
+    assert saved_state(env.dav) is None
+    assert env.archiver.stats()["pending_dates"] == {}
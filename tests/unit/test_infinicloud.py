@@ -0,0 +1,239 @@
+import asyncio
+from urllib.parse import quote, unquote
+
+import httpx
+import pytest
+
+from src.storage import infinicloud
+from src.storage.disk_cache import DiskCache
+from src.storage.infinicloud import InfiniCloudStorage
+
+BASE_URL = "https://dav.test/dav"
+MEMORY_DIR = "/obsidian/mem"
+
+
+class FakeDavServer:
+    """处理 PROPFIND / GET / PUT 的内存 WebDAV 服务器，记录收到的请求"""
+
+    def __init__(self):
+        self.files: dict[str, tuple[str, str]] = {}   # name -> (content, etag)
+        self.requests: list[httpx.Request] = []
+        self._version = 0
+
+    def put(self, name, content):
+        self._version += 1
+        self.files[name] = (content, f'"v{self._version}"')
+
+    def gets(self):
+        return [r for r in self.requests if r.method == "GET"]
+
+    def multistatus(self):
+        responses = [
+            f"<D:response><D:href>/dav{MEMORY_DIR}/</D:href>"
+            "<D:propstat><D:prop><D:resourcetype><D:collection/></D:resourcetype></D:prop></D:propstat></D:response>"
+        ]
+        for name, (content, etag) in self.files.items():
+            responses.append(
+                f"<D:response><D:href>/dav{MEMORY_DIR}/{quote(name)}</D:href><D:propstat><D:prop>"
+                f"<D:resourcetype/><D:getcontentlength>{len(content.encode('utf-8'))}</D:getcontentlength>"
+                f"<D:getlastmodified>Sat, 17 Oct 2026 08:00:00 GMT</D:getlastmodified>"
+                f"<D:getetag>{etag}</D:getetag></D:prop></D:propstat></D:response>"
+            )
+        return f'<?xml version="1.0"?><D:multistatus xmlns:D="DAV:">{"".join(responses)}</D:multistatus>'
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.method == "PROPFIND":
+            return httpx.Response(207, text=self.multistatus())
+        name = unquote(request.url.path.rsplit("/", 1)[-1])
+        if request.method == "PUT":
+            self.put(name, request.content.decode("utf-8"))
+            return httpx.Response(201, headers={"ETag": self.files[name][1]})
+        if name not in self.files:
+            return httpx.Response(404)
+        content, etag = self.files[name]
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, text=content, headers={"ETag": etag})
+
+
+@pytest.fixture
+def dav(monkeypatch):
+    server = FakeDavServer()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server.handle))
+    monkeypatch.setattr(infinicloud, "get_webdav_client", lambda: client)
+    monkeypatch.setattr(infinicloud, "get_disk_cache", lambda: None)
+    infinicloud.clear_cache()
+    yield server
+    infinicloud.clear_cache()
+
+
+def make_storage(disk_cache=False):
+    return InfiniCloudStorage(BASE_URL, "user", "pass", MEMORY_DIR, disk_cache=disk_cache)
+
+
+def test_listing_etag_bypasses_fresh_cache_after_external_edit(dav):
+    storage = make_storage()
+    dav.put("职业规划.md", "旧内容")
+
+    async def main():
+        assert await storage.read_file("职业规划.md", await storage.listed_etag("职业规划.md")) == "旧内容"
+        # 在 Obsidian 中修改了文件：内容缓存仍在新鲜期内，但目录列表的 ETag 已变化
+        dav.put("职业规划.md", "新内容")
+        infinicloud.clear_cache(storage.namespace, infinicloud.LIST_CACHE_KEY)
+        return await storage.read_file("职业规划.md", await storage.listed_etag("职业规划.md"))
+
+    assert asyncio.run(main()) == "新内容"
+    # 已知过期的条目不带校验器，直接下载正文
+    assert "If-None-Match" not in dav.gets()[-1].headers
+
+
+def test_matching_etag_is_served_from_cache(dav):
+    storage = make_storage()
+    dav.put("健康管理.md", "内容")
+
+    async def main():
+        etag = await storage.listed_etag("健康管理.md")
+        await storage.read_file("健康管理.md", etag)
+        return await storage.read_file("健康管理.md", f"W/{etag}")
+
+    assert asyncio.run(main()) == "内容"
+    assert len(dav.gets()) == 1
+
+
+def test_disk_entry_with_stale_etag_is_not_served(dav, monkeypatch, tmp_path):
+    storage = make_storage(disk_cache=True)
+    disk = DiskCache(str(tmp_path / "cache.sqlite3"), 1 << 20)
+    monkeypatch.setattr(infinicloud, "get_disk_cache", lambda: disk)
+    disk.put(storage.namespace, "file:职业规划.md", "重启前的内容", '"v0"', None)
+    dav.put("职业规划.md", "云端最新内容")
+
+    async def main():
+        return await storage.read_file("职业规划.md", await storage.listed_etag("职业规划.md"))
+
+    assert asyncio.run(main()) == "云端最新内容"
+    assert disk.get(storage.namespace, "file:职业规划.md").content == "云端最新内容"
+
+
+def test_revalidate_skips_freshness_window(dav):
+    storage = make_storage()
+    dav.put("职业规划.md", "内容")
+
+    async def main():
+        await storage.read_file("职业规划.md")
+        return await storage.read_file("职业规划.md", revalidate=True)
+
+    assert asyncio.run(main()) == "内容"
+    assert len(dav.gets()) == 2
+    assert dav.gets()[-1].headers["If-None-Match"] == dav.files["职业规划.md"][1]
+
+
+def test_disk_tier_is_only_used_when_enabled(dav, monkeypatch, tmp_path):
+    disk = DiskCache(str(tmp_path / "cache.sqlite3"), 1 << 20)
+    monkeypatch.setattr(infinicloud, "get_disk_cache", lambda: disk)
+    session_storage = make_storage()
+    disk.put(session_storage.namespace, "file:session_2026-10-17.json", "重启前的快照", '"v0"', None)
+    dav.put("session_2026-10-17.json", "云端最新快照")
+
+    # 会话类文件不走磁盘层：既不返回本地旧副本，也不写入磁盘
+    assert asyncio.run(session_storage.read_file("session_2026-10-17.json")) == "云端最新快照"
+    assert disk.get(session_storage.namespace, "file:session_2026-10-17.json").content == "重启前的快照"
+
+
+MULTISTATUS = """<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">
+  <d:response>
+    <d:href>/dav/obsidian/mem/</d:href>
+    <d:propstat><d:prop><d:resourcetype><d:collection/></d:resourcetype></d:prop>
+    <d:status>HTTP/1.1 200 OK</d:status></d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>https://dav.test/dav/obsidian/mem/%E8%81%8C%E4%B8%9A%E8%A7%84%E5%88%92.md</d:href>
+    <d:propstat><d:prop>
+      <d:resourcetype/>
+      <d:getcontentlength>1024</d:getcontentlength>
+      <d:getlastmodified>Sat, 17 Oct 2026 08:00:00 GMT</d:getlastmodified>
+      <d:getetag>"abc123"</d:getetag>
+      <oc:id>42</oc:id>
+    </d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/obsidian/mem/%E5%BD%92%E6%A1%A3/</d:href>
+    <d:propstat><d:prop><d:resourcetype><d:collection/></d:resourcetype></d:prop></d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/obsidian/mem/reading%20list.md</d:href>
+    <d:propstat><d:prop><d:resourcetype/></d:prop></d:propstat>
+  </d:response>
+  <d:response>
+    <d:href>/dav/obsidian/mem/image.png</d:href>
+    <d:propstat><d:prop><d:resourcetype/><d:getcontentlength>7</d:getcontentlength></d:prop></d:propstat>
+  </d:response>
+</d:multistatus>""".encode("utf-8")
+
+
+def serve_listing(monkeypatch, status=207, body=MULTISTATUS, chunk_size=37, clear=True):
+    """返回固定 PROPFIND 响应的客户端，正文按小块发送以覆盖流式解析"""
+    requests = []
+
+    async def chunks():
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+    def handle(request):
+        requests.append(request)
+        return httpx.Response(status, content=chunks())
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    monkeypatch.setattr(infinicloud, "get_webdav_client", lambda: client)
+    if clear:
+        infinicloud.clear_cache()
+    return requests
+
+
+def test_propfind_parses_namespaced_percent_encoded_multistatus(monkeypatch):
+    requests = serve_listing(monkeypatch)
+    entries = asyncio.run(make_storage().list_entries(None))
+
+    # 目录（含子目录）被跳过，文件名解码，缺失的属性为默认值
+    assert [e.name for e in entries] == ["职业规划.md", "reading list.md", "image.png"]
+    first = entries[0]
+    assert (first.size, first.etag, first.last_modified) == (1024, '"abc123"', "Sat, 17 Oct 2026 08:00:00 GMT")
+    assert (entries[1].size, entries[1].etag, entries[1].last_modified) == (0, None, None)
+    assert requests[0].method == "PROPFIND" and requests[0].headers["Depth"] == "1"
+    infinicloud.clear_cache()
+
+
+def test_list_files_filters_by_suffix(monkeypatch):
+    serve_listing(monkeypatch)
+    assert asyncio.run(make_storage().list_files()) == ["职业规划.md", "reading list.md"]
+    infinicloud.clear_cache()
+
+
+def test_non_207_response_keeps_previous_listing(monkeypatch):
+    storage = make_storage()
+    serve_listing(monkeypatch)
+    assert len(asyncio.run(storage.list_entries(None))) == 3
+
+    # 列表过期后服务器返回 401：沿用旧列表，而不是把记忆目录当成空的
+    monkeypatch.setattr(infinicloud, "CACHE_TTL_LIST", 0)
+    requests = serve_listing(monkeypatch, status=401, body=b"Unauthorized", clear=False)
+    assert [e.name for e in asyncio.run(storage.list_entries(None))] == ["职业规划.md", "reading list.md", "image.png"]
+    assert len(requests) == 1
+
+    # 没有旧列表时返回空列表，且不缓存失败结果
+    serve_listing(monkeypatch, status=401, body=b"Unauthorized")
+    assert asyncio.run(storage.list_entries(None)) == []
+    assert infinicloud.get_entry(storage.namespace, infinicloud.LIST_CACHE_KEY) is None
+    infinicloud.clear_cache()
+
+
+def test_truncated_multistatus_keeps_previous_listing(monkeypatch):
+    storage = make_storage()
+    serve_listing(monkeypatch)
+    asyncio.run(storage.list_entries(None))
+
+    monkeypatch.setattr(infinicloud, "CACHE_TTL_LIST", 0)
+    serve_listing(monkeypatch, body=MULTISTATUS[:len(MULTISTATUS) // 2], clear=False)
+    assert len(asyncio.run(storage.list_entries(None))) == 3
+    infinicloud.clear_cache()
@@ -0,0 +1,137 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import src.agents.memory_patcher as memory_patcher
+from src.agents.markdown_sections import EditError, apply_edits, find_section, outline, parse_sections, render_sections
+
+DOC = """# 职业规划
+> last_accessed: 2026-10-01
+
+## 目标
+- 转向 AI 工程 [2025-01-01]
+
+```python
+# 代码块里的注释不是标题
+print("## 也不是")
+```
+
+### 短期
+- 学习 Rust
+
+## 财务
+- 每月存 30% [2025-03-01]
+"""
+
+
+@pytest.mark.parametrize("content", [
+    DOC,
+    DOC.rstrip("\n"),
+    "没有标题的笔记\n- 一条\n",
+    "",
+    "## 直接从二级标题开始\n\n\n- 多个空行\n\n",
+])
+def test_parse_render_round_trip_is_exact(content):
+    assert render_sections(parse_sections(content)) == content
+
+
+def test_fenced_headings_are_body_text():
+    root = parse_sections(DOC)
+    assert outline(root) == ["职业规划", "职业规划 > 目标", "职业规划 > 目标 > 短期", "职业规划 > 财务"]
+    goal = find_section(root, "目标")
+    assert "# 代码块里的注释不是标题" in goal.body
+
+
+def test_append_replace_and_add_section_preserve_other_text():
+    result = apply_edits(DOC, [
+        {"op": "append", "path": "目标 > 短期", "content": "- 学习 Go [2026-10-17]"},
+        {"op": "replace", "path": "财务", "old": "每月存 30%", "new": "- 每月存 40%（原为 30%，已更新）[2026-10-17]"},
+        {"op": "add_section", "path": "", "heading": "健康", "content": "- 每周跑步三次"},
+    ])
+    assert "- 学习 Rust\n- 学习 Go [2026-10-17]\n" in result
+    assert "- 每月存 40%（原为 30%，已更新）[2026-10-17]" in result
+    assert "30% [2025-03-01]" not in result
+    assert result.endswith("\n## 健康\n- 每周跑步三次\n")
+    # 未触及的部分逐字保留
+    assert result.startswith(DOC.split("### 短期")[0])
+
+
+def test_ambiguous_suffix_match_is_rejected():
+    content = "# 计划\n## 工作\n### 目标\n- a\n## 生活\n### 目标\n- b\n"
+    with pytest.raises(EditError):
+        apply_edits(content, [{"op": "append", "path": "目标", "content": "- c"}])
+    # 补全路径后可以唯一定位
+    result = apply_edits(content, [{"op": "append", "path": "生活 > 目标", "content": "- c"}])
+    assert result.endswith("### 目标\n- b\n- c\n")
+
+
+def test_full_path_wins_over_deeper_suffix_match():
+    content = "# 笔记\n## 目标\n- 顶层\n## 项目\n### 目标\n- 项目内\n"
+    root = parse_sections(content)
+    assert find_section(root, "笔记 > 目标").body == ["- 顶层"]
+
+
+def test_failed_operation_leaves_document_unchanged():
+    with pytest.raises(EditError):
+        apply_edits(DOC, [{"op": "replace", "path": "财务", "old": "不存在的行", "new": "- x"}])
+    with pytest.raises(EditError):
+        apply_edits(DOC, [{"op": "delete", "path": "财务"}])
+
+
+class FakeMemoryStorage:
+    def __init__(self, files):
+        self.files = dict(files)
+
+    async def read_memory_file(self, filename, expected_etag=None, revalidate=False):
+        return self.files.get(filename)
+
+    async def write_memory_file(self, filename, content):
+        self.files[filename] = content
+        return True
+
+
+class ScriptedLLM:
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    async def ainvoke(self, messages):
+        self.prompts.append(messages[-1].content)
+        content = self.replies.pop(0)
+        return SimpleNamespace(content=content, usage_metadata={"input_tokens": 10, "output_tokens": len(content)})
+
+
+def run_patch(monkeypatch, replies, instruction="更新"):
+    storage = FakeMemoryStorage({"职业规划.md": DOC})
+    llm = ScriptedLLM(replies)
+    monkeypatch.setattr(memory_patcher, "get_sphere_storage", lambda: storage)
+    monkeypatch.setattr(memory_patcher, "llm", llm)
+    monkeypatch.setattr(memory_patcher.settings, "MEMORY_PATCH_MODE", "structured")
+    result = asyncio.run(memory_patcher.apply_file_patches("职业规划.md", [instruction], retries=0))
+    return result, storage.files["职业规划.md"], llm
+
+
+def test_structured_edit_applies_operations(monkeypatch):
+    result, content, llm = run_patch(monkeypatch, [
+        '```json\n[{"op": "append", "path": "财务", "content": "- 建立应急基金"}]\n```'
+    ])
+    assert result["success"] and result["mode"] == "structured"
+    assert content == DOC + "- 建立应急基金\n"
+    assert len(llm.prompts) == 1
+
+
+@pytest.mark.parametrize("reply", [
+    "这不是 JSON",
+    '[{"op": "append", "path": "不存在的章节", "content": "- x"}]',
+    '[{"op": "append", "path": "目标", "content": "- x"}, {"op": "unknown"}]',
+    '[{"op": "append", "path": "目标", "content": 42}]',
+    '[{"op": "replace", "path": "目标 > 短期 > 不存在", "old": "x", "new": "y"}]',
+])
+def test_structured_edit_falls_back_to_full_rewrite(monkeypatch, reply):
+    rewritten = "# 职业规划\n\n## 目标\n- 全文重写后的内容\n"
+    result, content, llm = run_patch(monkeypatch, [reply, rewritten])
+    assert result["success"] and result["mode"] == "rewrite"
+    assert content == rewritten.strip()
+    assert len(llm.prompts) == 2
+    assert "只输出修改后的文档全文" in llm.prompts[1]
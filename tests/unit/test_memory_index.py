@@ -0,0 +1,32 @@
+from src.agents.memory_index import MemoryIndex, split_sections
+
+DOC = """# 职业规划
+> last_accessed: 2026-10-01
+
+## 目标
+- 转向 AI 工程
+```bash
+# 这是注释，不是标题
+cargo build
+```
+
+### 短期
+- 学习 Rust
+"""
+
+
+def test_split_sections_skips_fenced_headings():
+    sections = split_sections(DOC)
+    assert [heading for heading, _ in sections] == ["职业规划", "职业规划 > 目标", "职业规划 > 目标 > 短期"]
+    assert "# 这是注释，不是标题" in dict(sections)["职业规划 > 目标"]
+
+
+def test_index_skips_unchanged_content_and_tracks_etag():
+    index = MemoryIndex()
+    assert index.index_file("职业规划.md", DOC, '"e1"')
+    assert not index.index_file("职业规划.md", DOC, '"e2"')
+    assert index.stale_files({"职业规划.md": '"e2"'}) == []
+    assert index.stale_files({"职业规划.md": '"e3"', "新文件.md": '"e4"'}) == ["职业规划.md", "新文件.md"]
+
+    hits = index.search("Rust 短期", filenames=["职业规划.md"])
+    assert hits[0].heading == "职业规划 > 目标 > 短期"
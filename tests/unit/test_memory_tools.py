@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from src.agents import memory_tools
+from src.agents.memory_index import MemoryIndex
+from src.storage.sphere_storage import SphereStorage
+from src.utils.token_estimator import estimate_tokens
+
+CAREER = """# 职业规划
+## 目标
+- 转向 AI 工程，预算学习时间每周十小时
+## 跑步
+- 每周跑步三次，准备半程马拉松
+"""
+
+HEALTH = """# 健康管理
+## 跑步计划
+- 跑步前热身十分钟，跑步后拉伸
+## 饮食
+- 少糖
+"""
+
+
+@pytest.fixture
+def memory(monkeypatch, fake_dav):
+    storage = SphereStorage()
+    storage.memory_storage = fake_dav
+    index = MemoryIndex()
+    monkeypatch.setattr(memory_tools, "get_sphere_storage", lambda: storage)
+    monkeypatch.setattr(memory_tools, "get_memory_index", lambda: index)
+    fake_dav.put("职业规划.md", CAREER)
+    fake_dav.put("健康管理.md", HEALTH)
+    return fake_dav, index
+
+
+def test_search_memory_returns_sources_within_budget(memory):
+    result = asyncio.run(memory_tools.search_memory("跑步"))
+    assert result["success"]
+    assert result["sources"][0] == "健康管理.md > 健康管理 > 跑步计划"
+    assert "职业规划.md > 职业规划 > 跑步" in result["sources"]
+    assert result["content"].startswith("【健康管理.md > 健康管理 > 跑步计划】")
+
+
+def test_search_memory_stops_at_token_budget(memory):
+    full = asyncio.run(memory_tools.search_memory("跑步", token_budget=10_000))
+    first_block = full["content"].split("\n\n")[0]
+    budget = estimate_tokens(first_block) + 1
+
+    result = asyncio.run(memory_tools.search_memory("跑步", token_budget=budget))
+    assert len(result["sources"]) == 1 < len(full["sources"])
+    assert result["content"] == first_block
+    assert estimate_tokens(result["content"]) <= budget
+
+
+def test_search_memory_truncates_first_block_over_budget(memory):
+    result = asyncio.run(memory_tools.search_memory("跑步", token_budget=5))
+    assert len(result["sources"]) == 1
+    assert estimate_tokens(result["content"]) <= 5
+
+
+def test_search_memory_reports_no_match(memory):
+    result = asyncio.run(memory_tools.search_memory("不存在的主题"))
+    assert not result["success"] and result["sources"] == []
+
+
+def test_ensure_memory_index_rereads_only_changed_files(memory):
+    dav, index = memory
+    asyncio.run(memory_tools.ensure_memory_index())
+    assert sorted(dav.reads) == ["健康管理.md", "职业规划.md"]
+
+    # 没有变化时不再读取任何文件
+    dav.reads.clear()
+    asyncio.run(memory_tools.ensure_memory_index())
+    assert dav.reads == []
+
+    # 只有 ETag 变化的文件被重新读取和索引，新文件也会被发现
+    dav.put("健康管理.md", HEALTH.replace("少糖", "少糖，多喝水"))
+    dav.put("读书.md", "# 读书\n## 清单\n- 多喝水的科学\n")
+    asyncio.run(memory_tools.ensure_memory_index())
+    assert sorted(dav.reads) == ["健康管理.md", "读书.md"]
+    hits = index.search("喝水")
+    assert {hit.filename for hit in hits} == {"健康管理.md", "读书.md"}
+
+
+def test_ensure_memory_index_drops_deleted_files(memory):
+    dav, index = memory
+    asyncio.run(memory_tools.ensure_memory_index())
+    asyncio.run(dav.delete_file("职业规划.md"))
+    asyncio.run(memory_tools.ensure_memory_index())
+    assert {hit.filename for hit in index.search("跑步")} == {"健康管理.md"}
@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+from src.storage.session_journal import SessionJournal, segment_filename, snapshot_filename
+
+DATE = "2026-10-17"
+
+
+def turn(i):
+    return [{"role": "user", "content": f"问题 {i}"}, {"role": "assistant", "content": f"回答 {i}"}]
+
+
+def test_first_save_writes_snapshot_then_appends_segments(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=10)
+    history = turn(0)
+    assert asyncio.run(journal.save(DATE, history, "摘要"))
+    assert fake_dav.writes == [snapshot_filename(DATE)]
+
+    history = history + turn(1)
+    assert asyncio.run(journal.save(DATE, history, "摘要"))
+    assert fake_dav.writes[-1] == segment_filename(DATE, 1)
+    # 分段只包含新增消息，摘要未变时不写摘要记录
+    records = [json.loads(line) for line in fake_dav.files[segment_filename(DATE, 1)].splitlines()]
+    assert [r["message"] for r in records] == turn(1)
+
+    # 没有变化时不写任何文件
+    writes = len(fake_dav.writes)
+    assert asyncio.run(journal.save(DATE, history, "摘要"))
+    assert len(fake_dav.writes) == writes
+
+
+def test_compacts_every_n_segments(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=3)
+    history = []
+    for i in range(4):
+        history = history + turn(i)
+        asyncio.run(journal.save(DATE, history, ""))
+
+    # 快照 → 分段 1 → 分段 2 → 第三个分段触发压缩
+    assert fake_dav.writes == [
+        snapshot_filename(DATE), segment_filename(DATE, 1), segment_filename(DATE, 2), snapshot_filename(DATE)
+    ]
+    assert fake_dav.deletes == [segment_filename(DATE, 1), segment_filename(DATE, 2)]
+    snapshot = json.loads(fake_dav.files[snapshot_filename(DATE)])
+    assert snapshot["history"] == history
+    assert snapshot["journal_seq"] == 2
+    assert not any(name.endswith(".jsonl") for name in fake_dav.files)
+
+
+def test_rewritten_history_forces_snapshot(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=10)
+    history = turn(0) + turn(1)
+    asyncio.run(journal.save(DATE, history, ""))
+    asyncio.run(journal.save(DATE, history + turn(2), ""))
+    asyncio.run(journal.save(DATE, turn(0), ""))  # 删除了后面的消息
+
+    assert fake_dav.writes[-1] == snapshot_filename(DATE)
+    assert json.loads(fake_dav.files[snapshot_filename(DATE)])["history"] == turn(0)
+    assert segment_filename(DATE, 1) not in fake_dav.files
+
+
+def test_reload_after_restart_replays_snapshot_and_tail(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=10)
+    history = turn(0)
+    asyncio.run(journal.save(DATE, history, ""))
+    history = history + turn(1)
+    asyncio.run(journal.save(DATE, history, "第一版摘要"))
+    history = history + turn(2)
+    asyncio.run(journal.save(DATE, history, "第一版摘要"))
+
+    # 新进程：没有内存状态，从快照 + 分段 1、2 重建
+    restarted = SessionJournal(fake_dav, compact_every=10)
+    data = asyncio.run(restarted.load(DATE))
+    assert data == {"history": history, "summary": "第一版摘要"}
+
+    # 重启后继续追加，序号接在已有分段之后
+    history = history + turn(3)
+    asyncio.run(restarted.save(DATE, history, "第一版摘要"))
+    assert fake_dav.writes[-1] == segment_filename(DATE, 3)
+    assert asyncio.run(SessionJournal(fake_dav, compact_every=10).load(DATE))["history"] == history
+
+
+def test_restart_without_load_compacts_and_cleans_segments(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=10)
+    history = turn(0)
+    asyncio.run(journal.save(DATE, history, ""))
+    history = history + turn(1)
+    asyncio.run(journal.save(DATE, history, ""))
+
+    restarted = SessionJournal(fake_dav, compact_every=10)
+    history = history + turn(2)
+    asyncio.run(restarted.save(DATE, history, ""))
+
+    snapshot = json.loads(fake_dav.files[snapshot_filename(DATE)])
+    assert snapshot["history"] == history
+    assert snapshot["journal_seq"] == 1
+    assert segment_filename(DATE, 1) not in fake_dav.files
+    assert asyncio.run(SessionJournal(fake_dav, compact_every=10).load(DATE))["history"] == history
+
+
+def test_missing_segment_stops_replay(fake_dav):
+    journal = SessionJournal(fake_dav, compact_every=10)
+    history = turn(0)
+    asyncio.run(journal.save(DATE, history, ""))
+    asyncio.run(journal.save(DATE, history + turn(1), ""))
+
+    class FlakyStorage(type(fake_dav)):
+        async def read_file(self, filename, expected_etag=None):
+            if filename.endswith(".jsonl"):
+                return None
+            return self.files.get(filename)
+
+    flaky = FlakyStorage()
+    flaky.files = dict(fake_dav.files)
+    data = asyncio.run(SessionJournal(flaky, compact_every=10).load(DATE))
+    assert data["history"] == turn(0)
@@ -0,0 +1,184 @@
+import asyncio
+import json
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from src.agents import memory_tools, thinking_tool_stream
+from src.agents.thinking_tool_stream import ChunkType, StreamChunk
+from src.storage import sphere_storage
+from src.storage.session_journal import SessionJournal
+from src.storage.sphere_storage import SphereStorage
+
+
+def make_storage(monkeypatch, fake_dav, today):
+    clock = {"today": today}
+    monkeypatch.setattr(sphere_storage, "get_current_logical_date", lambda: clock["today"])
+    storage = SphereStorage()
+    storage.current_storage = fake_dav
+    storage.journal = SessionJournal(fake_dav, compact_every=10)
+    monkeypatch.setattr(storage, "_load_local_session", lambda: {"history": [], "summary": ""})
+    return storage, clock
+
+
+def test_session_state_reloads_after_logical_date_rollover(monkeypatch, fake_dav):
+    storage, clock = make_storage(monkeypatch, fake_dav, date(2026, 10, 16))
+
+    async def main():
+        state = await storage.get_session_state()
+        storage.append_session_messages([{"role": "user", "content": "昨天"}], persist=False)
+        yesterday_id = state.session_id
+
+        clock["today"] = date(2026, 10, 17)
+        await storage.journal.save("2026-10-17", [{"role": "user", "content": "今天"}], "")
+        storage._latest_session_date = None
+        rolled = await storage.get_session_state()
+        return yesterday_id, rolled
+
+    yesterday_id, rolled = asyncio.run(main())
+    assert rolled.session_id != yesterday_id
+    assert rolled.date_str == "2026-10-17"
+    assert rolled.history == [{"role": "user", "content": "今天"}]
+
+
+def test_append_across_rollover_returns_new_state(monkeypatch, fake_dav):
+    storage, clock = make_storage(monkeypatch, fake_dav, date(2026, 10, 16))
+
+    async def main():
+        state = await storage.get_session_state()
+        clock["today"] = date(2026, 10, 17)
+        appended = storage.append_session_messages([{"role": "user", "content": "凌晨四点后"}], persist=False)
+        return state, appended
+
+    state, appended = asyncio.run(main())
+    assert appended is not state
+    assert appended.date_str == "2026-10-17"
+    assert appended.history == [{"role": "user", "content": "凌晨四点后"}]
+
+
+# ===== /chat 会话模式的增量协议 =====
+
+
+def msg(role, content):
+    return {"role": role, "content": content}
+
+
+class FrontendSession:
+    """按 frontend/index.html 的逻辑维护本地历史：append 接在发送前的历史之后，resync 整体替换"""
+
+    def __init__(self, loaded):
+        self.history = list(loaded["history"])
+        self.session_id = loaded["session_id"]
+        self.version = loaded["version"]
+
+    def apply(self, metadata, base_length):
+        if metadata.get("session_id"):
+            self.session_id = metadata["session_id"]
+            self.version = metadata["version"]
+        if "append" in metadata:
+            self.history = self.history[:base_length] + metadata["append"]
+        elif metadata.get("history") is not None and (metadata.get("resync") or metadata["history"]):
+            self.history = metadata["history"]
+
+
+@pytest.fixture
+def chat(monkeypatch, fake_dav):
+    storage, _ = make_storage(monkeypatch, fake_dav, date(2026, 10, 17))
+    monkeypatch.setattr(sphere_storage, "_sphere_storage", storage)
+
+    async def memory_files():
+        return ["职业规划.md"]
+
+    async def reply(messages, tools, tool_executor, **kwargs):
+        yield StreamChunk(type=ChunkType.CONTENT, content=f"回答：{messages[-1]['content']}")
+        yield StreamChunk(type=ChunkType.CONTENT, content="", is_final=True)
+
+    monkeypatch.setattr(memory_tools, "list_available_memories", memory_files)
+    monkeypatch.setattr(thinking_tool_stream, "stream_with_thinking_tools", reply)
+    monkeypatch.setattr(main, "write_debug_prompt", lambda messages: None)
+    client = TestClient(main.app)
+
+    def send(frontend, text, **overrides):
+        """像前端一样发送一轮并应用 metadata，返回 metadata"""
+        base_length = len(frontend.history)
+        frontend.history.append(msg("user", text))
+        payload = {"message": text, "session_id": frontend.session_id, "version": frontend.version, "auto_save": False}
+        payload.update(overrides)
+        response = client.post("/chat", json=payload)
+        for block in response.text.split("\n\n"):
+            lines = block.split("\n")
+            if lines[0] == "event: metadata":
+                metadata = json.loads("\n".join(line[6:] for line in lines[1:]))
+                frontend.apply(metadata, base_length)
+                return metadata
+        raise AssertionError(f"没有 metadata 事件: {response.text}")
+
+    def load():
+        return FrontendSession(client.get("/session/load").json())
+
+    return storage, client, send, load
+
+
+def test_chat_returns_only_appended_messages(chat):
+    storage, client, send, load = chat
+    frontend = load()
+    metadata = send(frontend, "第一句")
+
+    assert metadata["append"] == [msg("user", "第一句"), msg("ai", "回答：第一句")]
+    assert "history" not in metadata and "resync" not in metadata
+    # 会话模式默认不回传完整提示词
+    assert "raw_prompt" not in metadata["debug"] and "system_prompt" not in metadata["debug"]
+    assert metadata["version"] == metadata["base_version"] + 1
+
+    send(frontend, "第二句")
+    assert frontend.history == storage._session_state.history
+    assert frontend.version == storage._session_state.version
+
+
+def test_stale_client_version_gets_full_resync(chat):
+    storage, client, send, load = chat
+    frontend = load()
+    other_tab = load()
+    send(other_tab, "另一个标签页")
+
+    metadata = send(frontend, "旧版本")
+    assert metadata["resync"] is True and "append" not in metadata
+    assert frontend.history == storage._session_state.history
+    assert [m["content"] for m in frontend.history] == [
+        "另一个标签页", "回答：另一个标签页", "旧版本", "回答：旧版本"
+    ]
+    # 重新同步后恢复增量
+    assert "append" in send(frontend, "继续")
+
+
+def test_history_rewrite_forces_resync(chat):
+    storage, client, send, load = chat
+    frontend = load()
+    send(frontend, "第一句")
+    send(frontend, "第二句")
+
+    # 其他客户端通过 /session/sync 改写了历史（删掉了第二轮）
+    rewritten = frontend.history[:2]
+    assert client.post("/session/sync", json={"history": rewritten, "summary": "", "wait": True}).json()["status"] == "synced"
+
+    metadata = send(frontend, "第三句")
+    assert metadata["resync"] is True
+    assert frontend.history == rewritten + [msg("user", "第三句"), msg("ai", "回答：第三句")]
+
+
+def test_unknown_session_id_gets_resync(chat):
+    storage, client, send, load = chat
+    frontend = load()
+    frontend.session_id = "重启前的会话"
+    metadata = send(frontend, "你好")
+    assert metadata["resync"] is True
+    assert frontend.session_id == storage._session_state.session_id
+
+
+def test_debug_flag_restores_prompt_in_session_mode(chat):
+    storage, client, send, load = chat
+    metadata = send(load(), "调试", debug=True)
+    assert metadata["debug"]["raw_prompt"][-1] == {"role": "user", "content": "调试"}
+    assert "system_prompt" in metadata["debug"]
@@ -0,0 +1,109 @@
+import asyncio
+
+from src.storage import session_writer
+from src.storage.session_writer import SessionWriteBehind
+
+DATE = "2026-10-17"
+
+
+class FlakyUpload:
+    """前 failures 次上传失败（抛异常或返回 False），之后成功"""
+
+    def __init__(self, failures=0, raises=False):
+        self.failures = failures
+        self.raises = raises
+        self.calls: list[list] = []
+        self.uploaded: list[list] = []
+
+    async def __call__(self, history, summary, date_str):
+        self.calls.append(history)
+        if len(self.calls) <= self.failures:
+            if self.raises:
+                raise OSError("WebDAV 暂时不可用")
+            return False
+        self.uploaded.append(history)
+        return True
+
+
+def test_coalesces_saves_within_window():
+    upload = FlakyUpload()
+
+    async def main():
+        writer = SessionWriteBehind(upload, delay=0.01)
+        for i in range(3):
+            writer.schedule([i], "", DATE)
+        await asyncio.sleep(0.05)
+        return writer
+
+    writer = asyncio.run(main())
+    assert upload.uploaded == [[2]]
+    assert writer.stats()["coalesced"] == 2
+
+
+def test_failed_upload_is_retried_with_backoff():
+    upload = FlakyUpload(failures=2, raises=True)
+
+    async def main():
+        writer = SessionWriteBehind(upload, delay=0.01, max_retries=5)
+        writer.schedule(["a"], "", DATE)
+        await asyncio.sleep(0.2)
+        return writer
+
+    writer = asyncio.run(main())
+    assert upload.calls == [["a"]] * 3
+    assert upload.uploaded == [["a"]]
+    assert writer.stats()["retried"] == 2
+    assert writer.get_pending(DATE) is None
+
+
+def test_failed_snapshot_does_not_replace_newer_one():
+    upload = FlakyUpload(failures=1)
+
+    async def main():
+        writer = SessionWriteBehind(upload, delay=0.01)
+        writer.schedule(["旧"], "", DATE)
+        await asyncio.sleep(0.015)           # 第一次上传失败
+        writer.schedule(["新"], "", DATE)
+        await asyncio.sleep(0.1)
+        return writer
+
+    asyncio.run(main())
+    assert upload.uploaded[-1] == ["新"]
+    assert ["旧"] not in upload.uploaded
+
+
+def test_write_now_supersedes_failed_background_snapshot():
+    upload = FlakyUpload(failures=1)
+
+    async def main():
+        writer = SessionWriteBehind(upload, delay=0.01)
+        writer.schedule(["旧"], "", DATE)
+        await asyncio.sleep(0.015)
+        assert await writer.write_now(["立即"], "", DATE)
+        await asyncio.sleep(0.1)
+        return writer
+
+    writer = asyncio.run(main())
+    assert upload.uploaded == [["立即"]]
+    assert writer.get_pending(DATE) is None
+
+
+def test_flush_retries_and_reports_failures(monkeypatch):
+    monkeypatch.setattr(session_writer, "FLUSH_RETRY_BASE", 0)
+
+    async def run(upload):
+        writer = SessionWriteBehind(upload, delay=10)
+        writer.schedule(["最后一轮"], "", DATE)
+        failed = await writer.flush(retries=1)
+        return writer, failed
+
+    upload = FlakyUpload(failures=1)
+    writer, failed = asyncio.run(run(upload))
+    assert failed == [] and upload.uploaded == [["最后一轮"]]
+
+    upload = FlakyUpload(failures=10, raises=True)
+    writer, failed = asyncio.run(run(upload))
+    assert failed == [DATE]
+    assert len(upload.calls) == 2
+    # 快照保留下来，调用方可以另行保存
+    assert writer.get_pending(DATE) == {"history": ["最后一轮"], "summary": ""}
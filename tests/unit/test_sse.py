@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from src.utils.sse import FLUSH_TICK, SSECoalescer, encode_event
+
+
+def test_encode_event_prefixes_every_line():
+    assert encode_event("content", "a\r\nb") == "event: content\ndata: a\ndata: b\n\n"
+
+
+def test_content_is_coalesced_until_bytes_or_delay():
+    sse = SSECoalescer(max_delay=60, max_bytes=6)
+    assert sse.content("a") != ""  # 空闲后的第一个增量立即发出
+    assert sse.content("b") == ""
+    assert sse.content("cd") == ""
+    assert sse.content("efg") == encode_event("content", "bcdefg")
+    assert sse.content("h") == ""
+    assert sse.event("done", "{}") == encode_event("content", "h") + encode_event("done", "{}")
+    assert sse.stats() == {"deltas": 5, "frames": 3}
+
+
+async def stalling_stream(pause):
+    yield "a"
+    yield "b"
+    await asyncio.sleep(pause)  # 模型停顿：调用工具或长时间思考
+    yield "c"
+
+
+def test_buffered_content_is_flushed_while_model_stalls():
+    async def main():
+        sse = SSECoalescer(max_delay=0.05, max_bytes=1024)
+        start = time.monotonic()
+        frames = []
+        async for item in sse.paced(stalling_stream(0.5)):
+            if item is FLUSH_TICK:
+                frame = sse.flush()
+            else:
+                frame = sse.content(item)
+            if frame:
+                frames.append((round(time.monotonic() - start, 2), frame))
+        frame = sse.flush()
+        if frame:
+            frames.append((round(time.monotonic() - start, 2), frame))
+        return frames
+
+    frames = asyncio.run(main())
+    contents = [frame for _, frame in frames]
+    assert contents == [encode_event("content", t) for t in ("a", "b", "c")]
+    # "b" 在停顿期间按计时发出，而不是等到 0.5s 后 "c" 到达
+    assert frames[1][0] < 0.3
+    assert frames[2][0] >= 0.5
+
+
+def test_closing_paced_iterator_cancels_pending_read():
+    cancelled = asyncio.Event()
+
+    async def slow_stream():
+        yield "a"
+        yield "b"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield "never"
+
+    async def main():
+        sse = SSECoalescer(max_delay=0.01, max_bytes=1024)
+        paced = sse.paced(slow_stream())
+        async for item in paced:
+            if item is FLUSH_TICK:
+                sse.flush()
+                break
+            sse.content(item)
+        await paced.aclose()
+        return cancelled.is_set()
+
+    assert asyncio.run(main())
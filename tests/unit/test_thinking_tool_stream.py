@@ -0,0 +1,218 @@
+import asyncio
+import gc
+
+from src.agents.thinking_tool_stream import _gather_unless_cancelled
+
+
+def test_gather_cancel_awaits_tools_and_retrieves_errors():
+    unhandled = []
+
+    async def failing_tool():
+        try:
+            await asyncio.sleep(10)
+        finally:
+            raise RuntimeError("工具在取消后报错")
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        cancel_event = asyncio.Event()
+        tasks = [asyncio.create_task(failing_tool()), asyncio.create_task(asyncio.sleep(10))]
+        asyncio.get_running_loop().call_later(0.01, cancel_event.set)
+        result = await _gather_unless_cancelled(tasks, cancel_event)
+        assert result is None
+        assert all(task.done() for task in tasks)
+        gc.collect()
+
+    asyncio.run(main())
+    gc.collect()
+    assert unhandled == []
+
+
+def test_gather_returns_results_when_not_cancelled():
+    async def tool(value):
+        await asyncio.sleep(0)
+        return value
+
+    async def main():
+        tasks = [asyncio.create_task(tool(i)) for i in range(3)]
+        return await _gather_unless_cancelled(tasks, asyncio.Event())
+
+    assert asyncio.run(main()) == [0, 1, 2]
+
+
+# ===== 流式工具调用组装与提前执行 =====
+
+from types import SimpleNamespace
+
+import src.agents.thinking_tool_stream as thinking_tool_stream
+from src.agents.thinking_tool_stream import ChunkType, ToolCallAssembler, _is_complete_json
+
+
+def tool_delta(index, id=None, name=None, arguments=None):
+    return SimpleNamespace(index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def chunk(content=None, tool_calls=None, finish_reason=None):
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls, reasoning_content=None)
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+
+class FakeStream:
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+        self.position = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self.chunks:
+            await asyncio.sleep(self.delay)
+            self.position += 1
+            yield item
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """按轮次返回预设的流，记录每轮请求的 messages"""
+
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, messages, **kwargs):
+        self.requests.append(list(messages))
+        return self.rounds.pop(0)
+
+
+def test_is_complete_json():
+    assert _is_complete_json('{"filename": "a.md"}')
+    assert not _is_complete_json('{"filename": "a.md"')
+    assert not _is_complete_json('{"text": "}"')
+    assert not _is_complete_json("[1]")
+
+
+def test_arguments_split_across_chunks_become_ready_once_complete():
+    assembler = ToolCallAssembler()
+    assert assembler.feed([tool_delta(0, id="call_a", name="fetch_memory", arguments='{"file')]) == []
+    assert assembler.feed([tool_delta(0, arguments='name": "职业')]) == []
+    assert assembler.feed([tool_delta(0, arguments='规划.md"}')]) == [0]
+    assert assembler.calls[0] == {"id": "call_a", "name": "fetch_memory", "arguments": '{"filename": "职业规划.md"}'}
+    # 已就绪的调用不会重复报告
+    assert assembler.feed([]) == []
+    assert assembler.finish() == []
+
+
+def test_interleaved_tool_calls_are_assembled_independently():
+    assembler = ToolCallAssembler()
+    ready = []
+    ready += assembler.feed([tool_delta(0, id="call_a", name="fetch_memory", arguments='{"filename": ')])
+    ready += assembler.feed([tool_delta(1, id="call_b", name="search_memory", arguments='{"query": "Ru')])
+    # 第二个调用已开始，但第一个的参数还不完整，不能提前启动
+    assert ready == []
+    ready += assembler.feed([tool_delta(0, arguments='"a.md"}'), tool_delta(1, arguments='st"}')])
+    assert ready == [0, 1]
+    assert assembler.calls[0]["arguments"] == '{"filename": "a.md"}'
+    assert assembler.calls[1]["arguments"] == '{"query": "Rust"}'
+
+
+def test_incomplete_arguments_are_released_at_stream_end():
+    assembler = ToolCallAssembler()
+    assembler.feed([tool_delta(0, id="call_a", name="list_memories", arguments="")])
+    assert assembler.finish() == [0]
+
+
+def test_tools_start_during_stream_and_results_follow_tool_call_order(monkeypatch):
+    started = []
+    started_at = {}
+
+    async def executor(name, args):
+        started.append(args["n"])
+        started_at[args["n"]] = first_round.position
+        # 先启动的工具更慢，结果仍须按 tool_call_id 顺序回传
+        await asyncio.sleep(0.05 if args["n"] == 1 else 0.0)
+        return f"结果{args['n']}"
+
+    first_round = FakeStream([
+        chunk(tool_calls=[tool_delta(0, id="call_1", name="fetch_memory", arguments='{"n": ')]),
+        chunk(tool_calls=[tool_delta(0, arguments="1}"), tool_delta(1, id="call_2", name="fetch_memory", arguments='{"n": 2}')]),
+        chunk(tool_calls=[tool_delta(2, id="call_3", name="fetch_memory", arguments='{"n": 3}')]),
+        chunk(content="", finish_reason="tool_calls"),
+    ], delay=0.01)
+    second_round = FakeStream([chunk(content="完成"), chunk(finish_reason="stop")])
+    client = FakeClient([first_round, second_round])
+    monkeypatch.setattr(thinking_tool_stream, "get_async_client", lambda: client)
+
+    async def collect():
+        return [
+            item async for item in thinking_tool_stream.stream_with_thinking_tools(
+                [{"role": "user", "content": "hi"}], [{}], executor
+            )
+        ]
+
+    chunks = asyncio.run(collect())
+    assert started == [1, 2, 3]
+    # 前两个工具在流结束（第 4 个 chunk）之前就已启动
+    assert started_at[1] < 4 and started_at[2] < 4
+    assert [c.tool_call["args"]["n"] for c in chunks if c.type == ChunkType.TOOL_CALL] == [1, 2, 3]
+    assert "".join(c.content for c in chunks if c.type == ChunkType.CONTENT) == "完成"
+
+    tool_messages = [m for m in client.requests[1] if m["role"] == "tool"]
+    assert [(m["tool_call_id"], m["content"]) for m in tool_messages] == [
+        ("call_1", "结果1"), ("call_2", "结果2"), ("call_3", "结果3")
+    ]
+    assistant = client.requests[1][-4]
+    assert [tc["id"] for tc in assistant["tool_calls"]] == ["call_1", "call_2", "call_3"]
+    # 每个采用的调用各产出一次 TOOL_RESULT，按 tool_call_id 顺序
+    assert [(c.tool_call["args"]["n"], c.content) for c in chunks if c.type == ChunkType.TOOL_RESULT] == [
+        (1, "结果1"), (2, "结果2"), (3, "结果3")
+    ]
+
+
+def run_single_call(monkeypatch, argument_deltas):
+    """一轮只有一个工具调用，参数按给定增量到达；返回 (执行记录, 输出块, 第二轮请求的 tool 消息)"""
+    executed = []
+
+    async def executor(name, args):
+        executed.append(args)
+        return f"结果{args['n']}"
+
+    first_round = FakeStream(
+        [chunk(tool_calls=[tool_delta(0, id="call_1", name="fetch_memory", arguments=argument_deltas[0])])]
+        + [chunk(tool_calls=[tool_delta(0, arguments=delta)]) for delta in argument_deltas[1:]]
+        + [chunk(content="", finish_reason="tool_calls")],
+        delay=0.01,
+    )
+    client = FakeClient([first_round, FakeStream([chunk(content="完成"), chunk(finish_reason="stop")])])
+    monkeypatch.setattr(thinking_tool_stream, "get_async_client", lambda: client)
+
+    async def collect():
+        return [
+            item async for item in thinking_tool_stream.stream_with_thinking_tools(
+                [{"role": "user", "content": "hi"}], [{}], executor
+            )
+        ]
+
+    chunks = asyncio.run(collect())
+    tool_messages = [m for m in client.requests[1] if m["role"] == "tool"]
+    return executed, chunks, tool_messages
+
+
+def test_whitespace_after_complete_arguments_does_not_rerun_tool(monkeypatch):
+    executed, chunks, tool_messages = run_single_call(monkeypatch, ['{"n": 1}', "  ", "\n"])
+    assert executed == [{"n": 1}]
+    assert [c.content for c in chunks if c.type == ChunkType.TOOL_RESULT] == ["结果1"]
+    assert tool_messages[0]["content"] == "结果1"
+
+
+def test_output_of_superseded_eager_run_is_discarded(monkeypatch):
+    # 提前启动后参数又变得无效：已执行的结果不能作为 TOOL_RESULT 上报
+    executed, chunks, tool_messages = run_single_call(monkeypatch, ['{"n": 1}', ', "x": 2}'])
+    assert executed == [{"n": 1}]
+    assert [c for c in chunks if c.type == ChunkType.TOOL_RESULT] == []
+    assert tool_messages[0]["content"] == "工具执行失败: 参数不是有效的 JSON"